@@ -62,15 +62,16 @@ setup(
     include_package_data=True,
 
     install_requires=[
-        'click==6.7',
+        'click>=7.0,<8',
         'boto3>=1.4.4',
+        'futures>=3.0.5;python_version<"3.0"',
         'tabulate>=0.7.7',
         'timeago>=1.0.7'
     ],
 
     entry_points={
         'console_scripts': [
-            'shipami=shipami.cli:cli',
+            'shipami=shipami.cli:main',
         ],
     },
 
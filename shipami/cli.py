@@ -2,12 +2,15 @@ from . import __version__ as VERSION
 
 import json
 import logging
+import os
+import sys
+import time
 import click
 
 from tabulate import tabulate
 import datetime, timeago, dateutil.parser
 
-from shipami.core import ShipAMI
+from shipami import client, completion, history, inventory, regions as aws_regions, tracing
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
@@ -18,6 +21,17 @@ state_colors = {
     'failed': 'red'
 }
 
+FILTERS = {
+    'name': 'name',
+    'release': 'release',
+    'id': 'id',
+    'state': 'state',
+    'managed': 'managed',
+    'shared': 'shared',
+    'marketplace': 'marketplace',
+    'public': 'public'
+}
+
 def validate_filter(ctx, param, filters):
     validated_filters = []
     for f in filters:
@@ -26,8 +40,63 @@ def validate_filter(ctx, param, filters):
             validated_filters.append((k, v))
         except ValueError:
             raise click.BadParameter('filter must be in format "key=value"')
+    for k, v in validated_filters:
+        if k not in FILTERS.keys():
+            raise click.BadParameter('available filters are {}'.format(FILTERS.keys()))
     return tuple(validated_filters)
 
+def validate_tag(ctx, param, tags):
+    validated_tags = []
+    for t in tags:
+        if '=' not in t:
+            raise click.BadParameter('tag must be in format "key=value"')
+        validated_tags.append(tuple(t.split('=', 1)))
+    return tuple(validated_tags)
+
+def apply_filters(images, filters):
+    def makefilter(v, attr):
+        def f(_):
+            x = getattr(_, attr)
+            if x is None:
+                return False
+            if isinstance(x, bool):
+                bool_mapping = {'yes': True, 'no': False}
+                return x is bool_mapping.get(v)
+            return v in x
+        return f
+
+    for k, v in filters:
+        images = filter(makefilter(v, FILTERS[k]), images)
+    return [_ for _ in images]
+
+def shares_label(image):
+    if image.shared is None:
+        return None
+    labels = []
+    if image.shared_accounts:
+        labels.append(str(image.shared_accounts))
+    if image.marketplace:
+        labels.append('marketplace')
+    if image.public:
+        labels.append('public')
+    return ','.join(labels) or 'no'
+
+def split_values(values):
+    return [v for value in values for v in value.split(',') if v]
+
+def echo_estimates(shipami, image_ids, source_region=None, region=None, incremental=False):
+    for image_id in image_ids:
+        try:
+            seconds = shipami.estimate(image_id, region, source_region=source_region, incremental=incremental)
+        except RuntimeError:
+            return
+        if seconds is None:
+            continue
+        finish = datetime.datetime.now() + datetime.timedelta(seconds=seconds)
+        click.echo('{}: {} -> {} expected to take {} (around {})'.format(
+            image_id, source_region or shipami.region, region or shipami.region,
+            history.format_duration(seconds), finish.strftime('%H:%M')), err=True)
+
 class AliasedGroup(click.Group):
     ALIASES = {
         'ls': 'list',
@@ -47,78 +116,96 @@ class AliasedGroup(click.Group):
 @click.group(cls=AliasedGroup)
 @click.version_option(VERSION)
 @click.option('--profile')
-@click.option('--region')
+@click.option('--role-arn', help='Role to assume, credentials are cached until they expire')
+@click.option('--region', autocompletion=completion.complete_regions)
 @click.option('-v', '--verbose', is_flag=True, default=False)
+@click.option('--trace', type=click.Path(dir_okay=False, writable=True), help='Write a Chrome trace of AWS operations to this file')
 @click.pass_context
-def cli(ctx, profile, region, verbose):
+def cli(ctx, profile, role_arn, region, verbose, trace):
     """CLI tool to manage AWS AMI and Marketplace"""
-    if verbose:
-        logger.setLevel(logging.DEBUG)
-    else:
-        logger.setLevel(logging.INFO)
-    ctx.obj = ShipAMI(profile, region)
+    # imported here so that shell completion never loads boto3
+    from shipami.core import ShipAMI
 
+    # `shipami serve` passes a factory handing out warm instances, its
+    # logging and tracing are process wide and left alone
+    if ctx.obj is None:
+        if verbose:
+            logger.setLevel(logging.DEBUG)
+        else:
+            logger.setLevel(logging.INFO)
+        if trace:
+            tracing.start()
+            ctx.call_on_close(lambda: tracing.stop(trace))
 
-@cli.command()
+    factory = ctx.obj or ShipAMI
+    ctx.obj = factory(profile, region, role_arn=role_arn)
+
+
+@cli.command('list')
 @click.option('--quiet', '-q', is_flag=True)
 @click.option('--all', '-a', is_flag=True)
 @click.option('filter_', '--filter', '-f', multiple=True, callback=validate_filter)
 @click.option('--color/--no-color', default=True)
+@click.option('accounts', '--account', multiple=True, help='Profile or role ARN to list, can be repeated')
+@click.option('--verify', is_flag=True, default=False, help='Check SHARED against the images permissions and fix it')
 @click.pass_obj
-def list(shipami, filter_, all, quiet, color):
-    headers = ['NAME', 'RELEASE', 'ID', 'OWNER ID', 'STATE', 'CREATED', 'MANAGED', 'COPIED FROM', 'COPIED TO']
+def list_(shipami, filter_, all, quiet, color, accounts, verify):
+    if verify and (all or accounts):
+        raise click.UsageError('--verify only applies to images of the current account')
+    headers = ['NAME', 'RELEASE', 'ID', 'OWNER ID', 'STATE', 'CREATED', 'MANAGED', 'SHARED', 'COPIED FROM', 'COPIED TO']
+    if accounts:
+        headers.insert(0, 'ACCOUNT')
     headers_mapping = {
-        'NAME': 'Name',
-        'RELEASE': 'Release',
-        'ID': 'ImageId',
-        'OWNER ID': 'OwnerId',
-        'STATE': 'State',
-        'CREATED': 'CreationDate',
-        'MANAGED': 'Managed',
-        'COPIED FROM': 'CopiedFrom',
-        'COPIED TO': 'CopiedTo'
+        'ACCOUNT': 'account',
+        'NAME': 'name',
+        'RELEASE': 'release',
+        'ID': 'id',
+        'OWNER ID': 'owner_id',
+        'STATE': 'state',
+        'CREATED': 'creation_date',
+        'MANAGED': 'managed',
+        'SHARED': 'shared',
+        'COPIED FROM': 'copied_from',
+        'COPIED TO': 'copied_to'
     }
 
-    filters = ['NAME', 'RELEASE', 'ID', 'STATE', 'MANAGED']
-    filters_mapping = {}
-    for f in filters:
-        filters_mapping[f.strip().lower()] = f
-
-    for k, v in filter_:
-        if k not in filters_mapping.keys():
-            raise click.BadParameter('available filters are {}'.format(filters_mapping.keys()))
-
-    def makefilter(k, v, attr):
-        def f(_):
-            x = _.get(attr)
-            if x is None:
-                return False
-            if isinstance(x, bool):
-                bool_mapping = {'yes': True, 'no': False}
-                return x is bool_mapping.get(v)
-            return v in x
-        return f
-
     now = datetime.datetime.utcnow()
     try:
-        images = shipami.list(include_executable_images=all)
+        if accounts:
+            images = shipami.list_accounts(accounts, include_executable_images=all)
+        else:
+            images = shipami.list(include_executable_images=all)
     except RuntimeError as e:
         raise click.ClickException(str(e))
 
-    for k, v in filter_:
-        attr = headers_mapping.get(filters_mapping.get(k))
-        images = filter(makefilter(k, v, attr), images)
+    if not accounts:
+        try:
+            completion.update_index(shipami.profile, shipami.region, images)
+        except (IOError, OSError) as e:
+            logger.debug('could not update completion index: {}'.format(e))
 
-    images = sorted(images, key=lambda _: _['CreationDate'], reverse=True)
+    if verify:
+        # only verify selected images, share filters apply to verified values
+        images = apply_filters(images, [_ for _ in filter_ if _[0] not in ('shared', 'marketplace', 'public')])
+        try:
+            corrected = shipami.verify_shares(images)
+        except RuntimeError as e:
+            raise click.ClickException(str(e))
+        for image, recorded, actual in corrected:
+            click.echo('{}: shares were {}, now {}'.format(image.id, recorded or 'unknown', actual), err=True)
+
+    images = sorted(apply_filters(images, filter_), key=lambda _: _.creation_date, reverse=True)
 
     if quiet:
-        for image in images: click.echo(image.get('ImageId'))
+        for image in images: click.echo(image.id)
     else:
         d = []
         for image in images:
             row = []
             for col in headers:
-                value = image.get(headers_mapping.get(col))
+                value = getattr(image, headers_mapping.get(col))
+                if isinstance(value, list):
+                    value = ','.join(value) or None
                 if col is 'STATE':
                     if color:
                         value = click.style(value, fg=state_colors.get(value))
@@ -128,13 +215,15 @@ def list(shipami, filter_, all, quiet, color):
                     value = 'yes' if value else 'no'
                     if color and value is 'yes':
                         value = click.style(value, fg='white', bold=True)
+                if col == 'SHARED':
+                    value = shares_label(image)
                 if col is 'COPIED TO':
                     if value and color:
                         value = click.style(value, fg='blue')
                 if col is 'COPIED FROM':
                     if value and color:
                         value = click.style(value, fg='blue')
-                    if value is None and image.get(headers_mapping.get('MANAGED')) is False:
+                    if value is None and image.managed is False:
                         value = 'origin'
                 row.append(value)
             d.append(row)
@@ -142,7 +231,7 @@ def list(shipami, filter_, all, quiet, color):
 
 
 @cli.command()
-@click.argument('image-id', nargs=-1)
+@click.argument('image-id', nargs=-1, autocompletion=completion.complete_image_ids)
 @click.pass_obj
 def show(shipami, image_id):
     try:
@@ -151,21 +240,19 @@ def show(shipami, image_id):
         raise click.ClickException(str(e))
 
     for i, image in enumerate(images):
-        click.echo('id:\t{}'.format(image.get('ImageId')))
-        click.echo('name:\t{}'.format(image.get('Name')))
-        click.echo('state:\t{}'.format(click.style(image.get('State'), fg=state_colors.get(image.get('State')))))
+        click.echo('id:\t{}'.format(image.id))
+        click.echo('name:\t{}'.format(image.name))
+        click.echo('state:\t{}'.format(click.style(image.state, fg=state_colors.get(image.state))))
 
-        if image.get('Tags'):
+        if image.tags:
             click.echo('tags:')
-            for tag in sorted(image['Tags'], key=lambda _: _['Key']):
-                key = tag.get('Key')
-                value = tag.get('Value')
+            for key, value in sorted(image.tags.items()):
                 color = 'blue' if 'shipami:' in key else 'white'
                 click.echo('  {}: {}'.format(key, click.style(value, fg=color, bold=True)))
 
-        if image.get('BlockDeviceMappings'):
+        if image.block_device_mappings:
             click.echo('devices mappings:')
-            for block_device_mapping in image.get('BlockDeviceMappings', []):
+            for block_device_mapping in image.block_device_mappings:
                 click.echo('  {} {}Go type:{}'.format(
                         block_device_mapping['DeviceName'],
                         block_device_mapping['Ebs']['VolumeSize'],
@@ -173,9 +260,9 @@ def show(shipami, image_id):
                     )
                 )
 
-        if image.get('Shares'):
+        if image.shares:
             click.echo('shared with:')
-            for share in image.get('Shares'):
+            for share in image.shares:
                 click.echo('  {}'.format(share['UserId']), nl=False)
                 if share.get('Marketplace') is not None:
                     click.echo(' (AWS MARKETPLACE)', nl=False)
@@ -190,18 +277,72 @@ def show(shipami, image_id):
 
 
 @cli.command()
-@click.argument('image-id')
+@click.argument('image-id', nargs=-1, required=True, autocompletion=completion.complete_image_ids)
 @click.option('--name')
 @click.option('--description')
-@click.option('--source-region')
+@click.option('--source-region', autocompletion=completion.complete_regions)
 @click.option('--copy-tags/--no-copy-tags', default=True)
 @click.option('--copy-tags-to-snapshots/--no-copy-tags-to-snapshots', default=False)
 @click.option('--copy-permissions/--no-copy-permissions', default=False)
 @click.option('--wait/--no-wait', default=False)
+@click.option('--timeout', type=int, help='Seconds to wait for the copy, implies --wait')
+@click.option('--rollback', is_flag=True, default=False, help='Deregister the copy when it times out or is interrupted')
+@click.option('--incremental', is_flag=True, default=False, help='Copy snapshot by snapshot, only sending blocks changed since an earlier copy')
+@click.option('--preflight', is_flag=True, default=False, help='Check sources and destinations before starting any copy')
+@click.option('--auto-source', is_flag=True, default=False, help='Copy from the copy of the image expected to be the fastest to copy from')
+@click.option('--max-in-flight', type=int, help='Maximum concurrent copies when copying several images')
 @click.pass_obj
 def copy(shipami, **kwargs):
+    image_ids = kwargs.pop('image_id')
+    max_in_flight = kwargs.pop('max_in_flight')
+    echo_estimates(shipami, image_ids, kwargs.get('source_region'), kwargs.get('region'), kwargs.get('incremental'))
+
+    if len(image_ids) == 1:
+        try:
+            image_id = shipami.copy(image_ids[0], **kwargs)
+        except RuntimeError as e:
+            raise click.ClickException(str(e))
+
+        click.echo(image_id)
+        return
+
+    errors = []
+    for handle in shipami.copy_images(image_ids, max_in_flight=max_in_flight, **kwargs):
+        # ^C cancels the copies, they fail, or roll back, before the command ends
+        error = shipami.uninterrupted(handle.exception)
+        if error is not None:
+            errors.append('{}: {}'.format(handle.source_image_id, error))
+        else:
+            click.echo(handle.image_id)
+    if errors:
+        raise click.ClickException('\n'.join(errors))
+
+
+@cli.command()
+@click.argument('image-id', autocompletion=completion.complete_image_ids)
+@click.argument('release', autocompletion=completion.complete_releases)
+@click.option('--name')
+@click.option('--description')
+@click.option('--source-region', autocompletion=completion.complete_regions)
+@click.option('--copy-tags/--no-copy-tags', default=True)
+@click.option('--copy-tags-to-snapshots/--no-copy-tags-to-snapshots', default=False)
+@click.option('--copy-permissions/--no-copy-permissions', default=False)
+@click.option('--wait/--no-wait', default=False)
+@click.option('--timeout', type=int, help='Seconds to wait for the copy, implies --wait')
+@click.option('--rollback', is_flag=True, default=False, help='Deregister the copy when it times out or is interrupted')
+@click.option('--incremental', is_flag=True, default=False, help='Copy snapshot by snapshot, only sending blocks changed since an earlier copy')
+@click.option('--preflight', is_flag=True, default=False, help='Check sources and destinations before starting any copy')
+@click.option('--auto-source', is_flag=True, default=False, help='Copy from the copy of the image expected to be the fastest to copy from')
+@click.option('--in-place', is_flag=True, default=False, help='Tag the image as the release instead of copying it, --name goes to shipami:name')
+@click.option('fsr_zones', '--fsr-zones', multiple=True,
+              help='Availability zone where Fast Snapshot Restores are enabled, can be repeated or comma separated')
+@click.pass_obj
+def release(shipami, **kwargs):
+    kwargs['fsr_zones'] = split_values(kwargs['fsr_zones'])
+    if not kwargs.get('in_place'):
+        echo_estimates(shipami, [kwargs['image_id']], kwargs.get('source_region'), kwargs.get('region'), kwargs.get('incremental'))
     try:
-        image_id = shipami.copy(kwargs.pop('image_id'), **kwargs)
+        image_id = shipami.release(kwargs.pop('image_id'), kwargs.pop('release'), **kwargs)
     except RuntimeError as e:
         raise click.ClickException(str(e))
 
@@ -209,30 +350,46 @@ def copy(shipami, **kwargs):
 
 
 @cli.command()
-@click.argument('image-id')
-@click.argument('release')
+@click.argument('release', autocompletion=completion.complete_releases)
+@click.option('regions', '--regions', '-r', multiple=True, required=True, autocompletion=completion.complete_regions,
+              help='Region where the release must exist, can be repeated or comma separated')
 @click.option('--name')
 @click.option('--description')
-@click.option('--source-region')
+@click.option('--source-region', autocompletion=completion.complete_regions)
 @click.option('--copy-tags/--no-copy-tags', default=True)
 @click.option('--copy-tags-to-snapshots/--no-copy-tags-to-snapshots', default=False)
 @click.option('--copy-permissions/--no-copy-permissions', default=False)
 @click.option('--wait/--no-wait', default=False)
+@click.option('--timeout', type=int, help='Seconds to wait for the copy, implies --wait')
+@click.option('--rollback', is_flag=True, default=False, help='Deregister the copy when it times out or is interrupted')
+@click.option('--incremental', is_flag=True, default=False, help='Copy snapshot by snapshot, only sending blocks changed since an earlier copy')
+@click.option('--preflight/--no-preflight', default=True, help='Check sources and destinations before starting any copy')
+@click.option('fsr_zones', '--fsr-zones', multiple=True,
+              help='Availability zone where Fast Snapshot Restores are enabled on copies, can be repeated or comma separated')
 @click.pass_obj
-def release(shipami, **kwargs):
+def sync(shipami, release, regions, **kwargs):
+    regions = split_values(regions)
+    kwargs['fsr_zones'] = split_values(kwargs['fsr_zones'])
     try:
-        image_id = shipami.release(kwargs.pop('image_id'), kwargs.pop('release'), **kwargs)
+        result = shipami.sync(release, regions, **kwargs)
     except RuntimeError as e:
         raise click.ClickException(str(e))
 
-    click.echo(image_id)
+    errors = []
+    for region, image_id, copied, error in result:
+        click.echo('{}\t{}\t{}'.format(region, image_id or '-', 'failed' if error else 'copied' if copied else 'present'))
+        if error:
+            errors.append('{}: {}'.format(region, error))
+    if errors:
+        raise click.ClickException('\n'.join(errors))
 
 
 @cli.command()
-@click.argument('image-id')
+@click.argument('image-id', autocompletion=completion.complete_image_ids)
 @click.option('--account-id')
 @click.option('--create-volume', is_flag=True, default=False)
 @click.option('--remove', is_flag=True, default=False)
+@click.option('--timeout', type=int, help='Seconds to wait for the image and its snapshots')
 @click.pass_obj
 def share(shipami, **kwargs):
     try:
@@ -242,14 +399,263 @@ def share(shipami, **kwargs):
 
 
 @cli.command()
-@click.argument('image-id', nargs=-1)
+@click.argument('image-id', autocompletion=completion.complete_image_ids)
+@click.option('accounts', '--accounts', '-a', multiple=True, required=True,
+              help='Account id or role ARN to copy the image into, can be repeated or comma separated')
+@click.option('regions', '--regions', '-r', multiple=True, autocompletion=completion.complete_regions,
+              help='Regions to copy the image to in every account, can be repeated or comma separated (default: --region)')
+@click.option('--role-name', help='Role assumed in accounts given by id (default: OrganizationAccountAccessRole)')
+@click.option('--name')
+@click.option('--description')
+@click.option('--timeout', type=int, help='Seconds to wait for the copies')
+@click.option('--rollback', is_flag=True, default=False, help='Deregister copies that time out or are interrupted')
+@click.option('--keep-shares', is_flag=True, default=False, help='Leave the image shared with the accounts once copied')
+@click.pass_obj
+def replicate(shipami, image_id, accounts, regions, **kwargs):
+    """Copy an image into other accounts
+
+    The image is shared with every account, copied from each of them into
+    every region at the same time, then unshared.
+    """
+    try:
+        result = shipami.replicate(image_id, split_values(accounts), split_values(regions), **kwargs)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+
+    errors = []
+    for account_id, region, copy_id, error in result:
+        click.echo('{}\t{}\t{}'.format(account_id, region, copy_id or 'failed'))
+        if error:
+            errors.append('{}:{}: {}'.format(account_id, region, error))
+    if errors:
+        raise click.ClickException('\n'.join(errors))
+
+
+@cli.command()
+@click.argument('image-id', nargs=-1, autocompletion=completion.complete_image_ids)
+@click.option('--release', autocompletion=completion.complete_releases, help='Select the images of this release instead of IMAGE_ID')
+@click.option('zones', '--zones', '-z', multiple=True, required=True,
+              help='Availability zone, can be repeated or comma separated, images are looked for in their regions')
+@click.option('--disable', is_flag=True, default=False)
+@click.option('--wait/--no-wait', default=False)
+@click.option('--timeout', type=int, help='Seconds to wait for Fast Snapshot Restores, implies --wait')
+@click.pass_obj
+def fsr(shipami, image_id, release, zones, disable, wait, timeout):
+    """Enable or disable Fast Snapshot Restores on images snapshots"""
+    if bool(image_id) == bool(release):
+        raise click.UsageError('select images with either IMAGE_ID or --release')
+    zones = split_values(zones)
+    invalid = [_ for _ in zones if not aws_regions.zone_region(_)]
+    if invalid:
+        raise click.BadParameter('{} is not an availability zone'.format(', '.join(invalid)), param_hint='--zones')
+    zone_regions = sorted(set(aws_regions.zone_region(_) for _ in zones))
+
+    try:
+        if release:
+            images = [image for found in shipami.find_release(release, zone_regions).values() for image in found]
+        else:
+            images = shipami.find_images(image_id, zone_regions)
+            missing = set(image_id) - set(_.id for _ in images)
+            if missing:
+                raise RuntimeError('The image id \'[{}]\' does not exist'.format(', '.join(sorted(missing))))
+        if not images:
+            raise RuntimeError('no image of release {} in {}'.format(release, ', '.join(zone_regions)))
+        result = shipami.fast_snapshot_restores(images, zones, enable=not disable, wait=wait or timeout is not None, timeout=timeout)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+
+    for region, image_id, image_zones in result:
+        click.echo('{}\t{}\t{}'.format(region, image_id, ','.join(image_zones)))
+
+
+@cli.command()
+@click.argument('image-id', nargs=-1, required=True, autocompletion=completion.complete_image_ids)
+@click.option('--interval', type=int, default=15, help='Seconds between refreshes')
+@click.pass_obj
+def watch(shipami, image_id, interval):
+    """Show progress and ETA of copies until they are done
+
+    IMAGE_ID can be prefixed with its region, as in us-east-1:ami-00000000.
+    """
+    targets = [tuple(_.split(':', 1)) if ':' in _ else (shipami.region, _) for _ in image_id]
+    while True:
+        rows = []
+        try:
+            for region, target in targets:
+                state, progress, remaining = shipami.eta(target, region)
+                rows.append([region, target, state, '{}%'.format(progress), history.format_duration(remaining) if remaining is not None else '-'])
+        except RuntimeError as e:
+            raise click.ClickException(str(e))
+        click.echo(tabulate(rows, headers=['REGION', 'ID', 'STATE', 'PROGRESS', 'ETA'], tablefmt='plain'))
+
+        if not [_ for _ in rows if _[2] == 'pending']:
+            break
+        time.sleep(interval)
+        click.echo()
+
+    failed = [_[1] for _ in rows if _[2] != 'available']
+    if failed:
+        raise click.ClickException('{} did not become available'.format(', '.join(failed)))
+
+
+@cli.command()
+@click.argument('image-id', nargs=-1, autocompletion=completion.complete_image_ids)
+@click.option('filter_', '--filter', '-f', multiple=True, callback=validate_filter, help='Select images like list does')
+@click.option('regions', '--regions', '-r', multiple=True, autocompletion=completion.complete_regions,
+              help='Regions to look for images in, can be repeated or comma separated (default: --region)')
+@click.option('add', '--add', '-a', multiple=True, callback=validate_tag, help='Tag to set as key=value, can be repeated')
+@click.option('remove', '--remove', '-d', multiple=True, help='Tag key to delete, can be repeated')
+@click.option('--snapshots', is_flag=True, default=False, help='Tag the images snapshots too')
+@click.pass_obj
+def tag(shipami, image_id, filter_, regions, add, remove, snapshots):
+    """Add or remove tags on many images at once"""
+    if not image_id and not filter_:
+        raise click.UsageError('select images with IMAGE_ID or --filter')
+    if not add and not remove:
+        raise click.UsageError('nothing to do, use --add or --remove')
+
+    try:
+        images = apply_filters(shipami.find_images(image_id, split_values(regions)), filter_)
+        missing = set(image_id) - set(_.id for _ in images)
+        if missing:
+            raise RuntimeError('The image id \'[{}]\' does not exist'.format(', '.join(sorted(missing))))
+        tagged = shipami.tag(images, add=dict(add), remove=remove, snapshots=snapshots)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+
+    for region, image_id in tagged:
+        click.echo('{}\t{}'.format(region, image_id))
+
+
+@cli.group()
+def snapshot():
+    """Inventory files of owned images, compared with diff"""
+
+
+@snapshot.command('export')
+@click.argument('file', type=click.Path(dir_okay=False, writable=True))
+@click.option('regions', '--regions', '-r', multiple=True, autocompletion=completion.complete_regions,
+              help='Regions to inventory, can be repeated or comma separated (default: --region)')
+@click.pass_obj
+def snapshot_export(shipami, file, regions):
+    """Write owned images of regions to a SQLite inventory FILE"""
+    try:
+        count = inventory.export(shipami, split_values(regions) or [shipami.region], file)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    click.echo('{} images written to {}'.format(count, file), err=True)
+
+
+@cli.command()
+@click.argument('old', type=click.Path(dir_okay=False))
+@click.argument('new', type=click.Path(dir_okay=False))
+def diff(old, new):
+    """Show what changed between two inventories, without calling AWS"""
+    try:
+        for change in inventory.diff(old, new):
+            if change.kind == 'added':
+                click.echo('+ {}\t{}\t{}'.format(change.region, change.image_id, change.new))
+            elif change.kind == 'removed':
+                click.echo('- {}\t{}\t{}'.format(change.region, change.image_id, change.old))
+            else:
+                what = 'tag {}'.format(change.key) if change.kind == 'tag' else change.kind
+                click.echo('~ {}\t{}\t{}: {} -> {}'.format(change.region, change.image_id, what, change.old, change.new))
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+
+
+@cli.command()
+@click.argument('image-id', nargs=-1, autocompletion=completion.complete_image_ids)
 @click.option('--force', '-f', is_flag=True, default=False)
+@click.option('--cascade', is_flag=True, default=False, help='Also delete every copy made from the images, in every region')
+@click.option('--yes', '-y', is_flag=True, default=False, help='Do not ask for confirmation with --cascade')
 @click.pass_obj
-def delete(shipami, image_id, force):
+def delete(shipami, image_id, force, cascade, yes):
     try:
-        deleted = shipami.delete(image_id, force)
+        if cascade:
+            levels = shipami.descendants(image_id)
+            for depth, level in enumerate(levels):
+                for image in level:
+                    click.echo('{}{}\t{}\t{}'.format('  ' * depth, image.region, image.id, ','.join(image.snapshot_ids)), err=True)
+            if not yes:
+                images = sum(len(_) for _ in levels)
+                click.confirm('Delete these {} images and their snapshots?'.format(images), abort=True, err=True)
+            deleted = shipami.delete_lineage(levels, force)
+        else:
+            deleted = shipami.delete(image_id, force)
     except RuntimeError as e:
         raise click.ClickException(str(e))
 
     for d in deleted:
         click.echo(d)
+
+
+@cli.command()
+@click.option('regions', '--regions', '-r', multiple=True, autocompletion=completion.complete_regions,
+              help='Regions to take inventory of, can be repeated or comma separated (default: --region)')
+@click.option('--output', '-o', type=click.Path(dir_okay=False, writable=True), help='Write the metrics to this file instead of stdout')
+@click.option('--port', type=int, help='Serve the metrics over HTTP on this port')
+@click.option('--address', default='127.0.0.1', help='Address to serve the metrics on')
+@click.option('--interval', type=int, default=300, help='Seconds between inventories when serving')
+@click.pass_obj
+def metrics(shipami, regions, output, port, address, interval):
+    """Export image inventory as Prometheus metrics"""
+    from shipami.metrics import Exporter, serve
+
+    exporter = Exporter(shipami, split_values(regions) or None, interval=interval)
+    if port is not None:
+        serve(exporter, address, port)
+        return
+
+    if not exporter.refresh():
+        raise click.ClickException('inventory failed')
+    if output:
+        # node_exporter textfile collectors must never see a partial file
+        tmp_file = '{}.{}'.format(output, os.getpid())
+        with open(tmp_file, 'w') as f:
+            f.write(exporter.text())
+        os.rename(tmp_file, output)
+    else:
+        click.echo(exporter.text(), nl=False)
+
+
+@cli.command()
+@click.option('socket_path', '--socket', help='Unix socket to listen on (default: ~/.shipami/shipami.sock)')
+@click.option('--cache-ttl', type=int, default=60, help='Seconds list results are kept')
+def serve(socket_path, cache_ttl):
+    """Keep clients and inventories warm for other shipami invocations"""
+    from shipami.server import serve
+
+    serve(socket_path or client.socket_path(), cli, cache_ttl)
+
+
+# long running commands are never forwarded to `shipami serve`
+# the daemon does not share the caller's working directory, file arguments stay local
+LOCAL_COMMANDS = ['serve', 'metrics', 'watch', 'snapshot', 'diff']
+
+def runs_locally(argv, command=None):
+    name, params, options = command or client.parse_command(cli, argv)
+    if name is None or name in LOCAL_COMMANDS:
+        return True
+    # the daemon cannot prompt, delete --cascade asks for confirmation unless --yes
+    if name == 'delete' and params.get('cascade') and not params.get('yes'):
+        return True
+    # -v and --trace change process wide state, --trace writes a file
+    return bool(options.get('verbose') or options.get('trace'))
+
+def main():
+    argv = sys.argv[1:]
+    if os.environ.get('_SHIPAMI_COMPLETE'):
+        cli(prog_name='shipami')
+        return
+    command = client.parse_command(cli, argv)
+    if not runs_locally(argv, command):
+        exit_code = client.forward(argv)
+        if exit_code is not None:
+            sys.exit(exit_code)
+    try:
+        cli(prog_name='shipami')
+    finally:
+        # a daemon must not keep serving the inventory this command changed
+        if command[0] is not None and command[0] not in client.READ_COMMANDS:
+            client.mark_changed()
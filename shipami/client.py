@@ -0,0 +1,111 @@
+"""Forwards CLI invocations to a running `shipami serve` daemon
+
+Kept free of boto3 imports so that forwarding costs no more than a socket
+round trip.
+"""
+import json
+import os
+import socket
+import sys
+
+from shipami import paths
+
+SOCKET_FILE = 'shipami.sock'
+# touched by commands that ran locally and may have changed images
+CHANGED_FILE = 'changed'
+# commands which change nothing, the others invalidate cached inventories
+READ_COMMANDS = ['list', 'show']
+
+
+def socket_path():
+    return os.environ.get('SHIPAMI_SOCKET') or paths.path(SOCKET_FILE)
+
+
+def aws_environ(environ=None):
+    environ = os.environ if environ is None else environ
+    return dict((k, v) for k, v in environ.items() if k.startswith('AWS_'))
+
+
+def mark_changed():
+    """Tells a running daemon that its cached inventories may be stale"""
+    path = paths.path(CHANGED_FILE)
+    try:
+        with open(path, 'a'):
+            os.utime(path, None)
+    except (IOError, OSError):
+        pass
+
+
+def changed_at():
+    """Returns when a local command last changed images, 0 when none did"""
+    try:
+        return os.path.getmtime(paths.path(CHANGED_FILE))
+    except (IOError, OSError):
+        return 0
+
+
+def parse_command(group, argv):
+    """Returns (name, params, group params) of the command argv would run
+
+    Nothing is invoked, aliases are resolved like click does. name is None
+    when argv names no command.
+    """
+    import click
+
+    try:
+        ctx = group.make_context('shipami', list(argv), resilient_parsing=True)
+        args = ctx.protected_args + ctx.args
+        if not args:
+            return None, {}, ctx.params
+        command = group.resolve_command(ctx, args)[1]
+        if command is None:
+            return None, {}, ctx.params
+        return command.name, command.make_context(command.name, args[1:], parent=ctx, resilient_parsing=True).params, ctx.params
+    except (click.ClickException, click.exceptions.Exit):
+        return None, {}, {}
+
+
+def forward(argv, path=None, stdout=None, stderr=None):
+    """Runs argv on the daemon and returns its exit code
+
+    Output is written as the daemon sends it. Returns None when there is no
+    daemon or when it cannot run the command with the same AWS environment,
+    the caller must then run it locally.
+    """
+    if os.environ.get('SHIPAMI_NO_DAEMON'):
+        return None
+    path = path or socket_path()
+    if not os.path.exists(path):
+        return None
+    streams = {'stdout': stdout or sys.stdout, 'stderr': stderr or sys.stderr}
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    received = False
+    try:
+        sock.connect(path)
+        request = {'argv': list(argv), 'env': aws_environ()}
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        sock.shutdown(socket.SHUT_WR)
+
+        for line in sock.makefile('rb'):
+            response = json.loads(line.decode('utf-8'))
+            if response.get('fallback'):
+                return None
+            received = True
+            if 'exit_code' in response:
+                return response['exit_code']
+            for name, stream in streams.items():
+                if name in response:
+                    stream.write(response[name])
+                    stream.flush()
+    except (socket.error, ValueError):
+        if not received:
+            return None
+    finally:
+        sock.close()
+
+    if not received:
+        return None
+    # the command may have done part of its work, running it again could repeat it
+    streams['stderr'].write('Error: lost connection to shipami serve\n')
+    return 1
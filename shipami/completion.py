@@ -0,0 +1,90 @@
+"""Shell completion served from a local image index
+
+This module is imported by the CLI when completing and must stay cheap:
+no boto3 import and no network access. The index is refreshed every time
+`shipami list` runs.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+
+from shipami import paths
+from shipami.regions import REGIONS
+
+INDEX_FILE = 'index.json'
+
+_lock = threading.Lock()
+
+
+def load_index():
+    try:
+        with open(paths.path(INDEX_FILE)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def update_index(profile, region, images):
+    """Stores (id, name, release) of images listed for profile and region"""
+    index_file = paths.path(INDEX_FILE)
+    with _lock:
+        index = load_index()
+        index[_key(profile, region)] = {
+            'region': region,
+            'updated': int(time.time()),
+            'images': [[_.id, _.name, _.release] for _ in images]
+        }
+
+        # a temporary file of its own so concurrent updates never share one
+        fd, tmp_file = tempfile.mkstemp(prefix=INDEX_FILE + '.', dir=os.path.dirname(index_file))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(index, f, separators=(',', ':'))
+            os.rename(tmp_file, index_file)
+        except Exception:
+            os.remove(tmp_file)
+            raise
+
+
+def complete_image_ids(ctx, args, incomplete):
+    result = []
+    for image_id, name, release in _images(args):
+        if image_id.startswith(incomplete) or (name or '').startswith(incomplete):
+            result.append((image_id, name or ''))
+    return sorted(set(result))
+
+
+def complete_releases(ctx, args, incomplete):
+    releases = set(_[2] for _ in _images(args) if _[2])
+    return sorted(_ for _ in releases if _.startswith(incomplete))
+
+
+def complete_regions(ctx, args, incomplete):
+    regions = set(REGIONS) | set(_.get('region') for _ in load_index().values() if _.get('region'))
+    return sorted(_ for _ in regions if _.startswith(incomplete))
+
+
+def _key(profile, region):
+    return '{}|{}'.format(profile or '', region or '')
+
+
+def _option(args, name):
+    for i, arg in enumerate(args):
+        if arg == name and i + 1 < len(args):
+            return args[i + 1]
+        if arg.startswith(name + '='):
+            return arg.split('=', 1)[1]
+    return None
+
+
+def _images(args):
+    profile = _option(args, '--profile')
+    region = _option(args, '--region') or os.environ.get('AWS_DEFAULT_REGION')
+
+    index = load_index()
+    entry = index.get(_key(profile, region))
+    if entry:
+        return entry.get('images', [])
+    return [image for entry in index.values() for image in entry.get('images', [])]
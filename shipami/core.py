@@ -1,8 +1,16 @@
+import calendar
 import json
 import logging
 import boto3
 import botocore
-import time
+import dateutil.parser
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from shipami import credentials, history, regions as aws_regions, tracing, waiting
+from shipami.exceptions import CopyLimitExceeded, PreflightError, WaitCancelled, WaitTimeout
+from shipami.scheduler import CopyScheduler
 
 import botocore.vendored.requests.packages.urllib3 as urllib3
 urllib3.disable_warnings(urllib3.exceptions.SecurityWarning)
@@ -10,25 +18,209 @@ urllib3.disable_warnings(urllib3.exceptions.SecurityWarning)
 logging.basicConfig()
 logger = logging.getLogger('shipami.cli')
 
+# One tag per copy, "shipami:copied_to:<region>:<image-id>", so that concurrent
+# copies of the same source never rewrite each other's lineage. Older releases
+# kept a single comma separated "shipami:copied_to" tag, which is still read.
+COPIED_TO_TAG = 'shipami:copied_to'
+COPIED_TO_PREFIX = COPIED_TO_TAG + ':'
+# Availability zones where shipami enabled Fast Snapshot Restores for the
+# snapshots of an image, comma separated, so that delete can disable them
+FSR_TAG = 'shipami:fsr'
+# Summary of the permissions of an image, "accounts=<count>,marketplace=<yes|no>",
+# kept current by shipami when it changes them so that list needs no extra call
+SHARES_TAG = 'shipami:shares'
+# DescribeImages fields an incremental copy registers its image with
+REGISTER_IMAGE_FIELDS = [
+    'Architecture', 'RootDeviceName', 'VirtualizationType', 'EnaSupport', 'SriovNetSupport',
+    'BootMode', 'TpmSupport', 'ImdsSupport', 'KernelId', 'RamdiskId'
+]
+
+
+class ImageRecord(object):
+    """Compact view of a describe_images entry
+
+    Tags are indexed once per image and shipami lineage tags are only parsed
+    when accessed. The raw response can be dropped with drop_raw() when only
+    the summary is needed. ShipAMI passes records around instead of boto3
+    resources so that an image is only described when it is needed.
+    """
+
+    __slots__ = (
+        'id', 'name', 'description', 'state', 'creation_date', 'owner_id', 'region', 'account',
+        'tags', 'shares', 'raw', '_copied_from', '_copied_to'
+    )
+
+    def __init__(self, image, region=None, keep_raw=True):
+        self.id = image.get('ImageId')
+        self.name = image.get('Name')
+        self.description = image.get('Description')
+        self.state = image.get('State')
+        self.creation_date = image.get('CreationDate')
+        self.owner_id = image.get('OwnerId')
+        self.region = region
+        self.account = None
+        self.tags = dict((tag['Key'], tag.get('Value')) for tag in image.get('Tags') or [])
+        self.shares = None
+        self.raw = image if keep_raw else None
+        self._copied_from = None
+        self._copied_to = None
+
+    def __repr__(self):
+        return 'ImageRecord(id={!r}, region={!r})'.format(self.id, self.region)
+
+    @property
+    def managed(self):
+        return self.tags.get('shipami:managed') == 'True'
+
+    @property
+    def release(self):
+        return self.tags.get('shipami:release')
+
+    @property
+    def copied_from(self):
+        if self._copied_from is None:
+            self._copied_from = self.__split(self.tags.get('shipami:copied_from'))
+        return self._copied_from
+
+    @property
+    def copied_to(self):
+        if self._copied_to is None:
+            copied_to = self.__split(self.tags.get(COPIED_TO_TAG))
+            for key in sorted(self.tags):
+                if key.startswith(COPIED_TO_PREFIX):
+                    value = key[len(COPIED_TO_PREFIX):]
+                    if value not in copied_to:
+                        copied_to.append(value)
+            self._copied_to = copied_to
+        return self._copied_to
+
+    @property
+    def shared_accounts(self):
+        """Number of accounts allowed to launch the image, None when unknown"""
+        value = self.__shares().get('accounts')
+        return int(value) if value and value.isdigit() else None
+
+    @property
+    def marketplace(self):
+        """Whether the image and its snapshots are shared with AWS Marketplace, None when unknown"""
+        value = self.__shares().get('marketplace')
+        return {'yes': True, 'no': False}.get(value)
+
+    @property
+    def public(self):
+        """Whether anyone can launch the image, None when unknown"""
+        if self.shared_accounts is None:
+            return None
+        return self.__shares().get('public') == 'yes'
+
+    @property
+    def shared(self):
+        if self.shared_accounts is None:
+            return None
+        return bool(self.shared_accounts or self.marketplace or self.public)
+
+    @property
+    def block_device_mappings(self):
+        if self.raw is None:
+            return []
+        return self.raw.get('BlockDeviceMappings', [])
+
+    @property
+    def size(self):
+        """Total size of the EBS volumes in GiB"""
+        return sum(_['Ebs'].get('VolumeSize') or 0 for _ in self.block_device_mappings if _.get('Ebs'))
+
+    @property
+    def snapshot_ids(self):
+        return [_['Ebs']['SnapshotId'] for _ in self.block_device_mappings if _.get('Ebs', {}).get('SnapshotId')]
+
+    def drop_raw(self):
+        self.raw = None
+
+    def __split(self, value):
+        return [_ for _ in value.split(',') if _] if value else []
+
+    def __shares(self):
+        return dict(_.split('=', 1) for _ in self.__split(self.tags.get(SHARES_TAG)) if '=' in _)
+
 
 class ShipAMI(object):
 
     MARKETPLACE_REGION = 'us-east-1'
     MARKETPLACE_ACCOUNT_ID = '679593333241'
-
-    def __init__(self, profile=None, region=None):
+    COPY_LIMIT_ERRORS = ['ResourceLimitExceeded', 'RequestLimitExceeded']
+    # CreateTags and DeleteTags accept up to 1000 resource ids per call
+    MAX_TAG_RESOURCES = 1000
+    DELETE_WORKERS = 4
+    # seconds rollback keeps retrying the snapshots of a deregistered copy
+    ROLLBACK_TIMEOUT = 300
+    # concurrent AMI copies allowed per destination region
+    MAX_CONCURRENT_COPIES = 50
+    # EnableFastSnapshotRestores and DisableFastSnapshotRestores accept up to 10 snapshots
+    MAX_FSR_SNAPSHOTS = 10
+    # role assumed in target accounts by replicate, created by AWS Organizations
+    REPLICATE_ROLE_NAME = 'OrganizationAccountAccessRole'
+
+    def __init__(self, profile=None, region=None, role_arn=None, session_factory=None, clock=None):
         self._profile = profile
-        self._region = region or boto3.session.Session().region_name
+        self._role_arn = role_arn
+        # any callable taking profile_name and region_name, see shipami.fake
+        self._session_factory = session_factory or boto3.session.Session
+        # time of waits and deadlines, see shipami.fake.ManualClock
+        self._clock = clock or waiting.CLOCK
+        self._region = region or self._session_factory().region_name
         self._sessions = {}
+        self._clients = {}
+        # boto3 sessions are not thread safe, clients created from them are
+        self._lock = threading.RLock()
+        self._cancel = threading.Event()
+
+    @property
+    def profile(self):
+        return self._profile
+
+    @property
+    def region(self):
+        return self._region
+
+    def cancel(self):
+        """Interrupts every wait in progress with WaitCancelled"""
+        self._cancel.set()
+
+    def uninterrupted(self, wait):
+        """Returns wait(), a ^C cancels every wait in progress then waits again
+
+        ^C only reaches the main thread, copies running in other threads
+        learn about it through cancel() and fail, or roll back, on their own.
+        """
+        while True:
+            try:
+                return wait()
+            except KeyboardInterrupt:
+                logger.warning('interrupted, cancelling the copies in progress')
+                self.cancel()
 
     def __get_session(self, region=None):
         region = region or self._region
-        session = self._sessions.get(region)
-        if not session:
-            self._sessions[region] = boto3.session.Session(profile_name=self._profile, region_name=region)
-            session = self._sessions[region]
+        with self._lock:
+            session = self._sessions.get(region)
+            if not session:
+                if self._role_arn:
+                    self._sessions[region] = credentials.assume_role_session(self._role_arn, profile=self._profile, region=region)
+                else:
+                    self._sessions[region] = self._session_factory(profile_name=self._profile, region_name=region)
+                session = self._sessions[region]
         return session
 
+    def __get_client(self, region=None):
+        region = region or self._region
+        with self._lock:
+            client = self._clients.get(region)
+            if not client:
+                self._clients[region] = self.__get_session(region).client('ec2')
+                client = self._clients[region]
+        return client
+
     def validate_ami_name(self, name, clean=False):
         allowed = ['(', ')', '[', ']', ' ', '.', '/', '-', '\'', '@', '_']
 
@@ -40,9 +232,7 @@ class ShipAMI(object):
         return name
 
     def list(self, include_executable_images=False):
-        result = []
-        copied_keys = ['ImageId', 'Name', 'State', 'CreationDate', 'OwnerId']
-        ec2 = self.__get_session().client('ec2')
+        ec2 = self.__get_client()
 
         try:
             r_owned = ec2.describe_images(
@@ -64,344 +254,1258 @@ class ShipAMI(object):
         images = r_owned.get('Images', [])
         if include_executable_images:
             images += r_executable.get('Images', [])
-        for image in images:
-            i = {}
-            for key in copied_keys:
-                i[key] = image.get(key)
 
-            i['Managed'] = self.__is_managed(image)
-            i['Release'] = self.__get_tag(image, 'shipami:release')
-            i['CopiedFrom'] = self.__get_tag(image, 'shipami:copied_from')
-            i['CopiedTo'] = self.__get_tag(image, 'shipami:copied_to')
+        return [ImageRecord(image, self._region, keep_raw=False) for image in images]
 
-            result.append(i)
+    def for_account(self, account):
+        if credentials.is_role_arn(account):
+            return ShipAMI(self._profile, self._region, role_arn=account, session_factory=self._session_factory, clock=self._clock)
+        return ShipAMI(account, self._region, session_factory=self._session_factory, clock=self._clock)
 
-        return result
+    def list_accounts(self, accounts, include_executable_images=False):
+        def scan(account):
+            try:
+                records = self.for_account(account).list(include_executable_images)
+            except RuntimeError as e:
+                raise RuntimeError('{}: {}'.format(account, e))
+            for record in records:
+                record.account = credentials.account_label(account)
+            return records
+
+        with ThreadPoolExecutor(max_workers=len(accounts) or 1) as executor:
+            results = list(executor.map(scan, accounts))
+        return [record for records in results for record in records]
 
     def show(self, image_ids):
+        records = dict((_.id, _) for _ in self.__describe_images(image_ids, owners=['self']))
         result_images = []
         for image_id in image_ids:
-            ec2 = self.__get_session().client('ec2')
-            image = self.__get_session().resource('ec2').Image(image_id)
-
-            try:
-                r = ec2.describe_images(
-                    Owners=[
-                        'self'
-                    ],
-                    ImageIds=[
-                        image.id
-                    ]
-                )
-            except botocore.exceptions.ClientError as e:
-                message = e.response['Error']['Message']
-                logger.error(message)
-                raise RuntimeError(message)
-
-            try:
-                result_image = r.get('Images', [])[0]
-            except IndexError:
+            result_image = records.get(image_id)
+            if result_image is None:
                 message = 'Something went wrong'
                 logger.error(message)
                 raise RuntimeError(message)
 
-            result_image['Shares'] = self.__get_image_permissions(image)
-            for share in result_image['Shares']:
+            result_image.shares = self.__get_image_permissions(result_image)
+            for share in result_image.shares:
                 if share.get('UserId') == self.MARKETPLACE_ACCOUNT_ID:
-                    share['Marketplace'] = self.__is_ami_shared(image)
+                    share['Marketplace'] = self.__is_ami_shared(result_image, permissions=result_image.shares)
 
             result_images.append(result_image)
 
         return result_images
 
     def copy(self, image_id, **kwargs):
-        src_image = self.__get_session(kwargs.pop('source_region')).resource('ec2').Image(image_id)
-        dst_image = self.__copy_image(src_image, **kwargs)
-        return dst_image.id
+        if kwargs.pop('preflight', False):
+            self.preflight([(kwargs.get('source_region'), image_id, kwargs.get('region'))], name=kwargs.get('name'), incremental=kwargs.get('incremental', False))
+        source_region = kwargs.pop('source_region', None)
+        src_image = self.__get_image(image_id, source_region)
+        if kwargs.pop('auto_source', False):
+            replica = self.nearest_replica(image_id, kwargs.get('region'), source_region)
+            if replica is not None and replica.id != image_id:
+                kwargs['via'] = replica
+        with tracing.span('copy', source_image_id=image_id, region=kwargs.get('region') or self._region) as span:
+            dst_image_id = self.__copy_image(src_image, **kwargs)
+            span.set('image_id', dst_image_id)
+        return dst_image_id
+
+    def copy_images(self, image_ids, max_in_flight=None, **kwargs):
+        if kwargs.pop('preflight', False):
+            copies = [(kwargs.get('source_region'), _, kwargs.get('region')) for _ in image_ids]
+            self.preflight(copies, name=kwargs.get('name'), incremental=kwargs.get('incremental', False))
+        scheduler = CopyScheduler(self, max_in_flight=max_in_flight, cancel=self._cancel, clock=self._clock)
+        return [scheduler.submit(image_id, **kwargs) for image_id in image_ids]
+
+    def release(self, image_id, release, in_place=False, fsr_zones=None, **kwargs):
+        """Copies image_id, or promotes it with in_place, as release
+
+        fsr_zones enables Fast Snapshot Restores on the release snapshots in
+        the zones of its region, which requires the copy to be available.
+        """
+        region = kwargs.get('region') or self._region
+        fsr_zones = [_ for _ in fsr_zones or [] if aws_regions.zone_region(_) == region]
+        wait = kwargs.get('wait', False)
+
+        if in_place:
+            if kwargs.get('source_region') not in (None, region):
+                raise RuntimeError('an image can only be released in place in its own region')
+            image_id = self.promote(image_id, release, name=kwargs.get('name'), region=region)
+        else:
+            if fsr_zones:
+                kwargs['wait'] = True
+            with tracing.span('release', source_image_id=image_id, release=release):
+                image_id = self.copy(image_id, **kwargs)
+                self.__set_tags(region, [image_id], {'shipami:release': release})
+
+        if fsr_zones:
+            self.fast_snapshot_restores(self.__describe_images([image_id], region=region), fsr_zones, wait=wait, timeout=kwargs.get('timeout'))
+        return image_id
+
+    def promote(self, image_id, release, name=None, region=None):
+        """Marks an available managed image as a release without copying it
+
+        AMI names cannot change, name is recorded in the shipami:name tag.
+        """
+        region = region or self._region
+        with tracing.span('promote', region=region, image_id=image_id, release=release):
+            record = self.__get_image(image_id, region)
+
+            if not record.managed:
+                raise RuntimeError('{} is not managed by shipami, copy it before releasing it'.format(image_id))
+            if record.state != 'available':
+                raise RuntimeError('{} is {}, only available images can be released'.format(image_id, record.state))
+            if record.release and record.release != release:
+                raise RuntimeError('{} is already release {}'.format(image_id, record.release))
+
+            tags = {'shipami:release': release}
+            if name:
+                tags['shipami:name'] = self.validate_ami_name(name, clean=True)
+            self.tag([record], add=tags)
+        return image_id
+
+    def progress(self, image_id, region=None):
+        """Returns (state, percent) of an image, state is None while it cannot be found"""
+        state, progress = self.__image_progress(image_id, region)
+        return state, progress or 0
+
+    def record_copy(self, image_id, source_region=None, region=None, seconds=0, incremental=False, size=None):
+        """Adds a completed copy of image_id to the local copy history
+
+        image_id is only described when its size is not given.
+        """
+        source_region = source_region or self._region
+        try:
+            if size is None:
+                images = self.__describe_images([image_id], region=source_region)
+                size = images[0].size if images else None
+            if size:
+                return history.record(source_region, region or self._region, size, seconds, incremental)
+        except Exception as e:
+            # the history only feeds estimates, botocore errors other than ClientError included
+            logger.debug('could not record copy of {}: {}'.format(image_id, e))
+
+    def estimate(self, image_id, region=None, source_region=None, incremental=False):
+        """Returns the expected seconds to copy image_id to region, None without history"""
+        entries = history.load()
+        if not entries:
+            return None
+        images = self.__describe_images([image_id], region=source_region or self._region)
+        if not images:
+            return None
+        return history.estimate(source_region or self._region, region or self._region, images[0].size, incremental, entries=entries)
+
+    def eta(self, image_id, region=None):
+        """Returns (state, progress, remaining seconds) of a copy
+
+        While progress is low the remaining time comes from the copy history,
+        it then shifts to an extrapolation of the progress made so far.
+        remaining is None when neither is known.
+        """
+        region = region or self._region
+        images = self.__describe_images([image_id], region=region)
+        if not images:
+            message = 'The image id \'[{}]\' does not exist'.format(image_id)
+            logger.error(message)
+            raise RuntimeError(message)
+        record = images[0]
+
+        state, progress = self.__image_progress(image_id, region)
+        state = state or 'pending'
+        progress = progress or 0
+        if state == 'available':
+            return state, 100, 0
+        if state != 'pending':
+            return state, progress, None
+
+        elapsed = max(0, self._clock.time() - calendar.timegm(dateutil.parser.parse(record.creation_date).utctimetuple()))
+        expected = None
+        if record.copied_from and record.size:
+            expected = history.estimate(record.copied_from[0].split(':')[0], region, record.size)
+        if progress and progress < 100:
+            extrapolated = elapsed * (100 - progress) / float(progress)
+            if expected is None:
+                return state, progress, extrapolated
+            weight = progress / 100.0
+            return state, progress, weight * extrapolated + (1 - weight) * max(0, expected - elapsed)
+        if expected is not None:
+            return state, progress, max(0, expected - elapsed)
+        return state, progress, None
+
+    def find_images(self, image_ids=None, regions=None):
+        """Returns owned images of each region, optionally restricted to image_ids"""
+        filters = [{'Name': 'image-id', 'Values': list(image_ids)}] if image_ids else []
+        regions = self.__unique(regions or [self._region])
+        with ThreadPoolExecutor(max_workers=len(regions)) as executor:
+            results = executor.map(lambda _: self.__find_images(_, filters, keep_raw=True), regions)
+        return [image for images in results for image in images]
+
+    def tag(self, images, add=None, remove=None, snapshots=False):
+        """Adds and removes tags on images, and their snapshots, with as few calls as possible
+
+        add is a dict of tags to set, remove a list of keys to delete.
+        """
+        add = add or {}
+        remove = remove or []
+        by_region = {}
+        for image in images:
+            resources = by_region.setdefault(image.region or self._region, [])
+            resources.append(image.id)
+            if snapshots:
+                resources.extend(image.snapshot_ids)
+
+        def tag_region(region):
+            ec2 = self.__get_client(region)
+            resources = self.__unique(by_region[region])
+            with tracing.span('tag', region=region, resources=len(resources)):
+                try:
+                    for i in range(0, len(resources), self.MAX_TAG_RESOURCES):
+                        chunk = resources[i:i + self.MAX_TAG_RESOURCES]
+                        if add:
+                            logger.debug('tagging {} resources in {}'.format(len(chunk), region))
+                            ec2.create_tags(Resources=chunk, Tags=[{'Key': k, 'Value': v} for k, v in sorted(add.items())])
+                        if remove:
+                            logger.debug('untagging {} resources in {}'.format(len(chunk), region))
+                            ec2.delete_tags(Resources=chunk, Tags=[{'Key': k} for k in remove])
+                except botocore.exceptions.ClientError as e:
+                    message = e.response['Error']['Message']
+                    logger.error(message)
+                    raise RuntimeError('{}: {}'.format(region, message))
+
+        if by_region and (add or remove):
+            with ThreadPoolExecutor(max_workers=len(by_region)) as executor:
+                list(executor.map(tag_region, by_region))
+        return [(_.region or self._region, _.id) for _ in images]
+
+    def launch_permissions(self, images):
+        """Returns the account ids allowed to launch each image, keyed by image id"""
+        by_region = {}
+        for image in images:
+            by_region.setdefault(image.region or self._region, []).append(image.id)
+
+        def describe(region):
+            ec2 = self.__get_client(region)
+            permissions = {}
+            try:
+                for image_id in by_region[region]:
+                    r = ec2.describe_image_attribute(ImageId=image_id, Attribute='launchPermission')
+                    permissions[image_id] = [_.get('UserId') or _.get('Group') for _ in r.get('LaunchPermissions', [])]
+            except botocore.exceptions.ClientError as e:
+                message = e.response['Error']['Message']
+                logger.error(message)
+                raise RuntimeError('{}: {}'.format(region, message))
+            return permissions
+
+        result = {}
+        if by_region:
+            with ThreadPoolExecutor(max_workers=len(by_region)) as executor:
+                for permissions in executor.map(describe, list(by_region)):
+                    result.update(permissions)
+        return result
+
+    def verify_shares(self, images):
+        """Reconciles the shipami:shares tag of images with their actual permissions
+
+        Permissions are read per region at the same time, snapshots only for
+        images shared with AWS Marketplace, and wrong tags are rewritten with
+        one call per region and value. Returns (image, recorded, actual) for
+        each corrected image, images get their new tag.
+        """
+        permissions = self.launch_permissions(images)
+        users = dict((image_id, [_ for _ in values if _]) for image_id, values in permissions.items())
+
+        # snapshot ids are needed to check marketplace readiness
+        marketplace_users = set([self.MARKETPLACE_ACCOUNT_ID, 'aws-marketplace'])
+        missing = {}
+        for image in images:
+            if marketplace_users & set(users[image.id]) and image.raw is None:
+                missing.setdefault(image.region or self._region, []).append(image.id)
+        described = {}
+        for region, image_ids in missing.items():
+            described.update((_.id, _) for _ in self.__describe_images(image_ids, region=region))
+
+        corrected = []
+        by_value = {}
+        for image in images:
+            value = self.__shares_value(described.get(image.id, image), users[image.id])
+            recorded = image.tags.get(SHARES_TAG)
+            if recorded != value:
+                corrected.append((image, recorded, value))
+                by_value.setdefault(value, []).append(image)
+                image.tags[SHARES_TAG] = value
+        for value, tagged in by_value.items():
+            self.tag(tagged, add={SHARES_TAG: value})
+        return corrected
+
+    def find_release(self, release, regions):
+        """Returns available or pending images of release in each region"""
+        filters = [
+            {'Name': 'tag:shipami:release', 'Values': [release]},
+            {'Name': 'state', 'Values': ['available', 'pending']}
+        ]
+        regions = self.__unique(regions)
+        with ThreadPoolExecutor(max_workers=len(regions) or 1) as executor:
+            results = executor.map(lambda _: self.__find_images(_, filters, keep_raw=True), regions)
+        return dict(zip(regions, results))
+
+    def fast_snapshot_restores(self, images, zones, enable=True, wait=False, timeout=None):
+        """Enables, or disables, Fast Snapshot Restores on the snapshots of images
+
+        Each image is handled in the zones of its own region, regions at the
+        same time with one call per MAX_FSR_SNAPSHOTS snapshots. Zones are
+        recorded in the shipami:fsr tag of the images so that delete turns
+        FSR off. Returns (region, image_id, zones) for each image.
+        """
+        deadline = waiting.deadline(timeout, self._clock)
+        by_region = {}
+        for image in images:
+            by_region.setdefault(image.region or self._region, []).append(image)
+        zones_by_region = dict((region, sorted(set(_ for _ in zones if aws_regions.zone_region(_) == region))) for region in by_region)
+        missing = sorted(_ for _ in by_region if not zones_by_region[_])
+        if missing:
+            message = 'no availability zone given in {}'.format(', '.join(missing))
+            logger.error(message)
+            raise RuntimeError(message)
 
-    def release(self, image_id, release, **kwargs):
-        image = self.__get_session().resource('ec2').Image(self.copy(image_id, **kwargs))
-        self.__set_tag(image, 'shipami:release', release)
-        return image.id
+        def apply(region):
+            region_images = by_region[region]
+            region_zones = zones_by_region[region]
+            snapshot_ids = self.__unique([_ for image in region_images for _ in image.snapshot_ids])
+            with tracing.span('fsr', region=region, snapshots=len(snapshot_ids), enable=enable):
+                failed, errors = self.__set_fast_snapshot_restores(region, snapshot_ids, region_zones, enable)
+                recorded = {}
+                for image in region_images:
+                    # a zone is only recorded, or forgotten, once it changed for every snapshot of the image
+                    changed = set(zone for zone in region_zones if not [_ for _ in image.snapshot_ids if (_, zone) in failed])
+                    current = set(_ for _ in image.tags.get(FSR_TAG, '').split(',') if _)
+                    value = ','.join(sorted(current | changed if enable else current - changed))
+                    if value != image.tags.get(FSR_TAG, ''):
+                        recorded.setdefault(value, []).append(image)
+                for value, tagged in recorded.items():
+                    if value:
+                        self.tag(tagged, add={FSR_TAG: value})
+                    else:
+                        self.tag(tagged, remove=[FSR_TAG])
+                if wait and not errors:
+                    self.__wait_for_fast_snapshot_restores(region, snapshot_ids, region_zones, 'enabled' if enable else 'disabled', deadline)
+            return errors
+
+        errors = []
+        if by_region:
+            with ThreadPoolExecutor(max_workers=len(by_region)) as executor:
+                for region_errors in executor.map(apply, list(by_region)):
+                    errors.extend(region_errors)
+        if errors:
+            message = '\n'.join(errors)
+            logger.error(message)
+            raise RuntimeError(message)
+        return [(_.region or self._region, _.id, zones_by_region[_.region or self._region]) for _ in images]
+
+    def sync(self, release, regions, source_region=None, preflight=True, **kwargs):
+        """Makes sure release exists in every region, copying from the closest copy
+
+        Returns (region, image_id, copied, error) for each region, a region
+        whose copy failed has no image_id and the error message.
+        """
+        regions = self.__unique(regions)
+        found = self.find_release(release, regions + [source_region or self._region])
+        missing = [_ for _ in regions if not found.get(_)]
+
+        sources = [image for images in found.values() for image in images if image.state == 'available']
+        if missing and not sources:
+            message = 'no available image for release {} in {}'.format(release, ', '.join(sorted(found)))
+            logger.error(message)
+            raise RuntimeError(message)
+
+        entries = history.load()
+        plan = dict((_, min(sources, key=lambda source: self.__source_rank(source.region, _, entries))) for _ in missing)
+        if missing and preflight:
+            self.preflight([(plan[_].region, plan[_].id, _) for _ in missing], name=kwargs.get('name'), incremental=kwargs.get('incremental', False))
+
+        def copy(region):
+            source = plan[region]
+            logger.debug('copying release {} to {} from {}:{}'.format(release, region, source.region, source.id))
+            try:
+                return self.release(source.id, release, source_region=source.region, region=region, **kwargs), None
+            except RuntimeError as e:
+                return None, str(e)
+
+        copied = {}
+        if missing:
+            with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+                futures = [executor.submit(copy, _) for _ in missing]
+                copied = dict((region, self.uninterrupted(future.result)) for region, future in zip(missing, futures))
 
-    def share(self, image_id, account_id=None, create_volume=False, remove=False):
-        image = self.__get_session().resource('ec2').Image(image_id)
+        result = []
+        for region in regions:
+            if region in copied:
+                image_id, error = copied[region]
+                result.append((region, image_id, error is None, error))
+            else:
+                result.append((region, found[region][0].id, False, None))
+        return result
+
+    def preflight(self, copies, name=None, incremental=False):
+        """Checks that copies, a list of (source_region, image_id, region), can all start
+
+        Sources and destinations are checked region by region at the same
+        time: sources must be available with completed snapshots and usable
+        KMS keys, destinations must not already have an image of the same
+        name nor too many copies in progress, and their default EBS key must
+        be usable when a copy is encrypted. Every problem found is reported
+        at once with PreflightError.
+        """
+        copies = [(s or self._region, image_id, r or self._region) for s, image_id, r in copies]
+        sources = {}
+        for source_region, image_id, region in copies:
+            sources.setdefault(source_region, []).append(image_id)
+
+        with tracing.span('preflight', copies=len(copies)):
+            with ThreadPoolExecutor(max_workers=len(sources)) as executor:
+                checked = list(executor.map(lambda _: self.__preflight_sources(_, self.__unique(sources[_]), incremental), list(sources)))
+            images = dict((k, v) for images, problems in checked for k, v in images.items())
+            problems = [problem for images, problems in checked for problem in problems]
+
+            names = {}
+            encrypted = set()
+            for source_region, image_id, region in copies:
+                image = images.get((source_region, image_id))
+                if image is None:
+                    continue
+                if [_ for _ in image.raw.get('BlockDeviceMappings', []) if _.get('Ebs', {}).get('Encrypted')]:
+                    encrypted.add(region)
+                try:
+                    image_name = self.validate_ami_name(name or image.name, clean=True)
+                except RuntimeError as e:
+                    problems.append('{}:{}: {}'.format(source_region, image_id, e))
+                    continue
+                if image_name in names.setdefault(region, []):
+                    problems.append('{}: several copies would be named "{}"'.format(region, image_name))
+                names[region].append(image_name)
+
+            regions = sorted(names)
+            if regions:
+                with ThreadPoolExecutor(max_workers=len(regions)) as executor:
+                    for region_problems in executor.map(lambda _: self.__preflight_destination(_, names[_], _ in encrypted), regions):
+                        problems.extend(region_problems)
+
+        if problems:
+            error = PreflightError(problems)
+            logger.error(str(error))
+            raise error
+
+    def __preflight_sources(self, region, image_ids, incremental=False):
+        ec2 = self.__get_client(region)
+        problems = []
+        try:
+            records = self.__find_images(region, [{'Name': 'image-id', 'Values': image_ids}], keep_raw=True)
+            images = dict(((region, _.id), _) for _ in records)
+            for image_id in image_ids:
+                if (region, image_id) not in images:
+                    problems.append('{}:{}: image does not exist'.format(region, image_id))
+
+            for image in records:
+                if image.state != 'available':
+                    problems.append('{}:{}: image is {}'.format(region, image.id, image.state))
+                problem = self.__incremental_problem(image) if incremental else None
+                if problem:
+                    problems.append('{}:{}: {}, it cannot be copied with --incremental'.format(region, image.id, problem))
+
+            snapshot_ids = [snapshot_id for image in records for snapshot_id in image.snapshot_ids]
+            snapshots = ec2.describe_snapshots(SnapshotIds=snapshot_ids).get('Snapshots', []) if snapshot_ids else []
+        except botocore.exceptions.ClientError as e:
+            return {}, ['{}: {}'.format(region, e.response['Error']['Message'])]
+
+        keys = set()
+        for snapshot in snapshots:
+            if snapshot.get('State') != 'completed':
+                problems.append('{}:{}: snapshot is {}'.format(region, snapshot['SnapshotId'], snapshot.get('State')))
+            if snapshot.get('Encrypted') and snapshot.get('KmsKeyId'):
+                keys.add(snapshot['KmsKeyId'])
+        for key_id in sorted(keys):
+            problem = self.__preflight_kms_key(region, key_id)
+            if problem:
+                problems.append(problem)
+        return images, problems
+
+    def __preflight_kms_key(self, region, key_id):
+        with self._lock:
+            kms = self.__get_session(region).client('kms')
+        try:
+            key = kms.describe_key(KeyId=key_id)['KeyMetadata']
+        except botocore.exceptions.ClientError as e:
+            return '{}: KMS key {} cannot be used: {}'.format(region, key_id, e.response['Error']['Message'])
+        if key.get('KeyState') != 'Enabled':
+            return '{}: KMS key {} is {}'.format(region, key_id, key.get('KeyState'))
+        return None
+
+    def __preflight_destination(self, region, names, encrypted=False):
+        ec2 = self.__get_client(region)
+        problems = []
+        try:
+            conflicts = ec2.describe_images(Owners=['self'], Filters=[{'Name': 'name', 'Values': names}]).get('Images', [])
+            # images being created from instances do not count against the copy limit
+            pending = ec2.describe_images(Owners=['self'], Filters=[
+                {'Name': 'state', 'Values': ['pending']},
+                {'Name': 'tag-key', 'Values': ['shipami:copied_from']}
+            ]).get('Images', [])
+            # encrypted snapshots are copied with the default EBS key of the destination
+            key_id = ec2.get_ebs_default_kms_key_id()['KmsKeyId'] if encrypted else None
+        except botocore.exceptions.ClientError as e:
+            return ['{}: {}'.format(region, e.response['Error']['Message'])]
+
+        for image in conflicts:
+            problems.append('{}: an image named "{}" already exists ({})'.format(region, image.get('Name'), image.get('ImageId')))
+        if len(pending) + len(names) > self.MAX_CONCURRENT_COPIES:
+            problems.append('{}: {} copies in progress, {} more would exceed the limit of {}'.format(region, len(pending), len(names), self.MAX_CONCURRENT_COPIES))
+        if key_id:
+            problem = self.__preflight_kms_key(region, key_id)
+            if problem:
+                problems.append(problem)
+        return problems
+
+    def share(self, image_id, account_id=None, create_volume=False, remove=False, timeout=None):
+        deadline = waiting.deadline(timeout, self._clock)
         account_id = account_id or self.MARKETPLACE_ACCOUNT_ID
         operation = 'add' if not remove else 'remove'
         operation_log = 'adding' if not remove else 'removing'
 
-        logger.debug('{} permissions for {} on image {}'.format(operation_log, account_id, image.id))
-        self.__wait_for_image(image)
-        self.__share_modify_attribute(image, 'launchPermission', operation, account_id)
-        if create_volume:
-            for snapshot in self.__get_image_snapshots(image):
-                logger.debug('{} permissions for {} on snapshot {}'.format(operation_log, account_id, snapshot.id))
-                self.__wait_for_snapshot(snapshot)
-                self.__share_modify_attribute(snapshot, 'createVolumePermission', operation, account_id)
-
-    def delete(self, image_ids, force=False):
-        ec2 = self.__get_session().resource('ec2')
+        with tracing.span('share', region=self._region, image_id=image_id, account_id=account_id, operation=operation):
+            logger.debug('{} permissions for {} on image {}'.format(operation_log, account_id, image_id))
+            # snapshots of an available image are completed
+            image = self.__available(self.__get_image(image_id), deadline=deadline)
+            self.__modify_permission(image.region, image.id, 'launchPermission', operation, account_id)
+            if create_volume:
+                for snapshot_id in image.snapshot_ids:
+                    logger.debug('{} permissions for {} on snapshot {}'.format(operation_log, account_id, snapshot_id))
+                    self.__modify_permission(image.region, snapshot_id, 'createVolumePermission', operation, account_id)
+            self.__record_shares(image)
+
+    def replicate(self, image_id, accounts, regions=None, role_name=None, name=None, description=None, timeout=None, rollback=False, keep_shares=False):
+        """Copies image_id into the regions of other accounts
+
+        accounts are account ids, whose role_name is assumed, or role ARNs.
+        The image and its snapshots are shared with every account with one
+        call per resource, then the copies are scheduled from each account
+        with copy_images, which retries them on copy limit errors. Shares
+        added here are revoked once the copies are done, unless keep_shares.
+        Returns (account_id, region, image_id, error) for each copy,
+        image_id is None when it failed.
+        """
+        regions = self.__unique(regions or [self._region])
+        role_name = role_name or self.REPLICATE_ROLE_NAME
+        targets = []
+        for account in self.__unique(accounts):
+            if credentials.is_role_arn(account):
+                targets.append((credentials.account_label(account), account))
+            elif account.isdigit() and len(account) == 12:
+                targets.append((account, 'arn:aws:iam::{}:role/{}'.format(account, role_name)))
+            else:
+                raise RuntimeError('{} is neither an account id nor a role ARN'.format(account))
+        account_ids = [_[0] for _ in targets]
+
+        deadline = waiting.deadline(timeout, self._clock)
+        image = self.__available(self.__get_image(image_id), deadline=deadline)
+        with tracing.span('replicate', region=image.region, image_id=image.id, accounts=len(targets), regions=len(regions)):
+            added = self.__add_shares(image, account_ids)
+            try:
+                sessions = dict((account_id, self.for_account(role_arn)) for account_id, role_arn in targets)
+                for session in sessions.values():
+                    session._cancel = self._cancel
+
+                handles = []
+                for account_id in account_ids:
+                    for region in regions:
+                        # tags of the source belong to this account, the target can neither read nor write them
+                        handles.extend((account_id, region, _) for _ in sessions[account_id].copy_images(
+                            [image.id], source_region=image.region, region=region, name=name,
+                            description=description, copy_tags=False, tag_source=False,
+                            timeout=timeout, rollback=rollback
+                        ))
+                results = []
+                for account_id, region, handle in handles:
+                    error = self.uninterrupted(handle.exception)
+                    if error is not None:
+                        results.append((account_id, region, None, str(error)))
+                    else:
+                        results.append((account_id, region, handle.image_id, None))
+            finally:
+                if not keep_shares:
+                    self.__revoke_shares(image, added)
+        return results
+
+    def rollback(self, image_id, region=None):
+        """Deregisters an unfinished copy, deletes its snapshots and drops it from its source lineage
+
+        Snapshots that cannot be deleted yet are retried for ROLLBACK_TIMEOUT
+        seconds, the RuntimeError raised after that names the ones left behind.
+        """
+        region = region or self._region
+        ec2 = self.__get_client(region)
+
+        with tracing.span('rollback', region=region, image_id=image_id):
+            images = self.__describe_images([image_id], region=region)
+            if not images:
+                return
+            record = images[0]
+            try:
+                logger.warning('rolling back {}, deregistering it'.format(image_id))
+                ec2.deregister_image(ImageId=image_id)
+                # a pending copy does not list all its snapshots yet, copy_image names them after the image
+                snapshots = ec2.describe_snapshots(
+                    OwnerIds=['self'],
+                    Filters=[{'Name': 'description', 'Values': ['Copied for DestinationAmi {} *'.format(image_id)]}]
+                ).get('Snapshots', [])
+            except botocore.exceptions.ClientError as e:
+                message = 'rollback of {} failed: {}'.format(image_id, e.response['Error']['Message'])
+                logger.error(message)
+                raise RuntimeError(message)
+            snapshot_ids = list(record.snapshot_ids)
+            snapshot_ids.extend(_['SnapshotId'] for _ in snapshots if _['SnapshotId'] not in snapshot_ids)
+            remaining = self.__delete_snapshots(region, snapshot_ids, 'snapshots of {}'.format(image_id))
+            if record.managed and record.copied_from:
+                self.__remove_copied_to(record.copied_from[0], '{}:{}'.format(region, image_id))
+            if remaining:
+                message = 'rollback of {} is incomplete, delete {} by hand'.format(image_id, ', '.join(remaining))
+                logger.error(message)
+                raise RuntimeError(message)
+
+    def delete(self, image_ids, force=False, cascade=False):
+        if cascade:
+            return self.delete_lineage(self.descendants(image_ids), force)
+
+        records = dict((_.id, _) for _ in self.__describe_images(image_ids))
         deleted = []
 
         for image_id in image_ids:
-            image = ec2.Image(image_id)
+            record = records.get(image_id)
+            if record is None:
+                message = 'The image id \'[{}]\' does not exist'.format(image_id)
+                logger.error(message)
+                raise RuntimeError(message)
+
+            if (not record.managed or record.release) and (not force):
+                message = '{} is either a release or not managed by shipami, you must use -f to delete this image'.format(record.id)
+                raise RuntimeError(message)
+
+            # snapshots of a pending copy are only all known once it is available
+            if record.state == 'pending':
+                record = self.__wait_for_image(record.id, record.region)
+            self.__delete_record(record)
+
+            if record.managed and record.copied_from:
+                to_remove = '{}:{}'.format(record.region, record.id)
+                with tracing.span('remove_lineage', image_id=record.copied_from[0], copied_to=to_remove):
+                    self.__remove_copied_to(record.copied_from[0], to_remove)
+
+            deleted.append(image_id)
+        return deleted
+
+    def replicas(self, image_id, source_region=None):
+        """Returns every available copy of image_id, itself included, across regions
+
+        Lineage is followed up shipami:copied_from to the first image, then
+        down shipami:copied_to from there.
+        """
+        root = self.__get_image(image_id, source_region)
+        seen = set([(root.region, root.id)])
+        while root.managed and root.copied_from:
+            parent_region, parent_id = root.copied_from[0].split(':')
+            if (parent_region, parent_id) in seen:
+                break
+            seen.add((parent_region, parent_id))
+            parents = self.__find_images(parent_region, [{'Name': 'image-id', 'Values': [parent_id]}], keep_raw=True)
+            if not parents:
+                break
+            root = parents[0]
+
+        levels = self.descendants([root.id], region=root.region)
+        return [image for level in levels for image in level if image.state == 'available']
+
+    def nearest_replica(self, image_id, region=None, source_region=None):
+        """Returns the available copy of image_id expected to copy the fastest to region"""
+        region = region or self._region
+        entries = history.load()
+        replicas = self.replicas(image_id, source_region)
+        if not replicas:
+            return None
+        replica = min(replicas, key=lambda _: self.__source_rank(_.region, region, entries))
+        logger.debug('copying {} to {} from {}:{}'.format(image_id, region, replica.region, replica.id))
+        return replica
+
+    def __source_rank(self, source_region, region, entries=None):
+        """Sorts sources: same region, then known speed, then distance"""
+        if source_region == region:
+            return (0, 0)
+        speed = history.seconds_per_gib(source_region, region, entries)
+        if speed is not None:
+            return (1, speed)
+        return (2, aws_regions.distance(source_region, region))
+
+    def descendants(self, image_ids, region=None):
+        """Returns images and every copy made from them, following shipami:copied_to
+
+        The result is a list of levels: the images themselves, their copies,
+        the copies of these copies and so on.
+        """
+        roots = self.__describe_images(image_ids, region=region)
+        missing = [_ for _ in image_ids if _ not in [record.id for record in roots]]
+        if missing:
+            message = 'The image id \'[{}]\' does not exist'.format(', '.join(missing))
+            logger.error(message)
+            raise RuntimeError(message)
 
-            managed = self.__is_managed(image)
-            release = self.__is_release(image)
+        levels = []
+        seen = set((_.region, _.id) for _ in roots)
+        level = roots
+        while level:
+            levels.append(level)
+            wanted = {}
+            for record in level:
+                for copied_to in record.copied_to:
+                    region, image_id = copied_to.split(':')
+                    if (region, image_id) not in seen:
+                        seen.add((region, image_id))
+                        wanted.setdefault(region, []).append(image_id)
+            if not wanted:
+                break
+            # copies deleted without shipami are simply not found
+            regions = sorted(wanted)
+            with ThreadPoolExecutor(max_workers=len(regions)) as executor:
+                results = executor.map(lambda _: self.__find_images(_, [{'Name': 'image-id', 'Values': wanted[_]}], keep_raw=True), regions)
+            level = [image for images in results for image in images]
+        return levels
+
+    def delete_lineage(self, levels, force=False):
+        """Deletes levels returned by descendants(), deepest copies first
+
+        Each level is deleted in every region at the same time, with a pool
+        of DELETE_WORKERS per region. Pending copies are waited for. When an
+        image of a level cannot be deleted the shallower levels are kept and
+        the RuntimeError lists what was deleted.
+        """
+        records = [record for level in levels for record in level]
+        if not force:
+            for record in records:
+                if not record.managed or record.release:
+                    message = '{} is either a release or not managed by shipami, you must use -f to delete this image'.format(record.id)
+                    raise RuntimeError(message)
+
+        def delete_one(record):
+            # snapshots of a pending copy are only all known once it is available
+            if record.state == 'pending':
+                record = self.__wait_for_image(record.id, record.region)
+            return self.__delete_record(record)
+
+        def delete_region(level_records):
+            with ThreadPoolExecutor(max_workers=self.DELETE_WORKERS) as pool:
+                futures = [(_, pool.submit(delete_one, _)) for _ in level_records]
+            results = []
+            for record, future in futures:
+                try:
+                    results.append((future.result(), None))
+                except Exception as e:
+                    results.append((None, '{}: {}'.format(record.id, e)))
+            return results
 
-            if (not managed or release) and (not force):
-                message = '{} is either a release or not managed by shipami, you must use -f to delete this image'.format(image.id)
+        deleted = []
+        for level in reversed(levels):
+            by_region = {}
+            for record in level:
+                by_region.setdefault(record.region, []).append(record)
+            errors = []
+            with ThreadPoolExecutor(max_workers=len(by_region) or 1) as executor:
+                for results in executor.map(delete_region, by_region.values()):
+                    deleted.extend(image_id for image_id, error in results if error is None)
+                    errors.extend(error for _, error in results if error is not None)
+            # the images copied from the failed ones are gone, their sources are kept
+            if errors:
+                message = 'delete stopped, {} failed; deleted {}'.format('; '.join(errors), ', '.join(deleted) or 'nothing')
+                logger.error(message)
                 raise RuntimeError(message)
 
-            copied_from = None
-            if managed:
-                copied_from = self.__get_tag(image, 'shipami:copied_from')
-                if copied_from:
-                    from_image = self.__get_copied_from_image(copied_from)
-                    remove_copied_to = self.__generate_copy_tag(image)
+        planned = set('{}:{}'.format(_.region, _.id) for _ in records)
+        for record in levels[0] if levels else []:
+            if record.managed and record.copied_from and record.copied_from[0] not in planned:
+                to_remove = '{}:{}'.format(record.region, record.id)
+                with tracing.span('remove_lineage', image_id=record.copied_from[0], copied_to=to_remove):
+                    self.__remove_copied_to(record.copied_from[0], to_remove)
+        return deleted
 
+    def __delete_record(self, record):
+        ec2 = self.__get_client(record.region)
+        with tracing.span('delete', region=record.region, image_id=record.id):
+            self.__disable_recorded_fast_snapshot_restores(record)
             try:
-                snapshots = self.__get_image_snapshots(image)
-                logger.debug('deregistering {}'.format(image.id))
-                image.deregister()
-                for snapshot in snapshots:
-                    logger.debug('deleting {}'.format(snapshot.id))
-                    snapshot.delete()
+                with tracing.span('deregister_image', region=record.region, image_id=record.id):
+                    logger.debug('deregistering {} in {}'.format(record.id, record.region))
+                    ec2.deregister_image(ImageId=record.id)
+                for snapshot_id in record.snapshot_ids:
+                    with tracing.span('delete_snapshot', region=record.region, snapshot_id=snapshot_id):
+                        logger.debug('deleting {} in {}'.format(snapshot_id, record.region))
+                        ec2.delete_snapshot(SnapshotId=snapshot_id)
             except botocore.exceptions.ClientError as e:
                 message = e.response['Error']['Message']
                 logger.error(message)
-                raise RuntimeError(message)
+                raise RuntimeError('{}: {}'.format(record.region, message))
+        return record.id
 
-            if managed and copied_from:
-                self.__remove_copied_to(from_image, remove_copied_to)
+    def __delete_snapshots(self, region, snapshot_ids, description):
+        """Deletes snapshot_ids, retrying for ROLLBACK_TIMEOUT seconds, returns those left"""
+        ec2 = self.__get_client(region)
+        remaining = list(snapshot_ids)
 
-            deleted.append(image_id)
-        return deleted
+        def check():
+            for snapshot_id in list(remaining):
+                try:
+                    logger.debug('deleting {}'.format(snapshot_id))
+                    ec2.delete_snapshot(SnapshotId=snapshot_id)
+                except botocore.exceptions.ClientError as e:
+                    if e.response['Error'].get('Code') != 'InvalidSnapshot.NotFound':
+                        logger.debug('could not delete {} yet: {}'.format(snapshot_id, e.response['Error']['Message']))
+                        continue
+                remaining.remove(snapshot_id)
+            return not remaining, None
+
+        # try once even when cancelled, waiting is what a cancel skips
+        if not check()[0]:
+            try:
+                waiting.poll(check, description, deadline=waiting.deadline(self.ROLLBACK_TIMEOUT, self._clock), cancel=self._cancel, clock=self._clock)
+            except (WaitTimeout, WaitCancelled):
+                pass
+        return remaining
+
+    def __set_fast_snapshot_restores(self, region, snapshot_ids, zones, enable=True):
+        """Returns the (snapshot_id, zone) pairs which could not be changed and their error messages"""
+        ec2 = self.__get_client(region)
+        operation = ec2.enable_fast_snapshot_restores if enable else ec2.disable_fast_snapshot_restores
+        failed = set()
+        errors = []
+        for i in range(0, len(snapshot_ids), self.MAX_FSR_SNAPSHOTS):
+            chunk = snapshot_ids[i:i + self.MAX_FSR_SNAPSHOTS]
+            logger.debug('{} fast snapshot restores of {} snapshots in {}'.format('enabling' if enable else 'disabling', len(chunk), ', '.join(zones)))
+            try:
+                r = operation(AvailabilityZones=zones, SourceSnapshotIds=chunk)
+            except botocore.exceptions.ClientError as e:
+                failed.update((snapshot_id, zone) for snapshot_id in chunk for zone in zones)
+                errors.append('{}: {}'.format(region, e.response['Error']['Message']))
+                continue
+            for failure in r.get('Unsuccessful', []):
+                for error in failure.get('FastSnapshotRestoreStateErrors', []):
+                    failed.add((failure.get('SnapshotId'), error.get('AvailabilityZone')))
+                    errors.append('{}: {} in {}: {}'.format(region, failure.get('SnapshotId'), error.get('AvailabilityZone'), error.get('Error', {}).get('Message')))
+        return failed, errors
+
+    def __disable_recorded_fast_snapshot_restores(self, record):
+        # deleted snapshots stop FSR too, but disabling first stops the billing right away
+        zones = [_ for _ in record.tags.get(FSR_TAG, '').split(',') if _]
+        if not zones or not record.snapshot_ids:
+            return
+        for error in self.__set_fast_snapshot_restores(record.region or self._region, record.snapshot_ids, zones, enable=False)[1]:
+            logger.warning(error)
+
+    def __wait_for_fast_snapshot_restores(self, region, snapshot_ids, zones, state='enabled', deadline=None):
+        ec2 = self.__get_client(region)
+        pairs = [(snapshot_id, zone) for snapshot_id in snapshot_ids for zone in zones]
+        filters = [{'Name': 'snapshot-id', 'Values': snapshot_ids}, {'Name': 'availability-zone', 'Values': zones}]
+
+        def check():
+            states = {}
+            kwargs = {'Filters': filters}
+            while True:
+                try:
+                    r = ec2.describe_fast_snapshot_restores(**kwargs)
+                except botocore.exceptions.ClientError as e:
+                    message = e.response['Error']['Message']
+                    logger.error(message)
+                    raise RuntimeError('{}: {}'.format(region, message))
+                for restore in r.get('FastSnapshotRestores', []):
+                    states[(restore['SnapshotId'], restore['AvailabilityZone'])] = restore['State']
+                if not r.get('NextToken'):
+                    break
+                kwargs['NextToken'] = r['NextToken']
+            done = [_ for _ in pairs if states.get(_, 'disabled') == state]
+            return len(done) == len(pairs), 100 * len(done) // max(1, len(pairs))
+
+        waiting.poll(check, 'fast snapshot restores {} in {}'.format(state, ', '.join(zones)), deadline=deadline, cancel=self._cancel, clock=self._clock)
+
+    def __get_image(self, image_id, region=None):
+        images = self.__describe_images([image_id], region=region)
+        if not images:
+            message = 'The image id \'[{}]\' does not exist'.format(image_id)
+            logger.error(message)
+            raise RuntimeError(message)
+        return images[0]
+
+    def __describe_images(self, image_ids, owners=None, region=None, keep_raw=True):
+        kwargs = {'ImageIds': list(image_ids)}
+        if owners:
+            kwargs['Owners'] = owners
+        region = region or self._region
 
-    def __copy_image(self, src_image, name=None, description=None, copy_tags=True, copy_tags_to_snapshots=False, copy_permissions=False, wait=False):
         try:
-            name = name or src_image.name
-            name = self.validate_ami_name(name, clean=True)
-            description = description or src_image.description
-            src_region = src_image.meta.client.meta.region_name
+            r = self.__get_client(region).describe_images(**kwargs)
         except botocore.exceptions.ClientError as e:
             message = e.response['Error']['Message']
             logger.error(message)
             raise RuntimeError(message)
 
+        return [ImageRecord(image, region, keep_raw=keep_raw) for image in r.get('Images', [])]
+
+    def __find_images(self, region, filters, keep_raw=False):
         try:
-            logger.debug('copying image {} from {} to {}'.format(src_image.id, src_region, self._region))
-            r = self.__get_session().client('ec2').copy_image(
-                SourceRegion=src_region,
-                SourceImageId=src_image.id,
-                Name=name,
-                Description=description
-            )
+            r = self.__get_client(region).describe_images(Owners=['self'], Filters=filters)
         except botocore.exceptions.ClientError as e:
             message = e.response['Error']['Message']
             logger.error(message)
             raise RuntimeError(message)
 
-        dst_image = self.__get_session().resource('ec2').Image(r['ImageId'])
-        self.__append_tag(src_image, 'shipami:copied_to', '{}:{}'.format(self._region, dst_image.id))
-
-        if copy_tags:
-            self.__copy_tags(src_image, dst_image, copy_tags_to_snapshots)
-            # removes irrelevant 'copied_to' tag
-            # TODO: Find a way to filter tags properly when copying
-            self.__delete_tag(dst_image, 'shipami:copied_to')
+        images = [ImageRecord(image, region, keep_raw=keep_raw) for image in r.get('Images', [])]
+        return sorted(images, key=lambda _: _.creation_date, reverse=True)
 
-        self.__set_managed(dst_image)
-        self.__set_tag(dst_image, 'shipami:copied_from', '{}:{}'.format(src_region, src_image.id))
+    def __unique(self, values):
+        result = []
+        for value in values:
+            if value not in result:
+                result.append(value)
+        return result
 
-        if copy_permissions:
+    def __copy_image(self, src_image, region=None, name=None, description=None, copy_tags=True, copy_tags_to_snapshots=False, copy_permissions=False, wait=False, timeout=None, rollback=False, incremental=False, via=None, tag_source=True, record=True):
+        region = region or self._region
+        deadline = waiting.deadline(timeout, self._clock)
+        started = self._clock.time()
+        name = self.validate_ami_name(name or src_image.name, clean=True)
+        description = description or src_image.description
+        # via is a copy of src_image the data is actually copied from
+        copy_from = via or src_image
+
+        if incremental:
+            image_id = self.__copy_snapshots(copy_from, region, name, description, deadline)
+        else:
             try:
-                self.__wait_for_image(dst_image)
-                for permission in self.__get_image_permissions(src_image):
-                    account_id = permission.get('UserId')
-                    logger.debug('adding launchPermission permission for {} on image {}'.format(account_id, dst_image.id))
-                    self.__share_modify_attribute(dst_image, 'launchPermission', 'add', account_id)
-
-                src_block_devices = self.__get_image_block_devices(src_image)
-                for dst_block_device in self.__get_image_block_devices(dst_image):
-                    dst_snapshot = dst_block_device.get('Snapshot')
-                    self.__wait_for_snapshot(dst_snapshot)
-                    for src_block_device in src_block_devices:
-                        if src_block_device.get('DeviceName') == dst_block_device.get('DeviceName'):
-                            src_snapshot = src_block_device.get('Snapshot')
-                            logger.debug('found matching DeviceName for {} and {}'.format(src_snapshot.id, dst_snapshot.id))
-                            for permission in self.__get_snapshot_permissions(src_snapshot):
-                                account_id = permission.get('UserId')
-                                if account_id == 'aws-marketplace':
-                                    account_id = self.MARKETPLACE_ACCOUNT_ID
-                                logger.debug('adding createVolumePermission permission for {} on snapshot {}'.format(account_id, dst_snapshot.id))
-                                self.__share_modify_attribute(dst_snapshot, 'createVolumePermission', 'add', account_id)
+                with tracing.span('copy_image', source_region=copy_from.region, source_image_id=copy_from.id, region=region) as span:
+                    logger.debug('copying image {} from {} to {}'.format(copy_from.id, copy_from.region, region))
+                    r = self.__get_client(region).copy_image(
+                        SourceRegion=copy_from.region,
+                        SourceImageId=copy_from.id,
+                        Name=name,
+                        Description=description
+                    )
+                    span.set('image_id', r['ImageId'])
             except botocore.exceptions.ClientError as e:
-                message = e.response['Error']['Message']
-                logger.error(message)
-                raise RuntimeError(message)
+                self.__raise_copy_error(e)
+            image_id = r['ImageId']
+
+        copied_tags = self.__copied_tags(src_image) if copy_tags else {}
+        with tracing.span('tag', region=region, image_id=image_id):
+            if tag_source:
+                copied_to = '{}:{}'.format(region, image_id)
+                self.__set_tags(src_image.region, [src_image.id], {COPIED_TO_PREFIX + copied_to: copied_to})
+
+            tags = dict(copied_tags)
+            tags['shipami:managed'] = 'True'
+            tags['shipami:copied_from'] = '{}:{}'.format(src_image.region, src_image.id)
+            if via is not None:
+                tags['shipami:copied_via'] = '{}:{}'.format(via.region, via.id)
+            self.__set_tags(region, [image_id], tags)
 
-        if wait and not copy_permissions:
-            self.__wait_for_image(dst_image)
+        try:
+            dst_image = None
+            if copy_permissions:
+                dst_image = self.__copy_permissions(src_image, image_id, region, deadline)
+            elif wait or deadline:
+                dst_image = self.__wait_for_image(image_id, region, deadline=deadline)
+            if copy_tags_to_snapshots and copied_tags:
+                # snapshot ids are only all known once the copy is available
+                dst_image = dst_image or self.__wait_for_image(image_id, region, deadline=deadline)
+                logger.debug('copying tags to snapshots {}'.format(', '.join(dst_image.snapshot_ids)))
+                self.__set_tags(region, dst_image.snapshot_ids, copied_tags)
+        except (WaitTimeout, WaitCancelled) as e:
+            logger.error(str(e))
+            if rollback:
+                self.rollback(image_id, region)
+            raise
+
+        # the scheduler records the copies it runs itself
+        if record and (copy_permissions or wait or deadline):
+            self.record_copy(copy_from.id, copy_from.region, region, self._clock.time() - started, incremental, size=copy_from.size)
+
+        return image_id
+
+    def __raise_copy_error(self, e):
+        message = e.response['Error']['Message']
+        if e.response['Error'].get('Code') in self.COPY_LIMIT_ERRORS:
+            logger.debug(message)
+            raise CopyLimitExceeded(message)
+        logger.error(message)
+        raise RuntimeError(message)
+
+    def __copy_snapshots(self, src_image, region, name, description, deadline=None):
+        """Copies an image snapshot by snapshot then registers the copies
+
+        EC2 only transfers the blocks that changed when an earlier copy of
+        the same volume is present in the destination, which copy_image does
+        not do. When any step fails the snapshots copied so far are deleted.
+        """
+        image_id, src_region = src_image.id, src_image.region
+        src_ec2 = self.__get_client(src_region)
+        dst_ec2 = self.__get_client(region)
+
+        src = src_image.raw
+        problem = self.__incremental_problem(src_image)
+        if problem:
+            message = '{} {}, it can only be copied with copy_image'.format(image_id, problem)
+            logger.error(message)
+            raise RuntimeError(message)
 
-        return dst_image
+        try:
+            snapshots = src_ec2.describe_snapshots(SnapshotIds=src_image.snapshot_ids).get('Snapshots', []) if src_image.snapshot_ids else []
+        except botocore.exceptions.ClientError as e:
+            message = e.response['Error']['Message']
+            logger.error(message)
+            raise RuntimeError(message)
+        snapshots = dict((_['SnapshotId'], _) for _ in snapshots)
+        copies = []
+
+        def copy_snapshot(mapping):
+            if not mapping.get('Ebs', {}).get('SnapshotId'):
+                return mapping
+            snapshot = snapshots[mapping['Ebs']['SnapshotId']]
 
-    def __copy_tags(self, src_image, dst_image, copy_to_snapshots=False):
-        logger.debug('copying tags from image {} to image {}'.format(src_image.id, dst_image.id))
+            with tracing.span('copy_snapshot', source_region=src_region, source_snapshot_id=snapshot['SnapshotId'], region=region) as span:
+                logger.debug('copying snapshot {} from {} to {}'.format(snapshot['SnapshotId'], src_region, region))
+                try:
+                    r = dst_ec2.copy_snapshot(
+                        SourceRegion=src_region,
+                        SourceSnapshotId=snapshot['SnapshotId'],
+                        Description='Copied for {} from {}:{}'.format(name, src_region, snapshot['SnapshotId'])
+                    )
+                    copies.append(r['SnapshotId'])
+                    span.set('snapshot_id', r['SnapshotId'])
+
+                    lineage = [
+                        {'Key': 'shipami:managed', 'Value': 'True'},
+                        {'Key': 'shipami:copied_from', 'Value': '{}:{}'.format(src_region, snapshot['SnapshotId'])}
+                    ]
+                    dst_ec2.create_tags(Resources=[r['SnapshotId']], Tags=lineage)
+                except botocore.exceptions.ClientError as e:
+                    self.__raise_copy_error(e)
 
-        dst_image.create_tags(Tags=src_image.tags)
-        if copy_to_snapshots:
-            for snapshot in self.__get_image_snapshots(dst_image):
-                logger.debug('copying tags to snapshot {}'.format(snapshot.id))
-                snapshot.create_tags(Tags=src_image.tags)
+            # register_image needs completed snapshots
+            self.__wait_for_snapshot(r['SnapshotId'], region, deadline=deadline)
+            ebs = dict((k, v) for k, v in mapping['Ebs'].items() if k not in ('Encrypted', 'KmsKeyId'))
+            ebs['SnapshotId'] = r['SnapshotId']
+            return dict(mapping, Ebs=ebs)
 
-    def __share_modify_attribute(self, obj, attribute, operation, account_id):
+        mappings = src.get('BlockDeviceMappings', [])
         try:
-            obj.modify_attribute(
-                Attribute=attribute,
-                OperationType=operation,
-                UserIds=[
-                    account_id
-                ]
-            )
+            with ThreadPoolExecutor(max_workers=len(mappings) or 1) as executor:
+                mappings = list(executor.map(copy_snapshot, mappings))
+
+            params = dict((k, src[k]) for k in REGISTER_IMAGE_FIELDS if k in src)
+            if src.get('BootMode') in ('uefi', 'uefi-preferred'):
+                # the UEFI variable store, e.g. Secure Boot keys, is only returned as an attribute
+                uefi_data = self.__get_image_attribute(src_image, 'uefiData').get('UefiData', {}).get('Value')
+                if uefi_data:
+                    params['UefiData'] = uefi_data
+            with tracing.span('register_image', region=region, source_image_id=image_id) as span:
+                try:
+                    r = dst_ec2.register_image(Name=name, Description=description or '', BlockDeviceMappings=mappings, **params)
+                except botocore.exceptions.ClientError as e:
+                    message = e.response['Error']['Message']
+                    logger.error(message)
+                    raise RuntimeError(message)
+                span.set('image_id', r['ImageId'])
+        except Exception as e:
+            if isinstance(e, (WaitTimeout, WaitCancelled)):
+                logger.error(str(e))
+            # snapshots no image was registered with are useless, a retried copy starts over
+            if copies:
+                logger.warning('deleting the snapshots copied for {}'.format(image_id))
+                remaining = self.__delete_snapshots(region, copies, 'snapshots copied for {}'.format(image_id))
+                if remaining:
+                    logger.error('copy of {} left {} behind, delete them by hand'.format(image_id, ', '.join(remaining)))
+            raise
+        return r['ImageId']
+
+    def __incremental_problem(self, image):
+        """Returns why image cannot be registered again from its snapshots, None when it can"""
+        if image.raw.get('ProductCodes'):
+            return 'has product codes'
+        # register_image cannot set the platform nor the billing of the source
+        if image.raw.get('Platform') == 'windows':
+            return 'is a Windows image'
+        if image.raw.get('UsageOperation', 'RunInstances') != 'RunInstances':
+            return 'has billing products ({})'.format(image.raw['UsageOperation'])
+        return None
+
+    def __copy_permissions(self, src_image, image_id, region, deadline=None):
+        """Waits for the copy image_id and gives it the permissions of src_image
+
+        Returns the available copy. Its snapshots are completed and matched
+        with the source snapshots by device name.
+        """
+        with tracing.span('copy_permissions', region=region, image_id=image_id):
+            dst_image = self.__wait_for_image(image_id, region, deadline=deadline)
+            users = []
+            for permission in self.__get_image_permissions(src_image):
+                account_id = permission.get('UserId')
+                users.append(account_id)
+                logger.debug('adding launchPermission permission for {} on image {}'.format(account_id, image_id))
+                self.__modify_permission(region, image_id, 'launchPermission', 'add', account_id)
+
+            src_snapshots = dict((_.get('DeviceName'), _['Ebs']['SnapshotId']) for _ in src_image.block_device_mappings if _.get('Ebs', {}).get('SnapshotId'))
+            for mapping in dst_image.block_device_mappings:
+                dst_snapshot_id = mapping.get('Ebs', {}).get('SnapshotId')
+                src_snapshot_id = src_snapshots.get(mapping.get('DeviceName'))
+                if not dst_snapshot_id or not src_snapshot_id:
+                    continue
+                logger.debug('found matching DeviceName for {} and {}'.format(src_snapshot_id, dst_snapshot_id))
+                for permission in self.__get_snapshot_permissions(src_image.region, src_snapshot_id):
+                    account_id = permission.get('UserId')
+                    if account_id == 'aws-marketplace':
+                        account_id = self.MARKETPLACE_ACCOUNT_ID
+                    logger.debug('adding createVolumePermission permission for {} on snapshot {}'.format(account_id, dst_snapshot_id))
+                    self.__modify_permission(region, dst_snapshot_id, 'createVolumePermission', 'add', account_id)
+            self.__record_shares(dst_image, [_ for _ in users if _])
+        return dst_image
+
+    def __copied_tags(self, src_image):
+        # lineage, fast snapshot restores and shares of the source are irrelevant on the copy
+        return dict((k, v) for k, v in src_image.tags.items() if not self.__is_copied_to_tag(k) and k not in (FSR_TAG, SHARES_TAG))
+
+    def __record_shares(self, image, users=None):
+        """Sets the shipami:shares tag of image from its permissions, or users when known"""
+        if users is None:
+            users = [_.get('UserId') or _.get('Group') for _ in self.__get_image_permissions(image) if _.get('UserId') or _.get('Group')]
+        value = self.__shares_value(image, users)
+        if image.tags.get(SHARES_TAG) != value:
+            self.__set_tags(image.region, [image.id], {SHARES_TAG: value})
+            image.tags[SHARES_TAG] = value
+        return value
+
+    def __shares_value(self, image, users):
+        """users are account ids, or the group all of a public image"""
+        marketplace_users = set([self.MARKETPLACE_ACCOUNT_ID, 'aws-marketplace'])
+        marketplace = bool(marketplace_users & set(users))
+        if marketplace:
+            marketplace = all(self.__is_snapshot_shared(image.region, _) for _ in image.snapshot_ids)
+        accounts = len(set(users) - marketplace_users - set(['all']))
+        value = 'accounts={},marketplace={}'.format(accounts, 'yes' if marketplace else 'no')
+        # only public images get the flag, the tags of the others stay the same
+        if 'all' in users:
+            value += ',public=yes'
+        return value
+
+    def __is_copied_to_tag(self, key):
+        return key == COPIED_TO_TAG or key.startswith(COPIED_TO_PREFIX)
+
+    def __add_shares(self, image, account_ids):
+        """Adds account_ids to the permissions of image and its snapshots
+
+        Returns the accounts actually added to each resource, keyed by
+        resource id, which is what __revoke_shares takes back.
+        """
+        permissions = {image.id: self.__get_image_permissions(image)}
+        for snapshot_id in image.snapshot_ids:
+            permissions[snapshot_id] = self.__get_snapshot_permissions(image.region, snapshot_id)
+        added = {}
+        for resource_id in [image.id] + image.snapshot_ids:
+            present = set(_.get('UserId') for _ in permissions[resource_id])
+            added[resource_id] = [_ for _ in account_ids if _ not in present]
+        self.__change_shares(image, added, 'Add')
+        return added
+
+    def __revoke_shares(self, image, added):
+        """Removes the permissions __add_shares added"""
+        self.__change_shares(image, added, 'Remove')
+
+    def __change_shares(self, image, changes, operation):
+        ec2 = self.__get_client(image.region)
+        with tracing.span('share', region=image.region, image_id=image.id, operation=operation.lower()):
+            try:
+                for resource_id in [image.id] + image.snapshot_ids:
+                    if not changes.get(resource_id):
+                        continue
+                    change = {operation: [{'UserId': _} for _ in changes[resource_id]]}
+                    logger.debug('{} permissions for {} on {}'.format(operation.lower(), ', '.join(changes[resource_id]), resource_id))
+                    if resource_id == image.id:
+                        ec2.modify_image_attribute(ImageId=resource_id, LaunchPermission=change)
+                    else:
+                        ec2.modify_snapshot_attribute(SnapshotId=resource_id, Attribute='createVolumePermission', CreateVolumePermission=change)
+            except botocore.exceptions.ClientError as e:
+                message = e.response['Error']['Message']
+                logger.error(message)
+                raise RuntimeError(message)
+            if changes.get(image.id):
+                self.__record_shares(image)
+
+    def __modify_permission(self, region, resource_id, attribute, operation, account_id):
+        ec2 = self.__get_client(region)
+        kwargs = {'Attribute': attribute, 'OperationType': operation, 'UserIds': [account_id]}
+        try:
+            if attribute == 'launchPermission':
+                ec2.modify_image_attribute(ImageId=resource_id, **kwargs)
+            else:
+                ec2.modify_snapshot_attribute(SnapshotId=resource_id, **kwargs)
         except botocore.exceptions.ClientError as e:
             message = e.response['Error']['Message']
             logger.error(message)
             raise RuntimeError(message)
 
-    def __get_copied_from_image(self, copied_from):
+    def __remove_copied_to(self, copied_from, to_remove):
+        """Drops to_remove, a region:image_id copy, from the lineage of copied_from"""
         try:
             region, image_id = copied_from.split(':')
         except ValueError as e:
             logger.error(e)
             raise RuntimeError(e)
-        image = self.__get_session(region).resource('ec2').Image(image_id)
-        return image
-
-    def __generate_copy_tag(self, image):
-        return '{}:{}'.format(self.__get_image_region(image), image.id)
+        ec2 = self.__get_client(region)
 
-    def __remove_copied_to(self, image, to_remove):
         try:
-            copied_to = self.__get_tag(image, 'shipami:copied_to')
+            logger.debug('removing "{}" from {} lineage tags'.format(to_remove, image_id))
+            ec2.delete_tags(Resources=[image_id], Tags=[{'Key': COPIED_TO_PREFIX + to_remove}])
 
-            logger.debug('removing "{}" from {} shipami:copied_to tag'.format(to_remove, image.id))
-            logger.debug('shipami:copied_to: {}'.format(copied_to))
+            images = ec2.describe_images(ImageIds=[image_id]).get('Images', [])
+            copied_to = ImageRecord(images[0], region, keep_raw=False).tags.get(COPIED_TO_TAG) if images else None
+            logger.debug('{}: {}'.format(COPIED_TO_TAG, copied_to))
 
             if copied_to:
-                copied_to = copied_to.split(',')
-                copied_to = filter(lambda _: _ != to_remove, copied_to)
-                copied_to = ','.join(copied_to)
-
+                copied_to = ','.join(_ for _ in copied_to.split(',') if _ != to_remove)
                 if copied_to:
-                    logger.debug('set shipami:copied_to: {}'.format(copied_to))
-                    self.__set_tag(image, 'shipami:copied_to', copied_to)
+                    logger.debug('set {}: {}'.format(COPIED_TO_TAG, copied_to))
+                    ec2.create_tags(Resources=[image_id], Tags=[{'Key': COPIED_TO_TAG, 'Value': copied_to}])
                 else:
-                    logger.debug('removed shipami:copied_to')
-                    self.__delete_tag(image, 'shipami:copied_to')
-        except RuntimeError as e:
-            logger.debug(str(e))
-
-    def __get_image_region(self, image):
-        return image.meta.client.meta.region_name
-
-    def __get_image_snapshots(self, image):
-        region_name = self.__get_image_region(image)
-        ec2 = self.__get_session(region_name).resource('ec2')
-        snapshots = []
-
-        # We must wait for the image to be avaiale in order to get the SnapshotIds
-        self.__wait_for_image(image)
-        for block_device_mapping in image.block_device_mappings:
-            if block_device_mapping.get('Ebs'):
-                try:
-                    snapshots.append(ec2.Snapshot(block_device_mapping['Ebs']['SnapshotId']))
-                except KeyError:
-                    pass
-        return snapshots
-
-    def __get_image_block_devices(self, image):
-        region_name = self.__get_image_region(image)
-        ec2 = self.__get_session(region_name).resource('ec2')
-        block_devices = []
-
-        # We must wait for the image to be avaiale in order to get the SnapshotIds
-        self.__wait_for_image(image)
-        for block_device_mapping in image.block_device_mappings:
-            if block_device_mapping.get('Ebs'):
-                block_devices.append({'DeviceName': block_device_mapping.get('DeviceName'), 'Snapshot': ec2.Snapshot(block_device_mapping['Ebs']['SnapshotId'])})
-        return block_devices
-
-    def __set_managed(self, image):
-        self.__set_tag(image, 'shipami:managed', 'True')
-
-    def __append_tag(self, obj, key, value):
-        p_value = self.__get_tag(obj, key)
-        if p_value:
-            value = ','.join([p_value, value])
-
-        self.__set_tag(obj, key, value)
-
-    def __get_tag(self, obj, key):
-        try:
-            tags = obj.tags or []
-        except AttributeError:
-            try:
-                tags = obj.get('Tags', [])
-            except AttributeError:
-                return None
+                    logger.debug('removed {}'.format(COPIED_TO_TAG))
+                    ec2.delete_tags(Resources=[image_id], Tags=[{'Key': COPIED_TO_TAG}])
         except botocore.exceptions.ClientError as e:
-            message = e.response['Error']['Message']
-            raise RuntimeError(message)
+            # the source may have been deleted already
+            logger.debug(e.response['Error']['Message'])
 
-        for tag in tags:
-            if tag.get('Key') == key:
-                return tag.get('Value')
-        return None
-
-    def __set_tag(self, obj, key, value):
+    def __set_tags(self, region, resource_ids, tags):
+        if not resource_ids or not tags:
+            return
         try:
-            obj.create_tags(
-                Tags=[
-                    {
-                        'Key': key,
-                        'Value': value
-                    }
-                ]
+            self.__get_client(region).create_tags(
+                Resources=resource_ids,
+                Tags=[{'Key': k, 'Value': v} for k, v in sorted(tags.items())]
             )
         except botocore.exceptions.ClientError as e:
             message = e.response['Error']['Message']
             logger.error(message)
             raise RuntimeError(message)
 
-    def __delete_tag(self, obj, key):
+    def __get_image_attribute(self, image, attribute):
         try:
-            obj.meta.client.delete_tags(
-                Resources=[
-                    obj.id
-                ],
-                Tags=[
-                    {
-                        'Key': key
-                    }
-                ]
-            )
+            return self.__get_client(image.region).describe_image_attribute(ImageId=image.id, Attribute=attribute)
         except botocore.exceptions.ClientError as e:
             message = e.response['Error']['Message']
             logger.error(message)
             raise RuntimeError(message)
 
-    def __is_managed(self, image):
-        if self.__get_tag(image, 'shipami:managed') == 'True':
-            return True
-        return False
-
-    def __is_release(self, image):
-        return True if self.__get_tag(image, 'shipami:release') else False
-
     def __get_image_permissions(self, image):
         try:
-            r = image.describe_attribute(
+            r = self.__get_client(image.region).describe_image_attribute(
+                ImageId=image.id,
                 Attribute='launchPermission'
             )
         except botocore.exceptions.ClientError as e:
@@ -411,9 +1515,10 @@ class ShipAMI(object):
 
         return r.get('LaunchPermissions', [])
 
-    def __get_snapshot_permissions(self, snapshot):
+    def __get_snapshot_permissions(self, region, snapshot_id):
         try:
-            r = snapshot.describe_attribute(
+            r = self.__get_client(region).describe_snapshot_attribute(
+                SnapshotId=snapshot_id,
                 Attribute='createVolumePermission'
             )
         except botocore.exceptions.ClientError as e:
@@ -423,60 +1528,118 @@ class ShipAMI(object):
 
         return r.get('CreateVolumePermissions', [])
 
-    def __is_ami_shared(self, image, account_id=None):
+    def __is_ami_shared(self, image, account_id=None, permissions=None):
         account_id = account_id or self.MARKETPLACE_ACCOUNT_ID
 
-        for snapshot in self.__get_image_snapshots(image):
-            if not self.__is_snapshot_shared(snapshot, account_id):
+        for snapshot_id in image.snapshot_ids:
+            if not self.__is_snapshot_shared(image.region, snapshot_id, account_id):
                 return False
-        return self.__is_image_shared(image, account_id)
+        return self.__is_image_shared(image, account_id, permissions)
 
-    def __is_image_shared(self, image, account_id=None):
+    def __is_image_shared(self, image, account_id=None, permissions=None):
         account_id = account_id or self.MARKETPLACE_ACCOUNT_ID
 
-        for permission in self.__get_image_permissions(image):
+        if permissions is None:
+            permissions = self.__get_image_permissions(image)
+        for permission in permissions:
             if (permission.get('UserId') == account_id) or (account_id == self.MARKETPLACE_ACCOUNT_ID and permission.get('UserId') == 'aws-marketplace'):
                 return True
 
-    def __is_snapshot_shared(self, snapshot, account_id=None):
+    def __is_snapshot_shared(self, region, snapshot_id, account_id=None):
         account_id = account_id or self.MARKETPLACE_ACCOUNT_ID
 
-        for permission in self.__get_snapshot_permissions(snapshot):
+        for permission in self.__get_snapshot_permissions(region, snapshot_id):
             if (permission.get('UserId') == account_id) or (account_id == self.MARKETPLACE_ACCOUNT_ID and permission.get('UserId') == 'aws-marketplace'):
                 return True
         return False
 
-    def __wait_for_image(self, image, state='available'):
-        logger.debug('waiting for image {} to be {}'.format(image.id, state))
-        image.wait_until_exists(
-            Filters=[
-                {
-                    'Name': 'state',
-                    'Values': [
-                        state
-                    ]
-                }
-            ]
-        )
-        image.reload()
-
-    def __wait_for_snapshot(self, snapshot):
-        logger.debug('waiting for snapshot {} to be ready'.format(snapshot.id))
-        snapshot.wait_until_completed(
-            Filters=[
-                {
-                    'Name': 'status',
-                    'Values': [
-                        'completed',
-                        'error'
-                    ]
-                }
-            ]
-        )
-        snapshot.reload()
-
-    def __wait_for_block_devices(self, image):
-        logger.debug('waiting for block devices')
-        while not image.block_device_mappings:
-            image.reload()
-            time.sleep(1)
+    def __image_progress(self, image_id, region=None):
+        """Returns (state, percent) of an image, state is None when it is not found and percent when unknown"""
+        image, progress = self.__image_status(image_id, region)
+        return image.state if image is not None else None, progress
+
+    def __image_status(self, image_id, region=None):
+        """Returns (ImageRecord, percent) of an image, the record is None until the image is visible"""
+        region = region or self._region
+        ec2 = self.__get_client(region)
+
+        try:
+            images = ec2.describe_images(ImageIds=[image_id]).get('Images', [])
+            if not images:
+                return None, None
+            image = ImageRecord(images[0], region)
+
+            if image.state == 'available':
+                return image, 100
+            if not image.snapshot_ids:
+                return image, None
+            snapshots = ec2.describe_snapshots(SnapshotIds=image.snapshot_ids).get('Snapshots', [])
+        except botocore.exceptions.ClientError as e:
+            # a fresh copy is not always visible right away
+            if e.response['Error'].get('Code') == 'InvalidAMIID.NotFound':
+                return None, None
+            message = e.response['Error']['Message']
+            logger.error(message)
+            raise RuntimeError(message)
+
+        progress = [self.__snapshot_progress(_) for _ in snapshots]
+        return image, sum(progress) // len(progress) if progress else None
+
+    def __snapshot_progress(self, snapshot):
+        return int((snapshot.get('Progress') or '0%').rstrip('%'))
+
+    def __available(self, image, deadline=None):
+        """Returns image when it is available, or the record it has once it is"""
+        if image.state == 'available':
+            return image
+        return self.__wait_for_image(image.id, image.region, deadline=deadline)
+
+    def __wait_for_image(self, image_id, region=None, state='available', deadline=None):
+        """Waits for image_id to be in state, returns its last ImageRecord
+
+        An image not found for NOT_FOUND_GRACE seconds is an error, only a
+        copy that just started is expected to be invisible for a while.
+        """
+        region = region or self._region
+        started = self._clock.time()
+        last = []
+
+        def check():
+            image, progress = self.__image_status(image_id, region)
+            if image is None and self._clock.time() - started >= waiting.NOT_FOUND_GRACE:
+                raise RuntimeError('image {} does not exist'.format(image_id))
+            current = image.state if image is not None else 'pending'
+            if current in ('failed', 'error', 'invalid', 'deregistered') and current != state:
+                raise RuntimeError('image {} is {}'.format(image_id, current))
+            last[:] = [image]
+            return current == state, progress
+
+        with tracing.span('wait_for_image', region=region, image_id=image_id, state=state):
+            logger.debug('waiting for image {} to be {}'.format(image_id, state))
+            waiting.poll(check, 'image {}'.format(image_id), deadline=deadline, cancel=self._cancel, clock=self._clock)
+        return last[0]
+
+    def __wait_for_snapshot(self, snapshot_id, region=None, deadline=None):
+        """Waits for snapshot_id to be completed, returns its last describe_snapshots entry"""
+        region = region or self._region
+        ec2 = self.__get_client(region)
+        last = []
+
+        def check():
+            try:
+                snapshots = ec2.describe_snapshots(SnapshotIds=[snapshot_id]).get('Snapshots', [])
+            except botocore.exceptions.ClientError as e:
+                message = e.response['Error']['Message']
+                logger.error(message)
+                raise RuntimeError(message)
+            if not snapshots:
+                return False, None
+            if snapshots[0].get('State') == 'error':
+                raise RuntimeError('snapshot {} is in error'.format(snapshot_id))
+            last[:] = snapshots[:1]
+            return snapshots[0].get('State') == 'completed', self.__snapshot_progress(snapshots[0])
+
+        with tracing.span('wait_for_snapshot', region=region, snapshot_id=snapshot_id):
+            logger.debug('waiting for snapshot {} to be ready'.format(snapshot_id))
+            waiting.poll(check, 'snapshot {}'.format(snapshot_id), deadline=deadline, cancel=self._cancel, clock=self._clock)
+        return last[0]
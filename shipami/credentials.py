@@ -0,0 +1,125 @@
+import datetime
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import boto3
+import botocore
+import botocore.credentials
+import botocore.session
+import dateutil.parser
+import dateutil.tz
+
+from shipami import paths
+
+logger = logging.getLogger('shipami.cli')
+
+# Credentials are refreshed when they expire in less than this, botocore asks
+# for new ones 15 minutes before they expire and refuses them under 10
+EXPIRY_MARGIN = datetime.timedelta(minutes=15)
+
+_credentials = {}
+# one lock per cache file so that different roles are assumed at the same time
+_locks = {}
+_lock = threading.Lock()
+
+
+def is_role_arn(account):
+    return account.startswith('arn:')
+
+
+def account_label(account):
+    """Returns the account id for a role ARN, the profile name otherwise"""
+    if is_role_arn(account):
+        return account.split(':')[4]
+    return account
+
+
+def assume_role_session(role_arn, profile=None, region=None, cache_dir=None):
+    """Returns a session for role_arn whose credentials renew through get_credentials"""
+    def refresh():
+        credentials = get_credentials(role_arn, profile, cache_dir)
+        return {
+            'access_key': credentials['AccessKeyId'],
+            'secret_key': credentials['SecretAccessKey'],
+            'token': credentials['SessionToken'],
+            'expiry_time': credentials['Expiration']
+        }
+
+    botocore_session = botocore.session.get_session()
+    botocore_session._credentials = botocore.credentials.RefreshableCredentials.create_from_metadata(
+        metadata=refresh(),
+        refresh_using=refresh,
+        method='assume-role'
+    )
+    return boto3.session.Session(botocore_session=botocore_session, region_name=region)
+
+
+def get_credentials(role_arn, profile=None, cache_dir=None):
+    """Returns temporary credentials for role_arn
+
+    Credentials are kept in memory and on disk until they expire so that
+    repeated runs do not call AssumeRole again.
+    """
+    key = hashlib.sha1('{}|{}'.format(profile or '', role_arn).encode('utf-8')).hexdigest()
+    cache_file = os.path.join(cache_dir, key + '.json') if cache_dir else paths.path('cache', 'credentials', key + '.json')
+
+    with _lock:
+        lock = _locks.setdefault(cache_file, threading.Lock())
+
+    with lock:
+        credentials = _credentials.get(cache_file)
+        if not _is_valid(credentials):
+            credentials = _read(cache_file)
+        if not _is_valid(credentials):
+            credentials = _assume_role(role_arn, profile)
+            _write(cache_file, credentials)
+        _credentials[cache_file] = credentials
+    return credentials
+
+
+def _is_valid(credentials):
+    if not credentials:
+        return False
+    expiration = dateutil.parser.parse(credentials['Expiration'])
+    return expiration - EXPIRY_MARGIN > datetime.datetime.now(dateutil.tz.tzutc())
+
+
+def _assume_role(role_arn, profile=None):
+    logger.debug('assuming role {}'.format(role_arn))
+    try:
+        r = boto3.session.Session(profile_name=profile).client('sts').assume_role(
+            RoleArn=role_arn,
+            RoleSessionName='shipami'
+        )
+    except botocore.exceptions.ClientError as e:
+        message = e.response['Error']['Message']
+        logger.error(message)
+        raise RuntimeError(message)
+
+    credentials = dict(r['Credentials'])
+    credentials['Expiration'] = credentials['Expiration'].isoformat()
+    return credentials
+
+
+def _read(cache_file):
+    try:
+        with open(cache_file) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _write(cache_file, credentials):
+    try:
+        try:
+            os.makedirs(os.path.dirname(cache_file), 0o700)
+        except OSError:
+            pass
+        fd = os.open(cache_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(credentials, f)
+    except (IOError, OSError) as e:
+        logger.debug('could not cache credentials: {}'.format(e))
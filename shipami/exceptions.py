@@ -0,0 +1,18 @@
+class CopyLimitExceeded(RuntimeError):
+    """Raised when EC2 refuses a copy because too many are already in flight"""
+
+
+class WaitTimeout(RuntimeError):
+    """Raised when a resource is not ready before the deadline"""
+
+
+class WaitCancelled(RuntimeError):
+    """Raised when a wait is interrupted by ShipAMI.cancel() or ^C"""
+
+
+class PreflightError(RuntimeError):
+    """Raised before any copy is started when preflight checks fail"""
+
+    def __init__(self, problems):
+        super(PreflightError, self).__init__('preflight failed:\n{}'.format('\n'.join('  ' + _ for _ in problems)))
+        self.problems = problems
@@ -0,0 +1,469 @@
+"""In-memory EC2 with latency, state transitions, throttling and copy quotas
+
+It also answers the few KMS calls preflight makes.
+
+FakeEC2 answers EC2 calls at the botocore client layer, so ShipAMI code
+runs unchanged against it:
+
+    fake = FakeEC2(latency=0.2, copy_seconds=600, speedup=600)
+    image_id = fake.add_image('eu-west-1', 'foo')
+    shipami = ShipAMI(region='us-east-1', session_factory=fake.session)
+
+Durations are simulated seconds; speedup makes simulated time run faster
+than wall time so that copies taking minutes on AWS take seconds here.
+Throttling uses a seeded random generator to stay reproducible.
+
+Tests give the fake and ShipAMI the same ManualClock instead: simulated
+time only moves when the test advances it or when ShipAMI waits, so results
+do not depend on how fast the machine runs:
+
+    clock = ManualClock()
+    fake = FakeEC2(copy_seconds=600, clock=clock)
+    shipami = ShipAMI(region='us-east-1', session_factory=fake.session, clock=clock)
+    clock.advance(600)
+"""
+import collections
+import copy
+import datetime
+import functools
+import itertools
+import random
+import threading
+import time
+
+import boto3
+from botocore.awsrequest import AWSResponse
+
+from shipami.waiting import Clock
+
+
+class FakeError(Exception):
+
+    def __init__(self, code, message):
+        super(FakeError, self).__init__(message)
+        self.code = code
+        self.message = message
+
+
+class ManualClock(Clock):
+    """Simulated time that only moves with advance(), sleeping advances it"""
+
+    def __init__(self, now=None):
+        self._now = time.time() if now is None else now
+        self._lock = threading.Lock()
+
+    def time(self):
+        return self._now
+
+    def sleep(self, seconds, cancel=None):
+        self.advance(seconds)
+
+    def advance(self, seconds):
+        with self._lock:
+            self._now += seconds
+
+
+class FakeEC2(object):
+
+    OWNER_ID = '123456789012'
+
+    def __init__(self, latency=0, speedup=1, copy_seconds=600, copy_seconds_per_gib=0, incremental_ratio=0.1,
+                 throttle_rate=0, copy_limit=None, seed=0, fsr_seconds=60, clock=None):
+        # latency is a number of seconds or a dict of operation name to seconds
+        self.latency = latency
+        # a ManualClock replaces wall time and speedup
+        self.clock = clock
+        self.speedup = float(speedup)
+        self.copy_seconds = copy_seconds
+        self.copy_seconds_per_gib = copy_seconds_per_gib
+        self.incremental_ratio = incremental_ratio
+        self.throttle_rate = throttle_rate
+        self.copy_limit = copy_limit
+        # time for fast snapshot restores to go from enabling to enabled
+        self.fsr_seconds = fsr_seconds
+        self.calls = collections.Counter()
+        self.images = collections.defaultdict(dict)
+        self.snapshots = collections.defaultdict(dict)
+        # region to {key id: KeyState}, the AWS managed alias/aws/ebs is always enabled
+        self.kms_keys = collections.defaultdict(dict)
+        # region to the EBS default key id
+        self.default_kms_keys = {}
+        self._random = random.Random(seed)
+        self._ids = itertools.count(1)
+        self._started = clock.time() if clock is not None else time.time()
+        self._lock = threading.RLock()
+
+    def now(self):
+        """Simulated seconds since the fake was created"""
+        if self.clock is not None:
+            return self.clock.time() - self._started
+        return (time.time() - self._started) * self.speedup
+
+    def utcnow(self):
+        if self.clock is not None:
+            return datetime.datetime.utcfromtimestamp(self.clock.time())
+        return datetime.datetime.utcnow()
+
+    def session(self, profile_name=None, region_name=None, **kwargs):
+        session = boto3.session.Session(
+            aws_access_key_id='fake',
+            aws_secret_access_key='fake',
+            region_name=region_name
+        )
+        session.events.register('before-parameter-build.ec2', self.__capture)
+        session.events.register('before-call.ec2', functools.partial(self.__respond, region_name))
+        session.events.register('before-parameter-build.kms', self.__capture)
+        session.events.register('before-call.kms', functools.partial(self.__respond, region_name))
+        return session
+
+    def add_image(self, region, name, size=8, parent=None, state='available', kms_key_id=None):
+        """Registers an image with one snapshot, parent shares its snapshot lineage
+
+        kms_key_id encrypts the snapshot with that key.
+        """
+        with self._lock:
+            lineage = None
+            if parent:
+                parent_snapshot = self.__image_snapshot_ids(region, parent)[0]
+                lineage = self.snapshots[region][parent_snapshot]['_lineage']
+            snapshot_id = self.__add_snapshot(region, size, 0 if state == 'available' else self.copy_seconds, lineage)
+            image_id = self.__add_image(region, name, name, [snapshot_id], state)
+            if kms_key_id:
+                self.snapshots[region][snapshot_id].update(Encrypted=True, KmsKeyId=kms_key_id)
+                self.images[region][image_id]['BlockDeviceMappings'][0]['Ebs']['Encrypted'] = True
+            return image_id
+
+    # botocore plumbing
+
+    def __capture(self, params, context, **kwargs):
+        context['fake_params'] = copy.deepcopy(params)
+
+    def __respond(self, region, model, context, **kwargs):
+        operation = model.name
+        params = context.get('fake_params', {})
+        self.calls[operation] += 1
+
+        latency = self.latency.get(operation, 0) if isinstance(self.latency, dict) else self.latency
+        if latency and self.clock is not None:
+            self.clock.sleep(latency)
+        elif latency:
+            time.sleep(latency / self.speedup)
+
+        try:
+            with self._lock:
+                if self.throttle_rate and self._random.random() < self.throttle_rate:
+                    raise FakeError('RequestLimitExceeded', 'Request limit exceeded.')
+                handler = getattr(self, '_op_' + operation, None)
+                if handler is None:
+                    raise FakeError('UnsupportedOperation', '{} is not supported by FakeEC2'.format(operation))
+                parsed = handler(region, params) or {}
+            status_code = 200
+        except FakeError as e:
+            parsed = {'Error': {'Code': e.code, 'Message': e.message}}
+            status_code = 400
+
+        parsed['ResponseMetadata'] = {'HTTPStatusCode': status_code}
+        return AWSResponse('https://ec2.{}.amazonaws.com/'.format(region), status_code, {}, None), parsed
+
+    # state
+
+    def __new_id(self, prefix):
+        return '{}-{:08x}'.format(prefix, next(self._ids))
+
+    def __add_snapshot(self, region, size, duration, lineage=None, copied=False):
+        snapshot_id = self.__new_id('snap')
+        self.snapshots[region][snapshot_id] = {
+            'SnapshotId': snapshot_id,
+            # like EC2, copies do not keep the id of the volume they come from
+            'VolumeId': 'vol-ffffffff' if copied else 'vol-' + (lineage or snapshot_id)[5:],
+            'OwnerId': self.OWNER_ID,
+            'VolumeSize': size,
+            'Encrypted': False,
+            'StartTime': self.utcnow(),
+            'Tags': [],
+            '_permissions': [],
+            '_fsr': {},
+            '_started': self.now(),
+            '_duration': duration,
+            '_lineage': lineage or snapshot_id
+        }
+        return snapshot_id
+
+    def __add_image(self, region, name, description, snapshot_ids, state='pending', copied=False):
+        image_id = self.__new_id('ami')
+        self.images[region][image_id] = {
+            'ImageId': image_id,
+            'Name': name,
+            'Description': description,
+            'OwnerId': self.OWNER_ID,
+            'CreationDate': self.utcnow().strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+            'Architecture': 'x86_64',
+            'RootDeviceName': '/dev/xvda',
+            'RootDeviceType': 'ebs',
+            'VirtualizationType': 'hvm',
+            'BlockDeviceMappings': [
+                {
+                    'DeviceName': '/dev/xvda' if i == 0 else '/dev/xvd{}'.format(chr(ord('b') + i - 1)),
+                    'Ebs': {
+                        'SnapshotId': snapshot_id,
+                        'VolumeSize': self.snapshots[region][snapshot_id]['VolumeSize'],
+                        'VolumeType': 'gp2',
+                        'DeleteOnTermination': True,
+                        'Encrypted': False
+                    }
+                } for i, snapshot_id in enumerate(snapshot_ids)
+            ],
+            'Tags': [],
+            '_permissions': [],
+            '_state': state,
+            '_copied': copied
+        }
+        return image_id
+
+    def __snapshot_view(self, snapshot):
+        view = dict((k, v) for k, v in snapshot.items() if not k.startswith('_'))
+        elapsed = self.now() - snapshot['_started']
+        if snapshot['_duration'] <= 0 or elapsed >= snapshot['_duration']:
+            view['State'], view['Progress'] = 'completed', '100%'
+        else:
+            view['State'], view['Progress'] = 'pending', '{}%'.format(int(100 * elapsed / snapshot['_duration']))
+        return copy.deepcopy(view)
+
+    def __image_state(self, region, image):
+        if image['_state'] != 'pending':
+            return image['_state']
+        for snapshot_id in self.__image_snapshot_ids(region, image['ImageId']):
+            snapshot = self.snapshots[region].get(snapshot_id)
+            if snapshot is None or self.__snapshot_view(snapshot)['State'] != 'completed':
+                return 'pending'
+        image['_state'] = 'available'
+        return 'available'
+
+    def __image_view(self, region, image):
+        view = dict((k, v) for k, v in image.items() if not k.startswith('_'))
+        view['State'] = self.__image_state(region, image)
+        return copy.deepcopy(view)
+
+    def __image_snapshot_ids(self, region, image_id):
+        image = self.__get_image(region, image_id)
+        return [_['Ebs']['SnapshotId'] for _ in image['BlockDeviceMappings'] if _.get('Ebs', {}).get('SnapshotId')]
+
+    def __get_image(self, region, image_id):
+        image = self.images[region].get(image_id)
+        if image is None:
+            raise FakeError('InvalidAMIID.NotFound', 'The image id \'[{}]\' does not exist'.format(image_id))
+        return image
+
+    def __get_snapshot(self, region, snapshot_id):
+        snapshot = self.snapshots[region].get(snapshot_id)
+        if snapshot is None:
+            raise FakeError('InvalidSnapshot.NotFound', 'The snapshot \'{}\' does not exist.'.format(snapshot_id))
+        return snapshot
+
+    def __get_resource(self, region, resource_id):
+        if resource_id.startswith('ami-'):
+            return self.__get_image(region, resource_id)
+        if resource_id.startswith('snap-'):
+            return self.__get_snapshot(region, resource_id)
+        raise FakeError('InvalidID', 'The ID \'{}\' is not valid'.format(resource_id))
+
+    def __copy_duration(self, region, snapshot, incremental=True):
+        duration = self.copy_seconds + self.copy_seconds_per_gib * snapshot['VolumeSize']
+        if not incremental:
+            return duration
+        for other in self.snapshots[region].values():
+            if other['_lineage'] == snapshot['_lineage']:
+                return duration * self.incremental_ratio
+        return duration
+
+    def __match(self, view, filters):
+        for f in filters or []:
+            name, values = f['Name'], f['Values']
+            if name.startswith('tag:'):
+                value = dict((_['Key'], _['Value']) for _ in view.get('Tags', [])).get(name[4:])
+            elif name == 'tag-key':
+                if not set(values) & set(_['Key'] for _ in view.get('Tags', [])):
+                    return False
+                continue
+            else:
+                key = {
+                    'name': 'Name', 'state': 'State', 'status': 'State', 'image-id': 'ImageId',
+                    'snapshot-id': 'SnapshotId', 'owner-id': 'OwnerId', 'description': 'Description',
+                    'volume-id': 'VolumeId', 'availability-zone': 'AvailabilityZone'
+                }.get(name)
+                if key is None:
+                    raise FakeError('InvalidParameterValue', 'The filter \'{}\' is invalid'.format(name))
+                value = view.get(key)
+            if value not in values:
+                return False
+        return True
+
+    def __modify_permissions(self, permissions, params, key):
+        operation = params.get('OperationType')
+        if operation:
+            changes = {'add': [], 'remove': []}
+            changes[operation] = [{'UserId': _} for _ in params.get('UserIds', [])]
+        else:
+            changes = {'add': params.get(key, {}).get('Add', []), 'remove': params.get(key, {}).get('Remove', [])}
+        for permission in changes['add']:
+            if permission not in permissions:
+                permissions.append(permission)
+        for permission in changes['remove']:
+            if permission in permissions:
+                permissions.remove(permission)
+
+    # operations
+
+    def _op_DescribeImages(self, region, params):
+        if params.get('ImageIds'):
+            images = [self.__get_image(region, _) for _ in params['ImageIds']]
+        else:
+            images = list(self.images[region].values())
+        if params.get('ExecutableUsers'):
+            images = [_ for _ in images if {'UserId': self.OWNER_ID} in _['_permissions']]
+        views = [self.__image_view(region, _) for _ in images]
+        return {'Images': [_ for _ in views if self.__match(_, params.get('Filters'))]}
+
+    def _op_DescribeSnapshots(self, region, params):
+        if params.get('SnapshotIds'):
+            snapshots = [self.__get_snapshot(region, _) for _ in params['SnapshotIds']]
+        else:
+            snapshots = list(self.snapshots[region].values())
+        views = [self.__snapshot_view(_) for _ in snapshots]
+        return {'Snapshots': [_ for _ in views if self.__match(_, params.get('Filters'))]}
+
+    def _op_CopyImage(self, region, params):
+        source = self.__get_image(params['SourceRegion'], params['SourceImageId'])
+        if self.__image_state(params['SourceRegion'], source) != 'available':
+            raise FakeError('IncorrectState', 'Image {} is not available'.format(source['ImageId']))
+        if self.copy_limit is not None:
+            running = [_ for _ in self.images[region].values() if _['_copied'] and self.__image_state(region, _) == 'pending']
+            if len(running) >= self.copy_limit:
+                raise FakeError('ResourceLimitExceeded', 'You have reached the limit of concurrent AMI copies.')
+
+        snapshot_ids = []
+        for snapshot_id in self.__image_snapshot_ids(params['SourceRegion'], source['ImageId']):
+            snapshot = self.snapshots[params['SourceRegion']][snapshot_id]
+            # copy_image transfers every snapshot in full
+            duration = self.__copy_duration(region, snapshot, incremental=False)
+            snapshot_ids.append(self.__add_snapshot(region, snapshot['VolumeSize'], duration, snapshot['_lineage'], copied=True))
+        image_id = self.__add_image(region, params['Name'], params.get('Description'), snapshot_ids, copied=True)
+        return {'ImageId': image_id}
+
+    def _op_CopySnapshot(self, region, params):
+        snapshot = self.__get_snapshot(params['SourceRegion'], params['SourceSnapshotId'])
+        duration = self.__copy_duration(region, snapshot)
+        snapshot_id = self.__add_snapshot(region, snapshot['VolumeSize'], duration, snapshot['_lineage'], copied=True)
+        self.snapshots[region][snapshot_id]['Description'] = params.get('Description', '')
+        return {'SnapshotId': snapshot_id}
+
+    def _op_RegisterImage(self, region, params):
+        snapshot_ids = [_['Ebs']['SnapshotId'] for _ in params.get('BlockDeviceMappings', []) if _.get('Ebs', {}).get('SnapshotId')]
+        for snapshot_id in snapshot_ids:
+            self.__get_snapshot(region, snapshot_id)
+        image_id = self.__add_image(region, params['Name'], params.get('Description'), snapshot_ids)
+        image = self.images[region][image_id]
+        image['BlockDeviceMappings'] = params.get('BlockDeviceMappings', image['BlockDeviceMappings'])
+        for key in ['Architecture', 'RootDeviceName', 'VirtualizationType', 'EnaSupport', 'SriovNetSupport', 'BootMode', 'TpmSupport', 'ImdsSupport']:
+            if key in params:
+                image[key] = params[key]
+        if params.get('UefiData'):
+            image['_uefi_data'] = params['UefiData']
+        return {'ImageId': image_id}
+
+    def _op_EnableFastSnapshotRestores(self, region, params):
+        successful, unsuccessful = [], []
+        for snapshot_id in params.get('SourceSnapshotIds', []):
+            snapshot = self.snapshots[region].get(snapshot_id)
+            errors = []
+            for zone in params.get('AvailabilityZones', []):
+                if snapshot is None:
+                    error = ('InvalidSnapshot.NotFound', 'The snapshot \'{}\' does not exist.'.format(snapshot_id))
+                elif not zone.startswith(region):
+                    error = ('InvalidParameterValue', 'Invalid availability zone: [{}]'.format(zone))
+                elif self.__snapshot_view(snapshot)['State'] != 'completed':
+                    error = ('IncorrectState', 'Snapshot {} is not completed'.format(snapshot_id))
+                else:
+                    snapshot['_fsr'].setdefault(zone, self.now())
+                    successful.append({'SnapshotId': snapshot_id, 'AvailabilityZone': zone, 'State': 'enabling'})
+                    continue
+                errors.append({'AvailabilityZone': zone, 'Error': {'Code': error[0], 'Message': error[1]}})
+            if errors:
+                unsuccessful.append({'SnapshotId': snapshot_id, 'FastSnapshotRestoreStateErrors': errors})
+        return {'Successful': successful, 'Unsuccessful': unsuccessful}
+
+    def _op_DisableFastSnapshotRestores(self, region, params):
+        successful = []
+        for snapshot_id in params.get('SourceSnapshotIds', []):
+            snapshot = self.snapshots[region].get(snapshot_id)
+            for zone in params.get('AvailabilityZones', []):
+                if snapshot is not None and snapshot['_fsr'].pop(zone, None) is not None:
+                    successful.append({'SnapshotId': snapshot_id, 'AvailabilityZone': zone, 'State': 'disabling'})
+        return {'Successful': successful, 'Unsuccessful': []}
+
+    def _op_DescribeFastSnapshotRestores(self, region, params):
+        views = []
+        for snapshot in self.snapshots[region].values():
+            for zone, started in sorted(snapshot['_fsr'].items()):
+                elapsed = self.now() - started
+                state = 'enabling' if elapsed < self.fsr_seconds / 2.0 else 'optimizing' if elapsed < self.fsr_seconds else 'enabled'
+                views.append({'SnapshotId': snapshot['SnapshotId'], 'AvailabilityZone': zone, 'State': state, 'OwnerId': self.OWNER_ID})
+        return {'FastSnapshotRestores': [_ for _ in views if self.__match(_, params.get('Filters'))]}
+
+    def _op_DeregisterImage(self, region, params):
+        self.__get_image(region, params['ImageId'])
+        del self.images[region][params['ImageId']]
+
+    def _op_DeleteSnapshot(self, region, params):
+        self.__get_snapshot(region, params['SnapshotId'])
+        for image_id in list(self.images[region]):
+            if params['SnapshotId'] in self.__image_snapshot_ids(region, image_id):
+                raise FakeError('InvalidSnapshot.InUse', 'The snapshot {} is currently in use by {}'.format(params['SnapshotId'], image_id))
+        del self.snapshots[region][params['SnapshotId']]
+
+    def _op_CreateTags(self, region, params):
+        resources = [self.__get_resource(region, _) for _ in params['Resources']]
+        for resource in resources:
+            tags = dict((_['Key'], _['Value']) for _ in resource['Tags'])
+            tags.update((_['Key'], _.get('Value', '')) for _ in params['Tags'])
+            resource['Tags'] = [{'Key': k, 'Value': v} for k, v in tags.items()]
+
+    def _op_DeleteTags(self, region, params):
+        resources = [self.__get_resource(region, _) for _ in params['Resources']]
+        for resource in resources:
+            for tag in params.get('Tags', []):
+                resource['Tags'] = [
+                    _ for _ in resource['Tags']
+                    if not (_['Key'] == tag['Key'] and ('Value' not in tag or _['Value'] == tag['Value']))
+                ]
+
+    def _op_ModifyImageAttribute(self, region, params):
+        image = self.__get_image(region, params['ImageId'])
+        self.__modify_permissions(image['_permissions'], params, 'LaunchPermission')
+
+    def _op_ModifySnapshotAttribute(self, region, params):
+        snapshot = self.__get_snapshot(region, params['SnapshotId'])
+        self.__modify_permissions(snapshot['_permissions'], params, 'CreateVolumePermission')
+
+    def _op_DescribeImageAttribute(self, region, params):
+        image = self.__get_image(region, params['ImageId'])
+        if params['Attribute'] == 'uefiData':
+            return {'ImageId': image['ImageId'], 'UefiData': {'Value': image['_uefi_data']} if image.get('_uefi_data') else {}}
+        return {'ImageId': image['ImageId'], 'LaunchPermissions': copy.deepcopy(image['_permissions'])}
+
+    def _op_DescribeSnapshotAttribute(self, region, params):
+        snapshot = self.__get_snapshot(region, params['SnapshotId'])
+        return {'SnapshotId': snapshot['SnapshotId'], 'CreateVolumePermissions': copy.deepcopy(snapshot['_permissions'])}
+
+    def _op_GetEbsDefaultKmsKeyId(self, region, params):
+        return {'KmsKeyId': self.default_kms_keys.get(region, 'alias/aws/ebs')}
+
+    def _op_DescribeKey(self, region, params):
+        key_id = params['KeyId']
+        if key_id == 'alias/aws/ebs':
+            state = 'Enabled'
+        elif key_id in self.kms_keys[region]:
+            state = self.kms_keys[region][key_id]
+        else:
+            raise FakeError('NotFoundException', 'Key \'{}\' does not exist'.format(key_id))
+        return {'KeyMetadata': {'KeyId': key_id, 'KeyState': state}}
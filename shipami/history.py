@@ -0,0 +1,96 @@
+"""Local history of completed copies, used to predict how long copies take
+
+Every copy shipami waited for is appended to ~/.shipami/history.jsonl with
+its region pair, size in GiB and wall time. Estimates use the throughput of
+the most recent copies between the same regions, falling back to copies to
+the same destination.
+
+Known speeds between regions, in seconds per GiB, can also be configured in
+~/.shipami/speeds.json as {"eu-west-1": {"us-east-1": 45}}; measured copies
+take precedence.
+"""
+import json
+import os
+import threading
+import time
+
+from shipami import paths
+
+HISTORY_FILE = 'history.jsonl'
+SPEEDS_FILE = 'speeds.json'
+# only recent copies reflect current EBS throughput
+RECENT = 20
+
+_lock = threading.Lock()
+
+
+def record(source_region, region, size, seconds, incremental=False):
+    entry = {
+        'time': int(time.time()),
+        'source_region': source_region,
+        'region': region,
+        'size': size,
+        'seconds': round(seconds, 1),
+        'incremental': incremental
+    }
+    with _lock:
+        fd = os.open(paths.path(HISTORY_FILE), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        with os.fdopen(fd, 'a') as f:
+            f.write(json.dumps(entry, sort_keys=True) + '\n')
+    return entry
+
+
+def load():
+    entries = []
+    try:
+        with open(paths.path(HISTORY_FILE)) as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue
+    except (IOError, OSError):
+        pass
+    return entries
+
+
+def estimate(source_region, region, size, incremental=False, entries=None):
+    """Returns the expected seconds to copy size GiB, None without history"""
+    entries = [_ for _ in (load() if entries is None else entries) if _.get('incremental', False) == incremental and _.get('size')]
+    for matches in (
+        [_ for _ in entries if _['source_region'] == source_region and _['region'] == region],
+        [_ for _ in entries if _['region'] == region]
+    ):
+        if matches:
+            return _seconds_per_gib(matches) * size
+    return None
+
+
+def seconds_per_gib(source_region, region, entries=None):
+    """Returns the measured, or else configured, speed between two regions, None if unknown"""
+    entries = load() if entries is None else entries
+    matches = [
+        _ for _ in entries
+        if _['source_region'] == source_region and _['region'] == region and not _.get('incremental') and _.get('size')
+    ]
+    if matches:
+        return _seconds_per_gib(matches)
+    return configured_speeds().get(source_region, {}).get(region)
+
+
+def configured_speeds():
+    try:
+        with open(paths.path(SPEEDS_FILE)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _seconds_per_gib(entries):
+    entries = entries[-RECENT:]
+    return sum(_['seconds'] for _ in entries) / float(sum(_['size'] for _ in entries))
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    return '{}:{:02d}:{:02d}'.format(seconds // 3600, seconds % 3600 // 60, seconds % 60)
@@ -0,0 +1,142 @@
+"""Inventory files of owned images and offline diffs between them
+
+export() writes the owned images of several regions to a SQLite file, one
+row per image keyed and sorted by (image id, region). diff() walks two such
+files side by side in that order, a sorted-merge join that reads each file
+once, so comparing inventories makes no EC2 call and holds no image in
+memory beyond the two current rows.
+
+This module is used by the CLI without loading boto3.
+"""
+import collections
+import json
+import os
+import sqlite3
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+VERSION = 1
+# shipami.core.SHARES_TAG, kept in its own column and reported as share changes
+SHARES_TAG = 'shipami:shares'
+# inventories are read only, let SQLite map them instead of copying pages
+MMAP_SIZE = 1 << 30
+
+SCHEMA = '''
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID;
+CREATE TABLE images (
+    id TEXT NOT NULL,
+    region TEXT NOT NULL,
+    name TEXT,
+    state TEXT,
+    creation_date TEXT,
+    tags TEXT NOT NULL,
+    shares TEXT,
+    PRIMARY KEY (id, region)
+) WITHOUT ROWID;
+'''
+COLUMNS = ('id', 'region', 'name', 'state', 'creation_date', 'tags', 'shares')
+
+Change = collections.namedtuple('Change', ['kind', 'region', 'image_id', 'key', 'old', 'new'])
+
+
+def export(shipami, regions, path):
+    """Writes the owned images of regions to a new inventory at path
+
+    Regions are listed at the same time and each one is written as soon as
+    it is listed. The file is replaced atomically. Returns the number of
+    images written.
+    """
+    tmp_path = '{}.{}'.format(path, os.getpid())
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    db = sqlite3.connect(tmp_path)
+    count = 0
+    try:
+        db.execute('PRAGMA journal_mode = OFF')
+        db.execute('PRAGMA synchronous = OFF')
+        db.executescript(SCHEMA)
+        with ThreadPoolExecutor(max_workers=len(regions) or 1) as executor:
+            futures = [executor.submit(shipami.find_images, regions=[_]) for _ in regions]
+            for future in as_completed(futures):
+                rows = [_row(image) for image in future.result()]
+                db.executemany('INSERT INTO images VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+                count += len(rows)
+        meta = {'version': str(VERSION), 'created': str(int(time.time())), 'regions': ','.join(sorted(regions))}
+        db.executemany('INSERT INTO meta VALUES (?, ?)', sorted(meta.items()))
+        db.commit()
+    except Exception:
+        db.close()
+        os.remove(tmp_path)
+        raise
+    db.close()
+    os.rename(tmp_path, path)
+    return count
+
+
+def meta(path):
+    return dict(_open(path).execute('SELECT key, value FROM meta'))
+
+
+def diff(old_path, new_path):
+    """Yields the Changes from the inventory at old_path to the one at new_path
+
+    kind is 'added' or 'removed' (old and new are names), 'name', 'state',
+    'shares' or 'tag' (key is the tag key, a missing tag is None).
+    """
+    query = 'SELECT {} FROM images ORDER BY id, region'.format(', '.join(COLUMNS))
+    old_rows = _open(old_path).execute(query)
+    new_rows = _open(new_path).execute(query)
+
+    old = next(old_rows, None)
+    new = next(new_rows, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old[:2] < new[:2]):
+            yield Change('removed', old[1], old[0], None, old[2], None)
+            old = next(old_rows, None)
+        elif old is None or new[:2] < old[:2]:
+            yield Change('added', new[1], new[0], None, None, new[2])
+            new = next(new_rows, None)
+        else:
+            if old != new:
+                for change in _compare(old, new):
+                    yield change
+            old = next(old_rows, None)
+            new = next(new_rows, None)
+
+
+def _row(image):
+    tags = dict((k, v) for k, v in image.tags.items() if k != SHARES_TAG)
+    return (
+        image.id, image.region, image.name, image.state, image.creation_date,
+        json.dumps(tags, sort_keys=True, separators=(',', ':')), image.tags.get(SHARES_TAG)
+    )
+
+
+def _compare(old, new):
+    image_id, region = old[0], old[1]
+    for column in ('name', 'state', 'shares'):
+        i = COLUMNS.index(column)
+        if old[i] != new[i]:
+            yield Change(column, region, image_id, None, old[i], new[i])
+
+    i = COLUMNS.index('tags')
+    if old[i] != new[i]:
+        old_tags, new_tags = json.loads(old[i]), json.loads(new[i])
+        for key in sorted(set(old_tags) | set(new_tags)):
+            if old_tags.get(key) != new_tags.get(key):
+                yield Change('tag', region, image_id, key, old_tags.get(key), new_tags.get(key))
+
+
+def _open(path):
+    if not os.path.isfile(path):
+        raise RuntimeError('{} does not exist'.format(path))
+    db = sqlite3.connect(path)
+    db.execute('PRAGMA mmap_size = {}'.format(MMAP_SIZE))
+    try:
+        version = db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+    except sqlite3.DatabaseError:
+        version = None
+    if version is None or version[0] != str(VERSION):
+        raise RuntimeError('{} is not a shipami inventory'.format(path))
+    return db
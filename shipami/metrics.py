@@ -0,0 +1,172 @@
+"""Prometheus metrics computed from one inventory pass
+
+The inventory lists owned images of every region once, plus the launch
+permissions of releases, and all metrics are derived from it in memory.
+Exporter refreshes the inventory in a background thread: scrapes only read
+the last rendering and never call EC2.
+"""
+import calendar
+import collections
+import logging
+import threading
+import time
+
+import dateutil.parser
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+logger = logging.getLogger('shipami.cli')
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def inventory(shipami, regions=None):
+    """Returns (images, launch permissions of releases) for regions"""
+    images = shipami.find_images(regions=regions)
+    for image in images:
+        image.drop_raw()
+    permissions = shipami.launch_permissions([_ for _ in images if _.release])
+    return images, permissions
+
+
+def render(images, permissions, now=None, duration=None):
+    now = now or time.time()
+    regions = sorted(set(_.region for _ in images))
+    lines = []
+
+    counts = collections.Counter(
+        (_.region, _.state, _bool(_.managed), _bool(_.release)) for _ in images
+    )
+    _gauge(lines, 'shipami_images', 'Images by region, state, managed and release status', [
+        ({'region': k[0], 'state': k[1], 'managed': k[2], 'release': k[3]}, v) for k, v in sorted(counts.items())
+    ])
+
+    releases = [_ for _ in images if _.release]
+    _gauge(lines, 'shipami_releases', 'Release images by region', [
+        ({'region': r}, len([_ for _ in releases if _.region == r])) for r in regions
+    ])
+    _gauge(lines, 'shipami_unshared_releases', 'Release images shared with no account', [
+        ({'region': r}, len([_ for _ in releases if _.region == r and not permissions.get(_.id)])) for r in regions
+    ])
+
+    pending = [_ for _ in images if _.state == 'pending' and _.copied_from]
+    _gauge(lines, 'shipami_pending_copy_age_seconds', 'Seconds since a copy still pending was started', [
+        ({'region': _.region, 'image_id': _.id, 'copied_from': _.copied_from[0]}, int(now - _timestamp(_.creation_date)))
+        for _ in sorted(pending, key=lambda _: (_.region, _.id))
+    ])
+
+    _gauge(lines, 'shipami_inventory_timestamp_seconds', 'Time of the inventory', [({}, int(now))])
+    if duration is not None:
+        _gauge(lines, 'shipami_inventory_duration_seconds', 'Time taken by the inventory', [({}, round(duration, 3))])
+    return '\n'.join(lines) + '\n'
+
+
+class Exporter(object):
+    """Keeps the last rendering of an inventory refreshed every interval seconds"""
+
+    def __init__(self, shipami, regions=None, interval=300):
+        self._shipami = shipami
+        self._regions = regions
+        self._interval = interval
+        self._text = ''
+        self._refreshes = 0
+        self._errors = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def refresh(self):
+        started = time.time()
+        try:
+            images, permissions = inventory(self._shipami, self._regions)
+            text = render(images, permissions, duration=time.time() - started)
+        except Exception as e:
+            # botocore raises more than ClientError, e.g. EndpointConnectionError, the exporter keeps going
+            logger.error('inventory failed: {}'.format(e))
+            with self._lock:
+                self._errors += 1
+            return False
+        with self._lock:
+            self._text = text
+            self._refreshes += 1
+        return True
+
+    def text(self):
+        with self._lock:
+            lines = [self._text.rstrip('\n')] if self._text else []
+            _counter(lines, 'shipami_inventory_refreshes_total', 'Successful inventories', self._refreshes)
+            _counter(lines, 'shipami_inventory_errors_total', 'Failed inventories', self._errors)
+        return '\n'.join(lines) + '\n'
+
+    def start(self):
+        self.refresh()
+        self._thread = threading.Thread(target=self.__run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def __run(self):
+        while not self._stop.wait(self._interval):
+            self.refresh()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ['/', '/metrics']:
+            self.send_error(404)
+            return
+        body = self.server.exporter.text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def serve(exporter, address='127.0.0.1', port=9477):
+    server = HTTPServer((address, port), MetricsHandler)
+    server.exporter = exporter
+    exporter.start()
+    logger.info('serving metrics on http://{}:{}/metrics'.format(address, server.server_port))
+    try:
+        server.serve_forever()
+    finally:
+        exporter.stop()
+        server.server_close()
+
+
+def _gauge(lines, name, description, samples):
+    lines.append('# HELP {} {}'.format(name, description))
+    lines.append('# TYPE {} gauge'.format(name))
+    for labels, value in samples:
+        lines.append('{}{} {}'.format(name, _labels(labels), value))
+
+
+def _counter(lines, name, description, value):
+    lines.append('# HELP {} {}'.format(name, description))
+    lines.append('# TYPE {} counter'.format(name))
+    lines.append('{} {}'.format(name, value))
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in sorted(labels.items())]
+    return '{' + ','.join('{}="{}"'.format(k, v) for k, v in escaped) + '}'
+
+
+def _bool(value):
+    return 'true' if value else 'false'
+
+
+def _timestamp(value):
+    return calendar.timegm(dateutil.parser.parse(value).utctimetuple())
@@ -0,0 +1,17 @@
+import errno
+import os
+
+
+def home():
+    return os.environ.get('SHIPAMI_HOME') or os.path.join(os.path.expanduser('~'), '.shipami')
+
+
+def path(*parts):
+    """Returns a path under the shipami home directory, creating its parent"""
+    p = os.path.join(home(), *parts)
+    try:
+        os.makedirs(os.path.dirname(p), 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    return p
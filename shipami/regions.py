@@ -0,0 +1,54 @@
+"""Static region data, kept free of boto3 so completion can use it"""
+import math
+import re
+
+# Approximate location of each region (latitude, longitude)
+LOCATIONS = {
+    'ap-northeast-1': (35.7, 139.7),
+    'ap-northeast-2': (37.6, 127.0),
+    'ap-northeast-3': (34.7, 135.5),
+    'ap-south-1': (19.1, 72.9),
+    'ap-southeast-1': (1.4, 103.8),
+    'ap-southeast-2': (-33.9, 151.2),
+    'ca-central-1': (45.5, -73.6),
+    'eu-central-1': (50.1, 8.7),
+    'eu-north-1': (59.3, 18.1),
+    'eu-west-1': (53.3, -6.3),
+    'eu-west-2': (51.5, -0.1),
+    'eu-west-3': (48.9, 2.3),
+    'sa-east-1': (-23.5, -46.6),
+    'us-east-1': (39.0, -77.5),
+    'us-east-2': (40.0, -83.0),
+    'us-west-1': (37.4, -122.0),
+    'us-west-2': (45.8, -119.7),
+}
+
+REGIONS = tuple(sorted(LOCATIONS))
+
+EARTH_RADIUS_KM = 6371
+
+# us-east-1a, us-gov-west-1b, us-west-2-lax-1a...
+ZONE_PATTERN = re.compile(r'^([a-z]{2}(?:-gov)?-[a-z]+-\d+)')
+
+
+def distance(source, destination):
+    """Great-circle distance in km between two regions
+
+    Regions missing from LOCATIONS are considered close when they share the
+    same geography prefix (eg. "eu-"), and far away otherwise.
+    """
+    if source == destination:
+        return 0
+    if source not in LOCATIONS or destination not in LOCATIONS:
+        return 1000 if source.split('-')[0] == destination.split('-')[0] else 20000
+
+    lat1, lon1 = map(math.radians, LOCATIONS[source])
+    lat2, lon2 = map(math.radians, LOCATIONS[destination])
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return int(2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a)))
+
+
+def zone_region(zone):
+    """Region of an availability zone, None when zone does not look like one"""
+    match = ZONE_PATTERN.match(zone)
+    return match.group(1) if match else None
@@ -0,0 +1,220 @@
+import collections
+import logging
+import threading
+import time
+
+from shipami import waiting
+from shipami.exceptions import CopyLimitExceeded, WaitCancelled, WaitTimeout
+
+logger = logging.getLogger('shipami.cli')
+
+
+class CopyHandle(object):
+    """Tracks one scheduled copy
+
+    status goes from 'queued' to 'copying' and ends as 'available' or
+    'failed'. progress is the destination snapshots progress in percent.
+    """
+
+    def __init__(self, source_image_id, source_region=None, region=None):
+        self.source_image_id = source_image_id
+        self.source_region = source_region
+        self.region = region
+        self.image_id = None
+        self.status = 'queued'
+        self.progress = 0
+        self.attempts = 0
+        self.not_before = 0
+        self.deadline = None
+        self._error = None
+        self._done = threading.Event()
+
+    def __repr__(self):
+        return 'CopyHandle({} -> {}, status={})'.format(self.source_image_id, self.image_id, self.status)
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def result(self, timeout=None):
+        if not self.wait(timeout):
+            raise RuntimeError('copy of {} is still {}'.format(self.source_image_id, self.status))
+        if self._error is not None:
+            raise self._error
+        return self.image_id
+
+    def exception(self, timeout=None):
+        self.wait(timeout)
+        return self._error
+
+    def _finish(self, error=None):
+        self._error = error
+        self.status = 'failed' if error is not None else 'available'
+        if error is None:
+            self.progress = 100
+        self._done.set()
+
+
+class CopyScheduler(object):
+    """Runs many copy_image calls without exceeding per region copy quotas
+
+    At most max_in_flight copies run at the same time in each destination
+    region. A copy holds its slot until the destination image is available.
+    When EC2 answers with a limit error the copy is queued again and the
+    region limit shrinks to what is actually running. It grows back by one
+    every time a copy completes.
+
+    timeout and rollback given to submit() apply to each copy: a copy that
+    is not available in time fails with WaitTimeout and, with rollback, is
+    deregistered, including the waits copy() makes itself for
+    copy_permissions, copy_tags_to_snapshots or incremental copies, which
+    get what is left of the timeout. A copy refused max_attempts times, or whose next attempt
+    would start after its timeout, fails with CopyLimitExceeded.
+    """
+
+    DEFAULT_MAX_IN_FLIGHT = 5
+    DEFAULT_MAX_ATTEMPTS = 10
+    DEFAULT_RETRY_DELAY = 30
+
+    def __init__(self, shipami, max_in_flight=None, poll_delay=waiting.MIN_DELAY, retry_delay=None, cancel=None, max_attempts=None, clock=waiting.CLOCK):
+        self._shipami = shipami
+        # copies are timed and polled with clock, the queue always runs on wall time
+        self._clock = clock
+        self._max_in_flight = max_in_flight or self.DEFAULT_MAX_IN_FLIGHT
+        self._max_attempts = max_attempts or self.DEFAULT_MAX_ATTEMPTS
+        self._poll_delay = poll_delay
+        self._retry_delay = retry_delay or self.DEFAULT_RETRY_DELAY
+        self._cancel = cancel
+        self._limits = {}
+        self._in_flight = collections.defaultdict(int)
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._dispatcher = None
+
+    def submit(self, image_id, source_region=None, region=None, **kwargs):
+        kwargs.pop('wait', None)
+        handle = CopyHandle(image_id, source_region, region)
+        # time spent queued and retried counts against the timeout
+        handle.deadline = waiting.deadline(kwargs.pop('timeout', None), self._clock)
+        with self._cond:
+            self._queue.append((handle, kwargs))
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(target=self.__dispatch)
+                self._dispatcher.daemon = True
+                self._dispatcher.start()
+            self._cond.notify_all()
+        return handle
+
+    def limit(self, region):
+        return self._limits.get(region, self._max_in_flight)
+
+    def __dispatch(self):
+        with self._cond:
+            while self._queue or any(self._in_flight.values()):
+                now = time.time()
+                ready, delay = None, None
+                for entry in self._queue:
+                    handle = entry[0]
+                    if self._in_flight[handle.region] >= self.limit(handle.region):
+                        continue
+                    if handle.not_before > now:
+                        wait = handle.not_before - now
+                        delay = wait if delay is None else min(delay, wait)
+                        continue
+                    ready = entry
+                    break
+
+                if ready is None:
+                    self._cond.wait(delay)
+                    continue
+
+                self._queue.remove(ready)
+                self._in_flight[ready[0].region] += 1
+                worker = threading.Thread(target=self.__run, args=ready)
+                worker.daemon = True
+                worker.start()
+            self._dispatcher = None
+
+    def __run(self, handle, kwargs):
+        handle.attempts += 1
+        started = self._clock.time()
+        rollback = kwargs.get('rollback', False)
+        if self._cancel is not None and self._cancel.is_set():
+            self.__release(handle, WaitCancelled('cancelled before copying {} to {}'.format(handle.source_image_id, handle.region)))
+            return
+        timeout = None
+        if handle.deadline is not None:
+            timeout = handle.deadline - self._clock.time()
+            if timeout <= 0:
+                self.__release(handle, WaitTimeout('timed out waiting for copy of {} to {}'.format(handle.source_image_id, handle.region)))
+                return
+        try:
+            # copies which wait themselves, e.g. with copy_permissions, get what is left of the timeout
+            handle.image_id = self._shipami.copy(
+                handle.source_image_id,
+                source_region=handle.source_region,
+                region=handle.region,
+                wait=False,
+                record=False,
+                timeout=timeout,
+                **kwargs
+            )
+        except CopyLimitExceeded as e:
+            if handle.attempts >= self._max_attempts or (handle.deadline is not None and self._clock.time() + self._retry_delay >= handle.deadline):
+                logger.error('giving up copy of {} to {} after {} attempts: {}'.format(handle.source_image_id, handle.region, handle.attempts, e))
+                self.__release(handle, e)
+                return
+            with self._cond:
+                running = self._in_flight[handle.region] - 1
+                logger.debug('copy limit reached in {} with {} copies running: {}'.format(handle.region, running, e))
+                self._limits[handle.region] = max(1, running)
+                self._in_flight[handle.region] -= 1
+                handle.not_before = time.time() + self._retry_delay
+                self._queue.appendleft((handle, kwargs))
+                self._cond.notify_all()
+            return
+        except Exception as e:
+            self.__release(handle, e)
+            return
+
+        handle.status = 'copying'
+        logger.debug('copying {} to {} ({})'.format(handle.source_image_id, handle.image_id, handle.region))
+        copied = self._clock.time()
+
+        def check():
+            state, handle.progress = self._shipami.progress(handle.image_id, handle.region)
+            if state is None and self._clock.time() - copied >= waiting.NOT_FOUND_GRACE:
+                raise RuntimeError('copy {} of {} does not exist'.format(handle.image_id, handle.source_image_id))
+            if state in ('failed', 'error', 'invalid', 'deregistered'):
+                raise RuntimeError('copy of {} to {} is {}'.format(handle.source_image_id, handle.image_id, state))
+            return state == 'available', handle.progress
+
+        try:
+            waiting.poll(check, 'copy {}'.format(handle.image_id), deadline=handle.deadline, cancel=self._cancel, min_delay=self._poll_delay, clock=self._clock)
+        except (WaitTimeout, WaitCancelled) as e:
+            if rollback:
+                try:
+                    self._shipami.rollback(handle.image_id, handle.region)
+                except Exception as rollback_error:
+                    logger.error(str(rollback_error))
+            self.__release(handle, e)
+            return
+        except Exception as e:
+            self.__release(handle, e)
+            return
+        try:
+            self._shipami.record_copy(handle.source_image_id, handle.source_region, handle.region, self._clock.time() - started, kwargs.get('incremental', False))
+        except Exception as e:
+            logger.debug('could not record copy of {}: {}'.format(handle.source_image_id, e))
+        finally:
+            self.__release(handle)
+
+    def __release(self, handle, error=None):
+        with self._cond:
+            self._in_flight[handle.region] -= 1
+            if error is None and self.limit(handle.region) < self._max_in_flight:
+                self._limits[handle.region] = self.limit(handle.region) + 1
+            handle._finish(error)
+            self._cond.notify_all()
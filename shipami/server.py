@@ -0,0 +1,188 @@
+import io
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from shipami import client
+from shipami.core import ShipAMI
+
+logger = logging.getLogger('shipami.cli')
+
+_streams_lock = threading.Lock()
+
+
+class ThreadStream(object):
+    """Stands for sys.stdout, sys.stderr or sys.stdin, each request thread using its own stream"""
+
+    def __init__(self, default):
+        self._default = default
+        self._local = threading.local()
+
+    def set(self, stream):
+        self._local.stream = stream
+
+    def __getattr__(self, name):
+        return getattr(getattr(self._local, 'stream', None) or self._default, name)
+
+
+class FrameWriter(io.RawIOBase):
+    """Sends what is written to the client as {name: text} lines
+
+    A client that went away is ignored so that the command still completes.
+    """
+
+    def __init__(self, wfile, name, lock):
+        self._wfile = wfile
+        self._name = name
+        self._lock = lock
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        send(self._wfile, {self._name: bytes(data).decode('utf-8', 'replace')}, self._lock)
+        return len(data)
+
+
+def send(wfile, message, lock):
+    with lock:
+        try:
+            wfile.write(json.dumps(message).encode('utf-8') + b'\n')
+            wfile.flush()
+        except (IOError, OSError, socket.error) as e:
+            logger.debug('client went away: {}'.format(e))
+
+
+def redirect(name, stream):
+    """Makes sys.<name> write to, or read from, stream in the current thread"""
+    with _streams_lock:
+        current = getattr(sys, name)
+        if not isinstance(current, ThreadStream):
+            current = ThreadStream(current)
+            setattr(sys, name, current)
+    current.set(stream)
+
+
+class WarmShipAMI(ShipAMI):
+    """ShipAMI keeping list results for cache_ttl seconds, or until a local command changed images"""
+
+    def __init__(self, *args, **kwargs):
+        self.cache_ttl = kwargs.pop('cache_ttl', 60)
+        super(WarmShipAMI, self).__init__(*args, **kwargs)
+        self._inventory = {}
+
+    def list(self, include_executable_images=False):
+        cached = self._inventory.get(include_executable_images)
+        # commands run outside of the daemon leave a stamp when they may have changed images
+        if cached and time.time() - cached[0] < self.cache_ttl and client.changed_at() < cached[0]:
+            logger.debug('using cached inventory for {}'.format(self.region))
+            return list(cached[1])
+
+        images = super(WarmShipAMI, self).list(include_executable_images)
+        self._inventory[include_executable_images] = (time.time(), images)
+        return list(images)
+
+    def invalidate(self):
+        self._inventory.clear()
+
+
+class WarmPool(object):
+    """Hands out one WarmShipAMI per profile, region and role"""
+
+    def __init__(self, cache_ttl=60):
+        self.cache_ttl = cache_ttl
+        self._instances = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, profile=None, region=None, role_arn=None):
+        key = (profile, region, role_arn)
+        with self._lock:
+            if key not in self._instances:
+                self._instances[key] = WarmShipAMI(profile, region, role_arn=role_arn, cache_ttl=self.cache_ttl)
+            return self._instances[key]
+
+    def invalidate(self):
+        with self._lock:
+            for instance in self._instances.values():
+                instance.invalidate()
+
+
+class ShipAMIServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Runs forwarded commands, each in its own thread and at the same time
+
+    Output is streamed to the client as the command writes it. Commands get
+    an empty stdin, the client runs the ones that prompt, log with -v or
+    write files itself.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, cli, cache_ttl=60):
+        self.cli = cli
+        self.pool = WarmPool(cache_ttl)
+        self.environ = client.aws_environ()
+        if os.path.exists(path):
+            os.unlink(path)
+        socketserver.UnixStreamServer.__init__(self, path, RequestHandler)
+        os.chmod(path, 0o600)
+
+    def run(self, argv, stdout, stderr):
+        """Runs argv like `shipami` would, writing to stdout and stderr, returns its exit code"""
+        name = client.parse_command(self.cli, argv)[0]
+        redirect('stdout', stdout)
+        redirect('stderr', stderr)
+        redirect('stdin', io.StringIO())
+        try:
+            self.cli.main(args=list(argv), prog_name='shipami', obj=self.pool)
+            exit_code = 0
+        except SystemExit as e:
+            exit_code = e.code if isinstance(e.code, int) else int(e.code is not None)
+        except Exception as e:
+            logger.debug('{} failed'.format(' '.join(argv)), exc_info=True)
+            stderr.write('Error: {}\n'.format(e))
+            exit_code = 1
+        finally:
+            for _ in ('stdout', 'stderr', 'stdin'):
+                redirect(_, None)
+        if name not in client.READ_COMMANDS:
+            self.pool.invalidate()
+        return exit_code
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+        except ValueError:
+            return
+
+        lock = threading.Lock()
+        if request.get('env') != self.server.environ:
+            logger.debug('AWS environment differs from the daemon, client must run locally')
+            send(self.wfile, {'fallback': True}, lock)
+            return
+
+        logger.debug('running {}'.format(' '.join(request['argv'])))
+        stdout, stderr = [io.TextIOWrapper(FrameWriter(self.wfile, _, lock), encoding='utf-8', write_through=True) for _ in ('stdout', 'stderr')]
+        exit_code = self.server.run(request['argv'], stdout, stderr)
+        send(self.wfile, {'exit_code': exit_code}, lock)
+
+
+def serve(path, cli, cache_ttl=60):
+    server = ShipAMIServer(path, cli, cache_ttl)
+    logger.info('listening on {}'.format(path))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(path)
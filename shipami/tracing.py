@@ -0,0 +1,108 @@
+"""Lightweight spans exported as a Chrome trace
+
+Spans are only recorded between start() and stop(). The resulting file can
+be opened in chrome://tracing or https://ui.perfetto.dev to see where time
+goes during a copy or a release.
+"""
+import json
+import os
+import threading
+import time
+
+_tracer = None
+
+
+class Span(object):
+
+    __slots__ = ('name', 'attributes', 'start', 'end', 'thread')
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.thread = threading.current_thread()
+        self.start = time.time()
+        self.end = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end = time.time()
+        if exc_type is not None:
+            self.attributes['error'] = str(exc_value)
+        if _tracer is not None:
+            _tracer.add(self)
+        return False
+
+
+class NoopSpan(object):
+
+    def set(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class Tracer(object):
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def events(self):
+        pid = os.getpid()
+        events = []
+        threads = {}
+        for span in sorted(self.spans, key=lambda _: _.start):
+            threads[span.thread.ident] = span.thread.name
+            events.append({
+                'name': span.name,
+                'cat': 'shipami',
+                'ph': 'X',
+                'ts': int(span.start * 1e6),
+                'dur': int((span.end - span.start) * 1e6),
+                'pid': pid,
+                'tid': span.thread.ident,
+                'args': span.attributes
+            })
+        for tid, name in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}})
+        return events
+
+    def export(self, path):
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.events(), 'displayTimeUnit': 'ms'}, f, default=str)
+
+
+def span(name, **attributes):
+    if _tracer is None:
+        return NOOP_SPAN
+    return Span(name, attributes)
+
+
+def start():
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def stop(path=None):
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is not None and path:
+        tracer.export(path)
+    return tracer
@@ -0,0 +1,72 @@
+import logging
+import time
+
+from shipami.exceptions import WaitCancelled, WaitTimeout
+
+logger = logging.getLogger('shipami.cli')
+
+MIN_DELAY = 1
+MAX_DELAY = 30
+BACKOFF = 1.5
+# seconds a fresh copy may stay invisible before it is considered gone
+NOT_FOUND_GRACE = 60
+
+
+class Clock(object):
+    """Wall time, waits end early when cancel is set"""
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds, cancel=None):
+        if cancel is not None:
+            cancel.wait(seconds)
+        else:
+            time.sleep(seconds)
+
+
+CLOCK = Clock()
+
+
+def deadline(timeout, clock=CLOCK):
+    return clock.time() + timeout if timeout else None
+
+
+def poll(check, description, deadline=None, cancel=None, min_delay=MIN_DELAY, max_delay=MAX_DELAY, backoff=BACKOFF, clock=CLOCK):
+    """Calls check() until it returns (True, progress)
+
+    check returns (done, progress) where progress is a percentage or None.
+    Polling starts every min_delay seconds and backs off up to max_delay.
+    Once progress moves, the next poll is scheduled around half of the
+    estimated remaining time instead. deadline and delays are in the time
+    of clock.
+    """
+    delay = min_delay
+    first = None
+
+    try:
+        while True:
+            if cancel is not None and cancel.is_set():
+                raise WaitCancelled('cancelled while waiting for {}'.format(description))
+
+            done, progress = check()
+            if done:
+                return
+            now = clock.time()
+            if deadline is not None and now >= deadline:
+                raise WaitTimeout('timed out waiting for {}{}'.format(description, ' ({}%)'.format(progress) if progress is not None else ''))
+
+            if progress is not None and first is None:
+                first = (now, progress)
+            if progress is not None and progress > first[1] and now > first[0]:
+                rate = (progress - first[1]) / (now - first[0])
+                delay = min(max_delay, max(min_delay, (100 - progress) / rate / 2))
+            else:
+                delay = min(max_delay, delay * backoff)
+            if deadline is not None:
+                delay = max(0, min(delay, deadline - now))
+
+            logger.debug('{} not ready{}, next check in {:.1f}s'.format(description, ' ({}%)'.format(progress) if progress is not None else '', delay))
+            clock.sleep(delay, cancel)
+    except KeyboardInterrupt:
+        raise WaitCancelled('interrupted while waiting for {}'.format(description))
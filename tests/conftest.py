@@ -0,0 +1,5 @@
+import pytest
+
+@pytest.fixture(autouse=True)
+def shipami_home(tmpdir, monkeypatch):
+    monkeypatch.setenv('SHIPAMI_HOME', str(tmpdir.mkdir('shipami')))
@@ -161,6 +161,47 @@ class TestCli:
         assert len(lines) == 1
         assert released_image.id in lines[0]
 
+    def test_list_shared(self, ec2, base_image, released_image):
+        r = runner.invoke(shipami, ['share', released_image.id, '--account-id', '111111111111'])
+        assert r.exit_code == 0
+
+        r = runner.invoke(shipami, ['list', '-f', 'shared=yes'])
+
+        lines = r.output.splitlines()
+        assert r.exit_code == 0
+        assert 'SHARED' in lines[0]
+        assert len(lines) == 2
+        assert ' {} '.format(released_image.id) in lines[1]
+
+        released_image.modify_attribute(Attribute='launchPermission', OperationType='remove', UserIds=['111111111111'])
+        base_image.modify_attribute(Attribute='launchPermission', OperationType='add', UserIds=['222222222222'])
+        r = runner.invoke(shipami, ['list', '--verify', '-q', '-f', 'shared=yes'])
+
+        assert r.exit_code == 0
+        assert '{}: shares were accounts=1,marketplace=no, now accounts=0,marketplace=no'.format(released_image.id) in r.output
+        assert '{}: shares were unknown, now accounts=1,marketplace=no'.format(base_image.id) in r.output
+        assert r.output.splitlines()[-1] == base_image.id
+
+    def test_list_verify_all(self, base_image):
+        r = runner.invoke(shipami, ['list', '--verify', '--all'])
+
+        assert r.exit_code == 2
+
+    def test_list_accounts(self, base_image):
+        import moto
+
+        moto.mock_sts().start()
+        accounts = ['arn:aws:iam::123456789012:role/a', 'arn:aws:iam::123456789012:role/b']
+
+        r = runner.invoke(shipami, ['list', '--account', accounts[0], '--account', accounts[1]])
+
+        lines = r.output.splitlines()
+
+        assert r.exit_code == 0
+        assert lines[0].split()[0] == 'ACCOUNT'
+        assert len(lines) == 3
+        assert all(base_image.id in _ and _.split()[0] == '123456789012' for _ in lines[1:])
+
     def test_show_unmanaged(self, base_image):
         r = runner.invoke(shipami, ['show', base_image.id])
 
@@ -254,6 +295,47 @@ class TestCli:
         assert image.name == base_image.name
         assert sorted(image.tags, key=lambda _: _['Key']) == sorted(expected_tags, key=lambda _: _['Key'])
 
+    def test_copy_multiple(self, ec2, base_image):
+        image_number = len(ec2.meta.client.describe_images()['Images'])
+
+        r = runner.invoke(shipami, ['copy', base_image.id, base_image.id])
+
+        returned_image_ids = r.output.split()
+
+        assert r.exit_code == 0
+        assert len(returned_image_ids) == 2
+        assert len(ec2.meta.client.describe_images()['Images']) == image_number + 2
+        for image_id in returned_image_ids:
+            assert ec2.Image(image_id).state == 'available'
+
+    def test_copy_trace(self, ec2, base_image, tmpdir):
+        trace = str(tmpdir.join('trace.json'))
+
+        r = runner.invoke(shipami, ['--trace', trace, 'copy', base_image.id, '--wait'])
+
+        with open(trace) as f:
+            names = [_['name'] for _ in json.load(f)['traceEvents'] if _['ph'] == 'X']
+
+        assert r.exit_code == 0
+        assert set(['copy', 'copy_image', 'tag', 'wait_for_image']) <= set(names)
+
+    def test_copy_lineage_tags(self, ec2, base_image):
+        r = runner.invoke(shipami, ['copy', base_image.id, base_image.id])
+
+        copies = ['eu-west-1:{}'.format(_) for _ in r.output.split()]
+        base_image.reload()
+        tags = dict((_['Key'], _['Value']) for _ in base_image.tags)
+
+        assert r.exit_code == 0
+        assert 'shipami:copied_to' not in tags
+        for copy in copies:
+            assert tags['shipami:copied_to:' + copy] == copy
+
+        r = runner.invoke(shipami, ['list'])
+        base_line = [_ for _ in r.output.splitlines() if base_image.id + ' ' in _][0]
+
+        assert ','.join(sorted(copies)) in base_line
+
     def test_copy_invalid_name(self, base_image):
         NAME = 'aa'
 
@@ -308,6 +390,108 @@ class TestCli:
         assert image.name == NAME
         assert sorted(image.tags, key=lambda _: _['Key']) == sorted(expected_tags, key=lambda _: _['Key'])
 
+    def test_release_in_place(self, ec2, copied_image):
+        image_number = len(ec2.meta.client.describe_images()['Images'])
+
+        r = runner.invoke(shipami, ['release', copied_image.id, '2.0.0', '--in-place', '--name', 'foo-2.0.0'])
+
+        assert r.exit_code == 0
+        assert r.output.strip() == copied_image.id
+        assert len(ec2.meta.client.describe_images()['Images']) == image_number
+        copied_image.reload()
+        tags = dict((_['Key'], _['Value']) for _ in copied_image.tags)
+        assert tags['shipami:release'] == '2.0.0'
+        assert tags['shipami:name'] == 'foo-2.0.0'
+
+    def test_release_in_place_unmanaged(self, ec2, base_image):
+        r = runner.invoke(shipami, ['release', base_image.id, '2.0.0', '--in-place'])
+
+        assert r.exit_code == 1
+        assert 'not managed' in r.output
+
+    def test_sync(self, ec2, released_image):
+        r = runner.invoke(shipami, ['sync', '1.0.0', '--regions', 'eu-west-1,us-east-1'])
+
+        lines = [_.split('\t') for _ in r.output.splitlines()]
+
+        assert r.exit_code == 0
+        assert lines[0] == ['eu-west-1', released_image.id, 'present']
+        assert lines[1][0] == 'us-east-1' and lines[1][2] == 'copied'
+
+        r = runner.invoke(shipami, ['sync', '1.0.0', '-r', 'eu-west-1', '-r', 'us-east-1'])
+
+        assert r.exit_code == 0
+        assert [_.split('\t')[2] for _ in r.output.splitlines()] == ['present', 'present']
+
+    def test_tag_filter(self, ec2, base_image, released_image):
+        r = runner.invoke(shipami, ['tag', '-f', 'release=1.0.0', '--add', 'deprecated=true', '--snapshots'])
+
+        assert r.exit_code == 0
+        assert r.output.split() == ['eu-west-1', released_image.id]
+        released_image.reload()
+        base_image.reload()
+        assert {'Key': 'deprecated', 'Value': 'true'} in released_image.tags
+        assert 'deprecated' not in [_['Key'] for _ in base_image.tags or []]
+        snapshot = ec2.Snapshot(released_image.block_device_mappings[0]['Ebs']['SnapshotId'])
+        assert {'Key': 'deprecated', 'Value': 'true'} in snapshot.tags
+
+        r = runner.invoke(shipami, ['tag', released_image.id, '--remove', 'deprecated'])
+
+        assert r.exit_code == 0
+        released_image.reload()
+        assert 'deprecated' not in [_['Key'] for _ in released_image.tags]
+
+    def test_tag_no_selection(self, ec2, base_image):
+        r = runner.invoke(shipami, ['tag', '--add', 'foo=bar'])
+
+        assert r.exit_code == 2
+        base_image.reload()
+        assert not base_image.tags
+
+    def test_replicate_invalid_account(self, ec2, base_image):
+        r = runner.invoke(shipami, ['replicate', base_image.id, '--accounts', '111111111111,production'])
+
+        assert r.exit_code == 1
+        assert 'production is neither an account id nor a role ARN' in r.output
+
+    def test_snapshot_diff(self, ec2, base_image, tmpdir):
+        old, new = str(tmpdir.join('old.db')), str(tmpdir.join('new.db'))
+        r = runner.invoke(shipami, ['snapshot', 'export', old])
+        assert r.exit_code == 0
+
+        base_image.create_tags(Tags=[{'Key': 'team', 'Value': 'ops'}])
+        r = runner.invoke(shipami, ['snapshot', 'export', new])
+        assert r.exit_code == 0
+
+        r = runner.invoke(shipami, ['diff', old, new])
+
+        assert r.exit_code == 0
+        assert r.output == '~ eu-west-1\t{}\ttag team: None -> ops\n'.format(base_image.id)
+
+    def test_fsr_usage(self, ec2, base_image):
+        r = runner.invoke(shipami, ['fsr', '--zones', 'eu-west-1a'])
+        assert r.exit_code == 2
+
+        r = runner.invoke(shipami, ['fsr', base_image.id, '--zones', 'eu-west-1a,west'])
+        assert r.exit_code == 2
+        assert 'west is not an availability zone' in r.output
+
+    def test_metrics(self, ec2, base_image, released_image, tmpdir):
+        output = str(tmpdir.join('shipami.prom'))
+        r = runner.invoke(shipami, ['metrics', '-o', output])
+
+        assert r.exit_code == 0
+        with open(output) as f:
+            text = f.read()
+        assert 'shipami_releases{region="eu-west-1"} 1' in text
+        assert 'shipami_unshared_releases{region="eu-west-1"} 1' in text
+
+    def test_watch(self, ec2, copied_image):
+        r = runner.invoke(shipami, ['watch', 'eu-west-1:{}'.format(copied_image.id)])
+
+        assert r.exit_code == 0
+        assert r.output.splitlines()[1].split() == ['eu-west-1', copied_image.id, 'available', '100%', '0:00:00']
+
     def test_delete(self, ec2, copied_image):
         copied_image_id = copied_image.id
         r = runner.invoke(shipami, ['delete', copied_image_id])
@@ -318,6 +502,31 @@ class TestCli:
         assert len(ec2.meta.client.describe_images()['Images']) == 1
         assert returned_image_id == copied_image_id
 
+    def test_delete_cascade(self, ec2, base_image, copied_image):
+        r = runner.invoke(shipami, ['delete', '--cascade', '-f', base_image.id], input='n\n')
+
+        assert r.exit_code == 1
+        assert len(ec2.meta.client.describe_images()['Images']) == 2
+
+        r = runner.invoke(shipami, ['delete', '--cascade', '-f', '--yes', base_image.id])
+
+        assert r.exit_code == 0
+        assert r.output.splitlines()[-2:] == [copied_image.id, base_image.id]
+        assert ec2.meta.client.describe_images()['Images'] == []
+
+    def test_delete_legacy_lineage(self, ec2, base_image, copied_image):
+        other = 'eu-west-1:ami-12345678'
+        ec2.meta.client.delete_tags(Resources=[base_image.id], Tags=[{'Key': 'shipami:copied_to:eu-west-1:{}'.format(copied_image.id)}])
+        base_image.create_tags(Tags=[{'Key': 'shipami:copied_to', 'Value': 'eu-west-1:{},{}'.format(copied_image.id, other)}])
+
+        r = runner.invoke(shipami, ['delete', copied_image.id])
+
+        base_image.reload()
+        tags = dict((_['Key'], _['Value']) for _ in base_image.tags)
+
+        assert r.exit_code == 0
+        assert tags['shipami:copied_to'] == other
+
     def test_delete_aliased(self, ec2, copied_image):
         copied_image_id = copied_image.id
         r = runner.invoke(shipami, ['rm', copied_image_id])
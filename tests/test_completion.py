@@ -0,0 +1,69 @@
+import os
+import subprocess
+import sys
+import threading
+
+from shipami import completion, paths
+from shipami.core import ImageRecord
+
+
+def record(image_id, name, release=None):
+    tags = [{'Key': 'shipami:release', 'Value': release}] if release else []
+    return ImageRecord({'ImageId': image_id, 'Name': name, 'Tags': tags})
+
+
+class TestCompletion:
+
+    def setup_method(self, method):
+        completion.update_index(None, 'eu-west-1', [
+            record('ami-00000001', 'foo'),
+            record('ami-00000002', 'bar', '1.0.0')
+        ])
+        completion.update_index(None, 'us-east-1', [
+            record('ami-00000003', 'baz', '2.0.0')
+        ])
+
+    def test_image_ids(self):
+        result = completion.complete_image_ids(None, ['--region', 'eu-west-1', 'show'], 'ami-')
+
+        assert result == [('ami-00000001', 'foo'), ('ami-00000002', 'bar')]
+
+    def test_image_names(self):
+        result = completion.complete_image_ids(None, ['--region', 'eu-west-1', 'show'], 'ba')
+
+        assert result == [('ami-00000002', 'bar')]
+
+    def test_image_ids_unknown_region(self):
+        result = completion.complete_image_ids(None, ['--region', 'sa-east-1', 'show'], 'ami-')
+
+        assert [_[0] for _ in result] == ['ami-00000001', 'ami-00000002', 'ami-00000003']
+
+    def test_releases(self):
+        assert completion.complete_releases(None, ['--region=us-east-1'], '') == ['2.0.0']
+
+    def test_regions(self):
+        assert completion.complete_regions(None, [], 'eu-west-') == ['eu-west-1', 'eu-west-2', 'eu-west-3']
+
+    def test_concurrent_updates(self):
+        regions = ['region-{}'.format(_) for _ in range(20)]
+        threads = [threading.Thread(target=completion.update_index, args=('other', _, [record('ami-00000004', 'qux')])) for _ in regions]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert completion.complete_regions(None, [], 'region-') == sorted(regions)
+        assert os.listdir(os.path.dirname(paths.path(completion.INDEX_FILE))) == [completion.INDEX_FILE]
+
+    def test_shell_completion_without_boto3(self):
+        env = dict(os.environ, _SHIPAMI_COMPLETE='complete', COMP_WORDS='shipami --region eu-west-1 rm ami-', COMP_CWORD='4')
+        code = (
+            'import sys\n'
+            'sys.modules["boto3"] = sys.modules["botocore"] = None\n'
+            'from shipami.cli import cli\n'
+            'cli(prog_name="shipami")\n'
+        )
+        p = subprocess.Popen([sys.executable, '-c', code], env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = p.communicate()
+
+        assert out.decode().split() == ['ami-00000001', 'ami-00000002']
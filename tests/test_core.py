@@ -0,0 +1,759 @@
+import json
+import threading
+
+import pytest
+
+from shipami import history, paths
+from shipami.core import ImageRecord, ShipAMI
+from shipami.exceptions import PreflightError, WaitCancelled, WaitTimeout
+from shipami.fake import FakeEC2, FakeError, ManualClock
+from shipami.scheduler import CopyScheduler
+
+IMAGE = {
+    'ImageId': 'ami-00000001',
+    'Name': 'foo',
+    'State': 'available',
+    'CreationDate': '2017-01-01T00:00:00.000Z',
+    'OwnerId': '123456789012',
+    'Tags': [
+        {'Key': 'shipami:managed', 'Value': 'True'},
+        {'Key': 'shipami:release', 'Value': '1.0.0'},
+        {'Key': 'shipami:copied_from', 'Value': 'eu-west-1:ami-00000000'},
+        {'Key': 'shipami:copied_to', 'Value': 'us-east-1:ami-00000002,us-west-2:ami-00000003'}
+    ]
+}
+
+class TestImageRecord:
+
+    def test_fields(self):
+        record = ImageRecord(IMAGE, 'eu-west-1')
+
+        assert record.id == 'ami-00000001'
+        assert record.region == 'eu-west-1'
+        assert record.managed is True
+        assert record.release == '1.0.0'
+        assert record.copied_from == ['eu-west-1:ami-00000000']
+        assert record.copied_to == ['us-east-1:ami-00000002', 'us-west-2:ami-00000003']
+
+    def test_unmanaged(self):
+        record = ImageRecord({'ImageId': 'ami-00000000'})
+
+        assert record.managed is False
+        assert record.release is None
+        assert record.copied_from == []
+        assert record.copied_to == []
+
+    def test_slots(self):
+        record = ImageRecord(IMAGE)
+
+        with pytest.raises(AttributeError):
+            record.foo = 'bar'
+
+    def test_drop_raw(self):
+        record = ImageRecord(dict(IMAGE, BlockDeviceMappings=[{'DeviceName': '/dev/xvda'}]))
+        assert record.block_device_mappings
+
+        record.drop_raw()
+
+        assert record.raw is None
+        assert record.block_device_mappings == []
+        assert record.release == '1.0.0'
+
+    def test_copied_to_per_destination_tags(self):
+        image = dict(IMAGE, Tags=IMAGE['Tags'] + [
+            {'Key': 'shipami:copied_to:ap-southeast-1:ami-00000004', 'Value': 'ap-southeast-1:ami-00000004'},
+            {'Key': 'shipami:copied_to:us-east-1:ami-00000002', 'Value': 'us-east-1:ami-00000002'}
+        ])
+        record = ImageRecord(image)
+
+        assert record.copied_to == ['us-east-1:ami-00000002', 'us-west-2:ami-00000003', 'ap-southeast-1:ami-00000004']
+
+
+def released_image(fake, region, release, name='foo'):
+    image_id = fake.add_image(region, name)
+    fake.images[region][image_id]['Tags'] = [
+        {'Key': 'shipami:managed', 'Value': 'True'},
+        {'Key': 'shipami:release', 'Value': release}
+    ]
+    return image_id
+
+
+class TestSync:
+
+    def test_sync(self):
+        fake = FakeEC2()
+        origin = released_image(fake, 'eu-west-1', '2.4.1')
+        shipami = ShipAMI(region='eu-west-1', session_factory=fake.session)
+
+        result = shipami.sync('2.4.1', ['eu-west-1', 'us-east-1', 'ap-southeast-2'])
+
+        assert result[0] == ('eu-west-1', origin, False, None)
+        assert [(_[0], _[2], _[3]) for _ in result[1:]] == [('us-east-1', True, None), ('ap-southeast-2', True, None)]
+        assert fake.calls['CopyImage'] == 2
+        for region, image_id, copied, error in result[1:]:
+            tags = dict((_['Key'], _['Value']) for _ in fake.images[region][image_id]['Tags'])
+            assert tags['shipami:release'] == '2.4.1'
+
+        second = shipami.sync('2.4.1', ['eu-west-1', 'us-east-1', 'ap-southeast-2'])
+
+        assert fake.calls['CopyImage'] == 2
+        assert [_[1] for _ in second] == [_[1] for _ in result]
+        assert not any(_[2] for _ in second)
+
+    def test_sync_closest_source(self):
+        fake = FakeEC2()
+        released_image(fake, 'us-east-1', '1.0')
+        singapore = released_image(fake, 'ap-southeast-1', '1.0')
+        shipami = ShipAMI(region='us-east-1', session_factory=fake.session)
+
+        result = shipami.sync('1.0', ['ap-southeast-1', 'ap-southeast-2'])
+
+        tags = dict((_['Key'], _['Value']) for _ in fake.images['ap-southeast-2'][result[1][1]]['Tags'])
+        assert tags['shipami:copied_from'] == 'ap-southeast-1:' + singapore
+
+    def test_sync_partial_failure(self, monkeypatch):
+        fake = FakeEC2()
+        released_image(fake, 'eu-west-1', '1.0')
+        shipami = ShipAMI(region='eu-west-1', session_factory=fake.session)
+        release = shipami.release
+
+        def failing_release(image_id, name, region=None, **kwargs):
+            if region == 'us-east-1':
+                raise RuntimeError('boom')
+            return release(image_id, name, region=region, **kwargs)
+        monkeypatch.setattr(shipami, 'release', failing_release)
+
+        result = shipami.sync('1.0', ['us-east-1', 'ap-southeast-2'])
+
+        assert result == [
+            ('us-east-1', None, False, 'boom'),
+            ('ap-southeast-2', list(fake.images['ap-southeast-2'])[0], True, None)
+        ]
+
+    def test_sync_unknown_release(self):
+        shipami = ShipAMI(region='us-east-1', session_factory=FakeEC2().session)
+
+        with pytest.raises(RuntimeError):
+            shipami.sync('1.0', ['eu-west-1'])
+
+
+class TestTag:
+
+    def test_batches(self):
+        fake = FakeEC2()
+        for region in ['eu-west-1', 'us-east-1']:
+            for i in range(3):
+                fake.add_image(region, 'foo-{}'.format(i))
+        shipami = ShipAMI(region='eu-west-1', session_factory=fake.session)
+        shipami.MAX_TAG_RESOURCES = 2
+
+        images = shipami.find_images(regions=['eu-west-1', 'us-east-1'])
+        shipami.tag(images, add={'deprecated': 'true'}, remove=['shipami:release'], snapshots=True)
+
+        # 3 images and 3 snapshots per region
+        assert fake.calls['CreateTags'] == 6
+        assert fake.calls['DeleteTags'] == 6
+        for region in ['eu-west-1', 'us-east-1']:
+            for resource in list(fake.images[region].values()) + list(fake.snapshots[region].values()):
+                assert {'Key': 'deprecated', 'Value': 'true'} in resource['Tags']
+
+
+class TestCascade:
+
+    def test_delete_cascade(self):
+        clock = ManualClock()
+        fake = FakeEC2(copy_seconds=60, clock=clock)
+        origin = fake.add_image('eu-west-1', 'foo')
+        shipami = ShipAMI(region='eu-west-1', session_factory=fake.session, clock=clock)
+        first = shipami.copy(origin, region='us-east-1', wait=True)
+        second = shipami.copy(first, source_region='us-east-1', region='ap-southeast-2')
+        third = shipami.copy(first, source_region='us-east-1', region='us-east-1')
+
+        levels = ShipAMI(region='us-east-1', session_factory=fake.session, clock=clock).descendants([first])
+
+        assert [sorted(_.id for _ in level) for level in levels] == [[first], sorted([second, third])]
+
+        deleted = ShipAMI(region='us-east-1', session_factory=fake.session, clock=clock).delete([first], cascade=True)
+
+        assert deleted[-1] == first and sorted(deleted[:2]) == sorted([second, third])
+        # the pending copies were waited for, so all their snapshots went with them
+        assert not fake.images['us-east-1'] and not fake.images['ap-southeast-2']
+        assert not fake.snapshots['us-east-1'] and not fake.snapshots['ap-southeast-2']
+        assert shipami.list()[0].copied_to == []
+
+    def test_delete_cascade_partial(self):
+        clock = ManualClock()
+        fake = FakeEC2(copy_seconds=60, clock=clock)
+        origin = fake.add_image('eu-west-1', 'foo')
+        shipami = ShipAMI(region='eu-west-1', session_factory=fake.session, clock=clock)
+        first = shipami.copy(origin, region='us-east-1', wait=True)
+        second = shipami.copy(origin, region='ap-southeast-2', wait=True)
+        deregister_image = fake._op_DeregisterImage
+
+        def refuse_first(region, params):
+            if params['ImageId'] == first:
+                raise FakeError('UnauthorizedOperation', 'not allowed')
+            return deregister_image(region, params)
+        fake._op_DeregisterImage = refuse_first
+
+        with pytest.raises(RuntimeError) as e:
+            shipami.delete([origin], cascade=True, force=True)
+        assert 'deleted {}'.format(second) in str(e.value)
+        assert first in fake.images['us-east-1']
+        assert origin in fake.images['eu-west-1']
+
+    def test_delete_cascade_unmanaged(self):
+        fake = FakeEC2()
+        origin = fake.add_image('eu-west-1', 'foo')
+        shipami = ShipAMI(region='eu-west-1', session_factory=fake.session)
+        shipami.copy(origin, region='us-east-1')
+
+        with pytest.raises(RuntimeError):
+            shipami.delete([origin], cascade=True)
+        assert fake.calls['DeregisterImage'] == 0
+
+
+class TestIncremental:
+
+    def test_incremental_copy(self):
+        clock = ManualClock()
+        fake = FakeEC2(copy_seconds=60, incremental_ratio=0.1, clock=clock)
+        first = fake.add_image('eu-west-1', 'foo-1')
+        second = fake.add_image('eu-west-1', 'foo-2', parent=first)
+        shipami = ShipAMI(region='us-east-1', session_factory=fake.session, clock=clock)
+
+        first_copy = shipami.copy(first, source_region='eu-west-1', incremental=True)
+        second_copy = shipami.copy(second, source_region='eu-west-1', incremental=True, wait=True)
+
+        assert fake.calls['CopyImage'] == 0
+        assert fake.calls['CopySnapshot'] == 2
+        assert fake.calls['RegisterImage'] == 2
+        durations = sorted(_['_duration'] for _ in fake.snapshots['us-east-1'].values())
+        assert durations == [6, 60]
+
+        record = shipami.show([second_copy])[0]
+        assert record.state == 'available'
+        assert record.copied_from == ['eu-west-1:' + second]
+        assert record.name == 'foo-2'
+        snapshot = fake.snapshots['us-east-1'][record.snapshot_ids[0]]
+        tags = dict((_['Key'], _['Value']) for _ in snapshot['Tags'])
+        assert tags['shipami:copied_from'] == 'eu-west-1:' + fake.images['eu-west-1'][second]['BlockDeviceMappings'][0]['Ebs']['SnapshotId']
+
+    def test_incremental_keeps_boot_settings(self):
+        clock = ManualClock()
+        fake = FakeEC2(copy_seconds=60, clock=clock)
+        source = fake.add_image('eu-west-1', 'foo')
+        fake.images['eu-west-1'][source].update(BootMode='uefi', TpmSupport='v2.0', ImdsSupport='v2.0', _uefi_data='QU1aTlVFRkk=')
+        shipami = ShipAMI(region='us-east-1', session_factory=fake.session, clock=clock)
+
+        copy_id = shipami.copy(source, source_region='eu-west-1', incremental=True)
+
+        image = fake.images['us-east-1'][copy_id]
+        assert (image['BootMode'], image['TpmSupport'], image['ImdsSupport'], image['_uefi_data']) == ('uefi', 'v2.0', 'v2.0', 'QU1aTlVFRkk=')
+
+    def test_incremental_refuses_billed_images(self):
+        fake = FakeEC2()
+        windows = fake.add_image('eu-west-1', 'windows')
+        fake.images['eu-west-1'][windows].update(Platform='windows', UsageOperation='RunInstances:0002')
+        billed = fake.add_image('eu-west-1', 'billed')
+        fake.images['eu-west-1'][billed]['UsageOperation'] = 'RunInstances:0010'
+        shipami = ShipAMI(region='us-east-1', session_factory=fake.session)
+
+        for image_id in [windows, billed]:
+            with pytest.raises(RuntimeError):
+                shipami.copy(image_id, source_region='eu-west-1', incremental=True)
+        with pytest.raises(PreflightError) as e:
+            shipami.preflight([('eu-west-1', windows, 'us-east-1'), ('eu-west-1', billed, 'us-east-1')], incremental=True)
+        assert len(e.value.problems) == 2
+        assert fake.calls['CopySnapshot'] == 0
+
+    def test_incremental_failure_deletes_copies(self):
+        clock = ManualClock()
+        fake = FakeEC2(copy_seconds=60, clock=clock)
+        source = fake.add_image('eu-west-1', 'foo')
+        shipami = ShipAMI(region='us-east-1', session_factory=fake.session, clock=clock)
+
+        def refuse(region, params):
+            raise FakeError('InvalidParameterValue', 'cannot register')
+        fake._op_RegisterImage = refuse
+
+        with pytest.raises(RuntimeError):
+            shipami.copy(source, source_region='eu-west-1', incremental=True)
+        assert fake.calls['CopySnapshot'] == 1
+        assert not fake.snapshots['us-east-1']
+
+
+class TestPreflight:
+
+    def test_consolidated_report(self):
+        fake = FakeEC2()
+        available = fake.add_image('eu-west-1', 'foo')
+        pending = fake.add_image('eu-west-1', 'bar', state='pending')
+        fake.add_image('us-east-1', 'foo')
+        shipami = ShipAMI(region='eu-west-1', session_factory=fake.session)
+        shipami.MAX_CONCURRENT_COPIES = 1
+
+        with pytest.raises(PreflightError) as e:
+            shipami.copy_images([available, pending, 'ami-deadbeef'], region='us-east-1', preflight=True)
+
+        problems = e.value.problems
+        assert len(problems) == 5
+        assert 'eu-west-1:ami-deadbeef: image does not exist' in problems
+        assert 'eu-west-1:{}: image is pending'.format(pending) in problems
+        assert [_ for _ in problems if 'snapshot is pending' in _]
+        assert [_ for _ in problems if _.startswith('us-east-1: an image named "foo" already exists')]
+        assert [_ for _ in problems if 'copies in progress' in _]
+        assert fake.calls['CopyImage'] == 0
+
+    def test_copies_in_progress(self):
+        fake = FakeEC2()
+        source = fake.add_image('eu-west-1', 'foo')
+        other = fake.add_image('eu-west-1', 'bar')
+        fake.add_image('us-east-1', 'baking', state='pending')
+        shipami = ShipAMI(region='eu-west-1', session_factory=fake.session)
+        shipami.copy(source, region='us-east-1', name='foo-1')
+        shipami.MAX_CONCURRENT_COPIES = 2
+
+        # the image being baked is not a copy
+        shipami.preflight([('eu-west-1', source, 'us-east-1')])
+        with pytest.raises(PreflightError) as e:
+            shipami.preflight([('eu-west-1', source, 'us-east-1'), ('eu-west-1', other, 'us-east-1')])
+        assert e.value.problems == ['us-east-1: 1 copies in progress, 2 more would exceed the limit of 2']
+
+    def test_destination_kms_key(self):
+        fake = FakeEC2()
+        fake.kms_keys['eu-west-1']['key-source'] = 'Enabled'
+        fake.kms_keys['us-east-1']['key-default'] = 'Disabled'
+        fake.default_kms_keys['us-east-1'] = 'key-default'
+        source = fake.add_image('eu-west-1', 'foo', kms_key_id='key-source')
+        shipami = ShipAMI(region='eu-west-1', session_factory=fake.session)
+
+        shipami.preflight([('eu-west-1', source, 'us-west-2')])
+        with pytest.raises(PreflightError) as e:
+            shipami.preflight([('eu-west-1', source, 'us-east-1')])
+        assert e.value.problems == ['us-east-1: KMS key key-default is Disabled']
+
+    def test_ok(self):
+        fake = FakeEC2()
+        source = fake.add_image('eu-west-1', 'foo')
+        shipami = ShipAMI(region='eu-west-1', session_factory=fake.session)
+
+        shipami.copy(source, region='us-east-1', preflight=True)
+
+        assert fake.calls['CopyImage'] == 1
+
+
+class TestHistory:
+
+    def test_record_and_estimate(self):
+        clock = ManualClock()
+        fake = FakeEC2(copy_seconds=60, clock=clock)
+        source = fake.add_image('eu-west-1', 'foo', size=8)
+        shipami = ShipAMI(region='eu-west-1', session_factory=fake.session, clock=clock)
+
+        assert shipami.estimate(source, 'us-east-1') is None
+
+        shipami.copy(source, region='us-east-1', wait=True)
+        estimate = shipami.estimate(source, 'us-east-1')
+
+        # the copy takes 60 simulated seconds, waits overshoot by less than a poll
+        assert 60 <= estimate < 90
+
+        clock = ManualClock()
+        fake = FakeEC2(copy_seconds=600, clock=clock)
+        source = fake.add_image('eu-west-1', 'foo', size=8)
+        shipami = ShipAMI(region='eu-west-1', session_factory=fake.session, clock=clock)
+        copy_id = shipami.copy(source, region='us-east-1')
+
+        state, progress, remaining = shipami.eta(copy_id, 'us-east-1')
+
+        assert state == 'pending'
+        assert 0 <= remaining <= estimate
+
+
+    def test_scheduled_copy_recorded_once(self):
+        clock = ManualClock()
+        fake = FakeEC2(copy_seconds=60, clock=clock)
+        source = fake.add_image('eu-west-1', 'foo', size=8)
+        shipami = ShipAMI(region='eu-west-1', session_factory=fake.session, clock=clock)
+
+        handles = shipami.copy_images([source], region='us-east-1', copy_permissions=True)
+        handles[0].result(timeout=10)
+
+        assert len(history.load()) == 1
+
+class TestAutoSource:
+
+    def setup_method(self, method):
+        self.clock = ManualClock()
+        self.fake = FakeEC2(copy_seconds=60, clock=self.clock)
+        self.origin = self.fake.add_image('us-east-1', 'foo')
+        self.shipami = ShipAMI(region='us-east-1', session_factory=self.fake.session, clock=self.clock)
+        self.replica = self.shipami.copy(self.origin, region='ap-southeast-1', wait=True)
+
+    def test_nearest_replica(self):
+        copy_id = self.shipami.copy(self.origin, region='ap-southeast-2', auto_source=True)
+
+        tags = dict((_['Key'], _['Value']) for _ in self.fake.images['ap-southeast-2'][copy_id]['Tags'])
+        assert tags['shipami:copied_from'] == 'us-east-1:' + self.origin
+        assert tags['shipami:copied_via'] == 'ap-southeast-1:' + self.replica
+        assert 'ap-southeast-2:' + copy_id in self.shipami.list()[0].copied_to
+        assert self.shipami.nearest_replica(self.replica, 'us-east-1', 'ap-southeast-1').id == self.origin
+
+    def test_configured_speed(self):
+        with open(paths.path('speeds.json'), 'w') as f:
+            json.dump({'us-east-1': {'ap-southeast-2': 10}}, f)
+
+        copy_id = self.shipami.copy(self.origin, region='ap-southeast-2', auto_source=True)
+
+        tags = dict((_['Key'], _['Value']) for _ in self.fake.images['ap-southeast-2'][copy_id]['Tags'])
+        assert 'shipami:copied_via' not in tags
+
+
+class TestWait:
+
+    def test_timeout_rollback(self):
+        clock = ManualClock()
+        fake = FakeEC2(copy_seconds=600, clock=clock)
+        source = fake.add_image('eu-west-1', 'foo')
+        shipami = ShipAMI(region='eu-west-1', session_factory=fake.session, clock=clock)
+
+        with pytest.raises(WaitTimeout):
+            shipami.copy(source, region='us-east-1', timeout=1, rollback=True)
+
+        assert fake.calls['DeregisterImage'] == 1
+        assert not fake.images['us-east-1']
+        assert not fake.snapshots['us-east-1']
+        tags = [_['Key'] for _ in fake.images['eu-west-1'][source].get('Tags', [])]
+        assert not [_ for _ in tags if _.startswith('shipami:copied_to')]
+
+    def test_scheduled_timeout_rollback(self):
+        clock = ManualClock()
+        fake = FakeEC2(copy_seconds=600, clock=clock)
+        sources = [fake.add_image('eu-west-1', 'foo-{}'.format(i)) for i in range(2)]
+        shipami = ShipAMI(region='eu-west-1', session_factory=fake.session, clock=clock)
+
+        # copy_permissions waits inside copy(), it still gets the timeout
+        handles = shipami.copy_images(sources, region='us-east-1', copy_permissions=True, timeout=100, rollback=True)
+
+        for handle in handles:
+            assert isinstance(handle.exception(timeout=10), WaitTimeout)
+        assert clock.time() - fake._started < 600
+        assert not fake.images['us-east-1']
+
+    def test_interrupted_scheduled_copies_roll_back(self):
+        clock = ManualClock()
+        fake = FakeEC2(copy_seconds=10 ** 9, clock=clock)
+        sources = [fake.add_image('eu-west-1', 'foo-{}'.format(i)) for i in range(2)]
+        shipami = ShipAMI(region='eu-west-1', session_factory=fake.session, clock=clock)
+        handles = shipami.copy_images(sources, region='us-east-1', rollback=True)
+        interrupted = []
+
+        def wait():
+            if not interrupted:
+                interrupted.append(True)
+                raise KeyboardInterrupt()
+            return handles[0].exception()
+
+        assert isinstance(shipami.uninterrupted(wait), WaitCancelled)
+        assert isinstance(handles[1].exception(timeout=10), WaitCancelled)
+        assert not fake.images['us-east-1']
+
+    def test_rollback_retries_snapshots(self):
+        clock = ManualClock()
+        fake = FakeEC2(copy_seconds=600, clock=clock)
+        source = fake.add_image('eu-west-1', 'foo')
+        shipami = ShipAMI(region='eu-west-1', session_factory=fake.session, clock=clock)
+        delete_snapshot = fake._op_DeleteSnapshot
+        refused = []
+
+        def busy_once(region, params):
+            # deregistration takes a moment to release the snapshots
+            if params['SnapshotId'] not in refused:
+                refused.append(params['SnapshotId'])
+                raise FakeError('InvalidSnapshot.InUse', 'in use')
+            return delete_snapshot(region, params)
+        fake._op_DeleteSnapshot = busy_once
+
+        with pytest.raises(WaitTimeout):
+            shipami.copy(source, region='us-east-1', timeout=1, rollback=True)
+        assert refused
+        assert not fake.snapshots['us-east-1']
+
+    def test_rollback_names_leaked_snapshots(self):
+        clock = ManualClock()
+        fake = FakeEC2(copy_seconds=600, clock=clock)
+        source = fake.add_image('eu-west-1', 'foo')
+        shipami = ShipAMI(region='eu-west-1', session_factory=fake.session, clock=clock)
+
+        def busy(region, params):
+            raise FakeError('InvalidSnapshot.InUse', 'in use')
+        fake._op_DeleteSnapshot = busy
+
+        with pytest.raises(RuntimeError) as e:
+            shipami.copy(source, region='us-east-1', timeout=1, rollback=True)
+        assert not fake.images['us-east-1']
+        for snapshot_id in fake.snapshots['us-east-1']:
+            assert snapshot_id in str(e.value)
+
+    def test_deregistered_while_waiting(self):
+        clock = ManualClock()
+        fake = FakeEC2(copy_seconds=600, clock=clock)
+        source = fake.add_image('eu-west-1', 'foo')
+        shipami = ShipAMI(region='eu-west-1', session_factory=fake.session, clock=clock)
+        copy_id = shipami.copy(source)
+        describe_images = fake._op_DescribeImages
+
+        def describe_then_deregister(region, params):
+            r = describe_images(region, params)
+            fake.images['eu-west-1'].pop(copy_id, None)
+            return r
+        fake._op_DescribeImages = describe_then_deregister
+
+        with pytest.raises(RuntimeError) as e:
+            shipami.share(copy_id, account_id='111111111111')
+        assert str(e.value) == 'image {} does not exist'.format(copy_id)
+
+    def test_cancel(self):
+        fake = FakeEC2(copy_seconds=600, speedup=10)
+        source = fake.add_image('eu-west-1', 'foo')
+        shipami = ShipAMI(region='eu-west-1', session_factory=fake.session)
+        threading.Timer(0.2, shipami.cancel).start()
+
+        with pytest.raises(WaitCancelled):
+            shipami.copy(source, region='us-east-1', wait=True)
+
+
+class TestFastSnapshotRestores:
+
+    def test_enable_batches(self):
+        clock = ManualClock()
+        fake = FakeEC2(fsr_seconds=60, clock=clock)
+        for i in range(3):
+            fake.add_image('eu-west-1', 'foo-{}'.format(i))
+        fake.add_image('us-east-1', 'bar')
+        shipami = ShipAMI(region='eu-west-1', session_factory=fake.session, clock=clock)
+        shipami.MAX_FSR_SNAPSHOTS = 2
+
+        images = shipami.find_images(regions=['eu-west-1', 'us-east-1'])
+        shipami.fast_snapshot_restores(images, ['eu-west-1a', 'eu-west-1b', 'us-east-1a'], wait=True)
+
+        # 3 snapshots in eu-west-1, 1 in us-east-1
+        assert fake.calls['EnableFastSnapshotRestores'] == 3
+        for region, zones in [('eu-west-1', ['eu-west-1a', 'eu-west-1b']), ('us-east-1', ['us-east-1a'])]:
+            for snapshot in fake.snapshots[region].values():
+                assert sorted(snapshot['_fsr']) == zones
+            for image in fake.images[region].values():
+                assert {'Key': 'shipami:fsr', 'Value': ','.join(zones)} in image['Tags']
+
+    def test_pending_image(self):
+        fake = FakeEC2(copy_seconds=600)
+        origin = fake.add_image('eu-west-1', 'foo')
+        shipami = ShipAMI(region='eu-west-1', session_factory=fake.session)
+        copy = shipami.copy(origin)
+
+        with pytest.raises(RuntimeError):
+            shipami.fast_snapshot_restores(shipami.find_images([copy]), ['eu-west-1a'])
+        assert not [_ for _ in fake.images['eu-west-1'][copy]['Tags'] if _['Key'] == 'shipami:fsr']
+
+    def test_failed_disable_keeps_tag(self):
+        clock = ManualClock()
+        fake = FakeEC2(clock=clock)
+        fake.add_image('eu-west-1', 'foo')
+        shipami = ShipAMI(region='eu-west-1', session_factory=fake.session, clock=clock)
+        shipami.fast_snapshot_restores(shipami.find_images(), ['eu-west-1a', 'eu-west-1b'])
+        disable = fake._op_DisableFastSnapshotRestores
+
+        def fail_in_b(region, params):
+            r = disable(region, dict(params, AvailabilityZones=['eu-west-1a']))
+            r['Unsuccessful'] = [{'SnapshotId': _, 'FastSnapshotRestoreStateErrors': [
+                {'AvailabilityZone': 'eu-west-1b', 'Error': {'Code': 'InternalError', 'Message': 'try again'}}
+            ]} for _ in params['SourceSnapshotIds']]
+            return r
+        fake._op_DisableFastSnapshotRestores = fail_in_b
+
+        with pytest.raises(RuntimeError):
+            shipami.fast_snapshot_restores(shipami.find_images(), ['eu-west-1a', 'eu-west-1b'], enable=False)
+        assert shipami.find_images()[0].tags['shipami:fsr'] == 'eu-west-1b'
+
+    def test_release_and_delete(self):
+        clock = ManualClock()
+        fake = FakeEC2(copy_seconds=60, clock=clock)
+        origin = fake.add_image('eu-west-1', 'foo')
+        shipami = ShipAMI(region='eu-west-1', session_factory=fake.session, clock=clock)
+
+        image_id = shipami.release(origin, '1.0.0', region='us-east-1', fsr_zones=['us-east-1a', 'eu-west-1a'])
+
+        snapshot = list(fake.snapshots['us-east-1'].values())[0]
+        assert sorted(snapshot['_fsr']) == ['us-east-1a']
+        assert not list(fake.snapshots['eu-west-1'].values())[0]['_fsr']
+
+        ShipAMI(region='us-east-1', session_factory=fake.session, clock=clock).delete([image_id], force=True)
+
+        assert fake.calls['DisableFastSnapshotRestores'] == 1
+        assert not snapshot['_fsr']
+
+
+class TestCalls:
+
+    def setup_method(self, method):
+        self.fake = FakeEC2(copy_seconds=0)
+        self.origin = self.fake.add_image('eu-west-1', 'foo')
+        self.shipami = ShipAMI(region='eu-west-1', session_factory=self.fake.session)
+        self.shipami.share(self.origin, account_id='111111111111', create_volume=True)
+        self.fake.calls.clear()
+
+    def test_copy(self):
+        self.shipami.copy(self.origin, region='us-east-1')
+
+        assert self.fake.calls == {'DescribeImages': 1, 'CopyImage': 1, 'CreateTags': 2}
+
+    def test_copy_permissions(self):
+        self.shipami.copy(self.origin, region='us-east-1', copy_permissions=True)
+
+        # the source, then the available copy
+        assert self.fake.calls['DescribeImages'] == 2
+        assert self.fake.calls['DescribeSnapshots'] == 0
+        assert self.fake.calls['ModifyImageAttribute'] == 1
+        assert self.fake.calls['ModifySnapshotAttribute'] == 1
+
+    def test_share(self):
+        self.shipami.share(self.origin, account_id='222222222222', create_volume=True)
+
+        # permissions are read back for the shipami:shares tag
+        assert self.fake.calls == {
+            'DescribeImages': 1, 'ModifyImageAttribute': 1, 'ModifySnapshotAttribute': 1,
+            'DescribeImageAttribute': 1, 'CreateTags': 1
+        }
+
+    def test_show(self):
+        self.shipami.share(self.origin, account_id=ShipAMI.MARKETPLACE_ACCOUNT_ID, create_volume=True)
+        self.fake.calls.clear()
+
+        image = self.shipami.show([self.origin])[0]
+
+        assert [_.get('Marketplace') for _ in image.shares if _['UserId'] == ShipAMI.MARKETPLACE_ACCOUNT_ID] == [True]
+        # launch permissions are read once for the shares and the marketplace check
+        assert self.fake.calls == {'DescribeImages': 1, 'DescribeImageAttribute': 1, 'DescribeSnapshotAttribute': 1}
+
+    def test_delete(self):
+        image_id = self.shipami.copy(self.origin, wait=True)
+        self.fake.calls.clear()
+
+        self.shipami.delete([image_id])
+
+        # the copy, then its source for the older lineage tag
+        assert self.fake.calls == {'DescribeImages': 2, 'DeregisterImage': 1, 'DeleteSnapshot': 1, 'DeleteTags': 1}
+
+
+class TestReplicate:
+
+    def test_replicate(self, monkeypatch):
+        clock = ManualClock()
+        fake = FakeEC2(copy_seconds=60, clock=clock)
+        origin = fake.add_image('eu-west-1', 'foo')
+        shipami = ShipAMI(region='eu-west-1', session_factory=fake.session, clock=clock)
+        shipami.share(origin, account_id='111111111111', create_volume=True)
+        assumed = []
+
+        def for_account(account):
+            assumed.append(account)
+            return ShipAMI(region='eu-west-1', session_factory=fake.session, clock=clock)
+        monkeypatch.setattr(shipami, 'for_account', for_account)
+        fake.calls.clear()
+
+        result = shipami.replicate(origin, ['111111111111', 'arn:aws:iam::222222222222:role/deploy'], ['eu-west-1', 'us-east-1'])
+
+        assert sorted(assumed) == ['arn:aws:iam::111111111111:role/OrganizationAccountAccessRole', 'arn:aws:iam::222222222222:role/deploy']
+        assert sorted(_[:2] for _ in result) == [
+            ('111111111111', 'eu-west-1'), ('111111111111', 'us-east-1'),
+            ('222222222222', 'eu-west-1'), ('222222222222', 'us-east-1')
+        ]
+        assert not [_ for _ in result if _[3]]
+        assert len(fake.images['us-east-1']) == 2
+        # one call per resource to share, one to revoke
+        assert fake.calls['ModifyImageAttribute'] == 2
+        assert fake.calls['ModifySnapshotAttribute'] == 2
+        # 111111111111 was already allowed before
+        assert fake.images['eu-west-1'][origin]['_permissions'] == [{'UserId': '111111111111'}]
+        assert list(fake.snapshots['eu-west-1'].values())[0]['_permissions'] == [{'UserId': '111111111111'}]
+        assert not [_ for _ in fake.images['eu-west-1'][origin]['Tags'] if _['Key'].startswith('shipami:copied_to')]
+
+    def test_replicate_copy_limit(self, monkeypatch):
+        # retries wait on wall time, so does the copy they wait for
+        fake = FakeEC2(copy_seconds=60, speedup=600, copy_limit=1)
+        origin = fake.add_image('eu-west-1', 'foo')
+        shipami = ShipAMI(region='eu-west-1', session_factory=fake.session)
+        # every account lands in the same fake, so they share its copy limit
+        monkeypatch.setattr(shipami, 'for_account', lambda account: ShipAMI(region='eu-west-1', session_factory=fake.session))
+        monkeypatch.setattr(CopyScheduler, 'DEFAULT_RETRY_DELAY', 0.5)
+
+        result = shipami.replicate(origin, ['111111111111', '222222222222'], ['us-east-1'])
+
+        assert not [_ for _ in result if _[3]]
+        assert fake.calls['CopyImage'] > 2
+        assert len(fake.images['us-east-1']) == 2
+
+    def test_invalid_account(self):
+        fake = FakeEC2()
+        origin = fake.add_image('eu-west-1', 'foo')
+        shipami = ShipAMI(region='eu-west-1', session_factory=fake.session)
+
+        with pytest.raises(RuntimeError):
+            shipami.replicate(origin, ['production'])
+        assert fake.calls['ModifyImageAttribute'] == 0
+
+
+class TestShares:
+
+    def tags(self, fake, region, image_id):
+        return dict((_['Key'], _['Value']) for _ in fake.images[region][image_id]['Tags'])
+
+    def test_marketplace(self):
+        fake = FakeEC2(copy_seconds=0)
+        origin = fake.add_image('eu-west-1', 'foo')
+        shipami = ShipAMI(region='eu-west-1', session_factory=fake.session)
+
+        shipami.share(origin)
+        assert self.tags(fake, 'eu-west-1', origin)['shipami:shares'] == 'accounts=0,marketplace=no'
+
+        shipami.share(origin, create_volume=True)
+        shipami.share(origin, account_id='111111111111')
+        assert self.tags(fake, 'eu-west-1', origin)['shipami:shares'] == 'accounts=1,marketplace=yes'
+
+        copy = shipami.copy(origin, region='us-east-1', copy_permissions=True)
+        assert self.tags(fake, 'us-east-1', copy)['shipami:shares'] == 'accounts=1,marketplace=yes'
+        record = shipami.find_images([copy], ['us-east-1'])[0]
+        assert (record.shared, record.shared_accounts, record.marketplace) == (True, 1, True)
+
+    def test_verify(self):
+        fake = FakeEC2()
+        images = [fake.add_image('eu-west-1', 'foo-{}'.format(i)) for i in range(3)]
+        fake.images['eu-west-1'][images[0]]['_permissions'].append({'UserId': '111111111111'})
+        shipami = ShipAMI(region='eu-west-1', session_factory=fake.session)
+
+        corrected = shipami.verify_shares(shipami.find_images())
+
+        assert sorted((_[0].id, _[1], _[2]) for _ in corrected) == sorted([
+            (images[0], None, 'accounts=1,marketplace=no'),
+            (images[1], None, 'accounts=0,marketplace=no'),
+            (images[2], None, 'accounts=0,marketplace=no')
+        ])
+        # one call per distinct value
+        assert fake.calls['CreateTags'] == 2
+        assert shipami.verify_shares(shipami.find_images()) == []
+
+    def test_public(self):
+        fake = FakeEC2()
+        origin = fake.add_image('eu-west-1', 'foo')
+        fake.images['eu-west-1'][origin]['_permissions'].append({'Group': 'all'})
+        shipami = ShipAMI(region='eu-west-1', session_factory=fake.session)
+
+        corrected = shipami.verify_shares(shipami.find_images())
+
+        assert [_[2] for _ in corrected] == ['accounts=0,marketplace=no,public=yes']
+        record = shipami.find_images()[0]
+        assert (record.shared, record.shared_accounts, record.public) == (True, 0, True)
+
+        shipami.share(origin, account_id='111111111111')
+        assert self.tags(fake, 'eu-west-1', origin)['shipami:shares'] == 'accounts=1,marketplace=no,public=yes'
@@ -0,0 +1,92 @@
+import datetime
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from shipami import credentials
+
+ROLE_ARN = 'arn:aws:iam::123456789012:role/shipami'
+
+@pytest.fixture()
+def sts():
+    import moto
+
+    mock = moto.mock_sts()
+    mock.start()
+    yield
+    mock.stop()
+
+class TestCredentials:
+
+    def test_account_label(self):
+        assert credentials.account_label(ROLE_ARN) == '123456789012'
+        assert credentials.account_label('production') == 'production'
+
+    def test_cached_on_disk(self, sts, tmpdir, monkeypatch):
+        tmpdir = tmpdir.mkdir('cache')
+        calls = []
+        assume_role = credentials._assume_role
+        monkeypatch.setattr(credentials, '_assume_role', lambda *args: calls.append(args) or assume_role(*args))
+
+        first = credentials.get_credentials(ROLE_ARN, cache_dir=str(tmpdir))
+        credentials._credentials.clear()
+        second = credentials.get_credentials(ROLE_ARN, cache_dir=str(tmpdir))
+
+        assert len(calls) == 1
+        assert first == second
+        assert len(tmpdir.listdir()) == 1
+        assert oct(os.stat(str(tmpdir.listdir()[0])).st_mode & 0o777) == oct(0o600)
+
+    def test_expired(self, sts, tmpdir):
+        tmpdir = tmpdir.mkdir('cache')
+        first = credentials.get_credentials(ROLE_ARN, cache_dir=str(tmpdir))
+        expired = dict(first, Expiration='2000-01-01T00:00:00+00:00')
+        with open(str(tmpdir.listdir()[0]), 'w') as f:
+            json.dump(expired, f)
+        credentials._credentials.clear()
+
+        second = credentials.get_credentials(ROLE_ARN, cache_dir=str(tmpdir))
+
+        assert second['Expiration'] != expired['Expiration']
+
+    def test_roles_assumed_concurrently(self, tmpdir, monkeypatch):
+        expiration = '2100-01-01T00:00:00+00:00'
+        running = []
+        peak = []
+
+        def assume_role(role_arn, profile=None):
+            running.append(role_arn)
+            peak.append(len(running))
+            time.sleep(0.2)
+            running.remove(role_arn)
+            return {'AccessKeyId': role_arn, 'SecretAccessKey': 'x', 'SessionToken': 'x', 'Expiration': expiration}
+        monkeypatch.setattr(credentials, '_assume_role', assume_role)
+
+        roles = ['arn:aws:iam::{}:role/shipami'.format(_ * 111111111111) for _ in range(1, 4)]
+        threads = [threading.Thread(target=credentials.get_credentials, args=(_,), kwargs={'cache_dir': str(tmpdir)}) for _ in roles]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert max(peak) == 3
+
+    def test_session_renews(self, tmpdir, monkeypatch):
+        assumed = []
+
+        def assume_role(role_arn, profile=None):
+            assumed.append(role_arn)
+            # expires within EXPIRY_MARGIN, so every use asks for new credentials
+            expiration = datetime.datetime.utcnow() + credentials.EXPIRY_MARGIN - datetime.timedelta(minutes=1)
+            return {'AccessKeyId': 'key-{}'.format(len(assumed)), 'SecretAccessKey': 'x', 'SessionToken': 'x', 'Expiration': expiration.isoformat() + '+00:00'}
+        monkeypatch.setattr(credentials, '_assume_role', assume_role)
+
+        session = credentials.assume_role_session(ROLE_ARN, region='eu-west-1', cache_dir=str(tmpdir))
+        first = session.get_credentials().get_frozen_credentials().access_key
+        second = session.get_credentials().get_frozen_credentials().access_key
+
+        assert first != second
+        assert session.region_name == 'eu-west-1'
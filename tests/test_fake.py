@@ -0,0 +1,80 @@
+import time
+
+import pytest
+
+from shipami.core import ShipAMI
+from shipami.fake import FakeEC2, ManualClock
+from shipami.scheduler import CopyScheduler
+
+
+class TestFakeEC2:
+
+    def test_copy_lifecycle(self):
+        clock = ManualClock()
+        fake = FakeEC2(copy_seconds=600, clock=clock)
+        image_id = fake.add_image('eu-west-1', 'foo')
+        shipami = ShipAMI(region='us-east-1', session_factory=fake.session, clock=clock)
+
+        copy_id = shipami.copy(image_id, source_region='eu-west-1')
+
+        assert shipami.progress(copy_id) == ('pending', 0)
+        clock.advance(600)
+        assert shipami.progress(copy_id) == ('available', 100)
+        assert fake.calls['CopyImage'] == 1
+        assert [_.copied_to for _ in shipami.list()] == [[]]
+        assert ShipAMI(region='eu-west-1', session_factory=fake.session).list()[0].copied_to == ['us-east-1:' + copy_id]
+
+    def test_snapshot_progress(self):
+        clock = ManualClock()
+        fake = FakeEC2(copy_seconds=1000, clock=clock)
+        image_id = fake.add_image('eu-west-1', 'foo')
+        shipami = ShipAMI(region='us-east-1', session_factory=fake.session, clock=clock)
+
+        copy_id = shipami.copy(image_id, source_region='eu-west-1')
+        clock.advance(500)
+
+        assert shipami.progress(copy_id) == ('pending', 50)
+
+    def test_wait(self):
+        clock = ManualClock()
+        fake = FakeEC2(copy_seconds=600, clock=clock)
+        image_id = fake.add_image('eu-west-1', 'foo')
+        shipami = ShipAMI(region='us-east-1', session_factory=fake.session, clock=clock)
+        started = clock.time()
+
+        copy_id = shipami.copy(image_id, source_region='eu-west-1', wait=True)
+
+        # waits advance the clock instead of sleeping
+        assert shipami.progress(copy_id) == ('available', 100)
+        assert 600 <= clock.time() - started < 700
+
+    def test_latency(self):
+        fake = FakeEC2(latency={'DescribeImages': 0.2})
+        fake.add_image('eu-west-1', 'foo')
+        shipami = ShipAMI(region='eu-west-1', session_factory=fake.session)
+
+        start = time.time()
+        shipami.list()
+
+        assert time.time() - start >= 0.2
+
+    def test_throttling(self):
+        fake = FakeEC2(throttle_rate=1)
+        shipami = ShipAMI(region='eu-west-1', session_factory=fake.session)
+
+        with pytest.raises(RuntimeError) as e:
+            shipami.list()
+        assert 'Request limit exceeded' in str(e.value)
+
+    def test_copy_limit(self):
+        clock = ManualClock()
+        fake = FakeEC2(copy_seconds=60, copy_limit=2, clock=clock)
+        image_ids = [fake.add_image('eu-west-1', 'foo-{}'.format(i)) for i in range(5)]
+        shipami = ShipAMI(region='us-east-1', session_factory=fake.session, clock=clock)
+        scheduler = CopyScheduler(shipami, max_in_flight=5, poll_delay=0.01, retry_delay=0.01, clock=clock)
+
+        handles = [scheduler.submit(_, source_region='eu-west-1') for _ in image_ids]
+
+        assert all(_.result(timeout=10) for _ in handles)
+        assert fake.calls['CopyImage'] > 5
+        assert scheduler.limit(None) <= 5
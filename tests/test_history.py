@@ -0,0 +1,23 @@
+from shipami import history
+
+
+class TestHistory:
+
+    def test_empty(self):
+        assert history.load() == []
+        assert history.estimate('eu-west-1', 'us-east-1', 8) is None
+
+    def test_estimate(self):
+        history.record('eu-west-1', 'us-east-1', 8, 400)
+        history.record('eu-west-1', 'us-east-1', 16, 800)
+        history.record('eu-west-1', 'ap-southeast-2', 8, 1600)
+
+        assert len(history.load()) == 3
+        assert history.estimate('eu-west-1', 'us-east-1', 32) == 1600
+        # no copy between these regions yet, any copy to the destination is used
+        assert history.estimate('us-west-2', 'ap-southeast-2', 8) == 1600
+        assert history.estimate('eu-west-1', 'sa-east-1', 8) is None
+        assert history.estimate('eu-west-1', 'us-east-1', 8, incremental=True) is None
+
+    def test_format_duration(self):
+        assert history.format_duration(3725.4) == '1:02:05'
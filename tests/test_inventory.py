@@ -0,0 +1,53 @@
+import sqlite3
+
+import pytest
+
+from shipami import inventory
+from shipami.core import ShipAMI
+from shipami.fake import FakeEC2, ManualClock
+
+
+class TestInventory:
+
+    def test_export_diff(self, tmpdir):
+        clock = ManualClock()
+        fake = FakeEC2(copy_seconds=60, clock=clock)
+        kept = fake.add_image('eu-west-1', 'kept')
+        removed = fake.add_image('us-east-1', 'removed')
+        shipami = ShipAMI(region='eu-west-1', session_factory=fake.session)
+        copied = shipami.copy(kept, region='us-east-1')
+        old = str(tmpdir.join('old.db'))
+
+        assert inventory.export(shipami, ['eu-west-1', 'us-east-1'], old) == 3
+        assert inventory.meta(old)['regions'] == 'eu-west-1,us-east-1'
+
+        # the copy completes and an unmanaged image is deleted
+        clock.advance(60)
+        ShipAMI(region='us-east-1', session_factory=fake.session).delete([removed], force=True)
+        added = fake.add_image('eu-west-1', 'added')
+        shipami.tag(shipami.find_images([kept]), add={'team': 'ops'})
+        shipami.share(kept, account_id='111111111111')
+        new = str(tmpdir.join('new.db'))
+        inventory.export(shipami, ['eu-west-1', 'us-east-1'], new)
+
+        calls = sum(fake.calls.values())
+        changes = sorted(inventory.diff(old, new))
+
+        assert changes == sorted([
+            inventory.Change('added', 'eu-west-1', added, None, None, 'added'),
+            inventory.Change('removed', 'us-east-1', removed, None, 'removed', None),
+            inventory.Change('state', 'us-east-1', copied, None, 'pending', 'available'),
+            inventory.Change('shares', 'eu-west-1', kept, None, None, 'accounts=1,marketplace=no'),
+            inventory.Change('tag', 'eu-west-1', kept, 'team', None, 'ops')
+        ])
+        assert list(inventory.diff(new, new)) == []
+        assert sum(fake.calls.values()) == calls
+
+    def test_not_an_inventory(self, tmpdir):
+        path = str(tmpdir.join('other.db'))
+        sqlite3.connect(path).execute('CREATE TABLE foo (bar TEXT)')
+
+        with pytest.raises(RuntimeError):
+            list(inventory.diff(path, path))
+        with pytest.raises(RuntimeError):
+            list(inventory.diff(str(tmpdir.join('missing.db')), path))
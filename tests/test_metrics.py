@@ -0,0 +1,83 @@
+import threading
+import time
+
+import botocore.exceptions
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+from shipami import metrics
+from shipami.core import ShipAMI
+from shipami.fake import FakeEC2
+from shipami.metrics import Exporter, HTTPServer, MetricsHandler, inventory, render
+
+
+def fixture():
+    fake = FakeEC2(copy_seconds=600)
+    origin = fake.add_image('eu-west-1', 'foo')
+    fake.add_image('us-east-1', 'bar')
+    shipami = ShipAMI(region='eu-west-1', session_factory=fake.session)
+    release = shipami.release(origin, '1.0', region='us-east-1')
+    return fake, shipami, origin, release
+
+
+class TestMetrics:
+
+    def test_render(self):
+        fake, shipami, origin, release = fixture()
+
+        text = render(*inventory(shipami, ['eu-west-1', 'us-east-1']))
+
+        assert 'shipami_images{managed="false",region="eu-west-1",release="false",state="available"} 1' in text
+        assert 'shipami_images{managed="true",region="us-east-1",release="true",state="pending"} 1' in text
+        assert 'shipami_releases{region="us-east-1"} 1' in text
+        assert 'shipami_unshared_releases{region="us-east-1"} 1' in text
+        assert 'shipami_pending_copy_age_seconds{{copied_from="eu-west-1:{}",image_id="{}",region="us-east-1"}}'.format(origin, release) in text
+
+        fake.images['us-east-1'][release]['_permissions'].append({'UserId': '012345678912'})
+        text = render(*inventory(shipami, ['eu-west-1', 'us-east-1']))
+
+        assert 'shipami_unshared_releases{region="us-east-1"} 0' in text
+
+    def test_scrape_without_ec2_calls(self):
+        fake, shipami, origin, release = fixture()
+        exporter = Exporter(shipami, ['eu-west-1', 'us-east-1'], interval=3600)
+        exporter.refresh()
+        server = HTTPServer(('127.0.0.1', 0), MetricsHandler)
+        server.exporter = exporter
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        calls = sum(fake.calls.values())
+
+        try:
+            for _ in range(3):
+                body = urlopen('http://127.0.0.1:{}/metrics'.format(server.server_port)).read().decode('utf-8')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        assert sum(fake.calls.values()) == calls
+        assert 'shipami_inventory_refreshes_total 1' in body
+        assert 'shipami_releases{region="us-east-1"} 1' in body
+
+    def test_refresh_survives_errors(self, monkeypatch):
+        def unreachable(shipami, regions=None):
+            raise botocore.exceptions.EndpointConnectionError(endpoint_url='https://ec2.eu-west-1.amazonaws.com')
+        monkeypatch.setattr(metrics, 'inventory', unreachable)
+        exporter = Exporter(None, ['eu-west-1'], interval=0.01)
+
+        exporter.start()
+        try:
+            for _ in range(200):
+                if exporter._errors >= 3:
+                    break
+                time.sleep(0.01)
+            assert exporter._thread.is_alive()
+        finally:
+            exporter.stop()
+
+        assert exporter._errors >= 3
+        assert 'shipami_inventory_refreshes_total 0' in exporter.text()
@@ -0,0 +1,101 @@
+import threading
+
+from shipami.exceptions import CopyLimitExceeded
+from shipami.scheduler import CopyScheduler
+
+
+class QuotaShipAMI(object):
+    """Accepts at most `quota` copies until they are polled as available"""
+
+    def __init__(self, quota, polls=2):
+        self.quota = quota
+        self.polls = polls
+        self.running = {}
+        self.peak = 0
+        self.refused = 0
+        self.lock = threading.Lock()
+
+    def copy(self, image_id, source_region=None, region=None, wait=False, **kwargs):
+        with self.lock:
+            if len(self.running) >= self.quota:
+                self.refused += 1
+                raise CopyLimitExceeded('too many copies')
+            dst_id = image_id.replace('ami-', 'ami-c')
+            self.running[dst_id] = self.polls
+            self.peak = max(self.peak, len(self.running))
+        return dst_id
+
+    def record_copy(self, image_id, source_region=None, region=None, seconds=0, incremental=False):
+        pass
+
+    def progress(self, image_id, region=None):
+        with self.lock:
+            self.running[image_id] -= 1
+            if self.running[image_id] <= 0:
+                del self.running[image_id]
+                return 'available', 100
+        return 'pending', 50
+
+
+class TestCopyScheduler:
+
+    def test_copies_everything(self):
+        shipami = QuotaShipAMI(quota=10)
+        scheduler = CopyScheduler(shipami, max_in_flight=3, poll_delay=0.01, retry_delay=0.01)
+
+        handles = [scheduler.submit('ami-{:08d}'.format(i)) for i in range(10)]
+
+        assert [_.result(timeout=5) for _ in handles] == ['ami-c{:08d}'.format(i) for i in range(10)]
+        assert all(_.status == 'available' and _.progress == 100 for _ in handles)
+        assert shipami.peak <= 3
+
+    def test_retries_limit_errors(self):
+        shipami = QuotaShipAMI(quota=2)
+        scheduler = CopyScheduler(shipami, max_in_flight=5, poll_delay=0.01, retry_delay=0.01)
+
+        handles = [scheduler.submit('ami-{:08d}'.format(i)) for i in range(8)]
+
+        for handle in handles:
+            handle.result(timeout=5)
+        assert shipami.refused > 0
+        assert shipami.peak == 2
+        assert any(_.attempts > 1 for _ in handles)
+
+    def test_gives_up_on_limit_errors(self):
+        shipami = QuotaShipAMI(quota=0)
+        scheduler = CopyScheduler(shipami, poll_delay=0.01, retry_delay=0.01, max_attempts=3)
+
+        handle = scheduler.submit('ami-00000000')
+
+        assert isinstance(handle.exception(timeout=5), CopyLimitExceeded)
+        assert handle.attempts == 3
+        assert shipami.refused == 3
+
+        scheduler = CopyScheduler(shipami, poll_delay=0.01, retry_delay=10)
+        handle = scheduler.submit('ami-00000001', timeout=5)
+
+        assert isinstance(handle.exception(timeout=5), CopyLimitExceeded)
+        assert handle.attempts == 1
+
+    def test_failure(self):
+        class FailingShipAMI(QuotaShipAMI):
+            def copy(self, image_id, **kwargs):
+                raise RuntimeError('boom')
+
+        scheduler = CopyScheduler(FailingShipAMI(quota=1), poll_delay=0.01)
+        handle = scheduler.submit('ami-00000000')
+
+        assert isinstance(handle.exception(timeout=5), RuntimeError)
+        assert handle.status == 'failed'
+
+    def test_record_failure(self):
+        class UnreachableHistory(QuotaShipAMI):
+            def record_copy(self, *args):
+                raise IndexError('not a RuntimeError')
+
+        scheduler = CopyScheduler(UnreachableHistory(quota=2), poll_delay=0.01)
+        handles = [scheduler.submit('ami-0000000{}'.format(_)) for _ in range(2)]
+
+        for handle in handles:
+            assert handle.result(timeout=5)
+        assert scheduler._in_flight[None] == 0
@@ -0,0 +1,162 @@
+import logging
+import threading
+import sys
+
+import click
+import pytest
+
+from shipami import client
+from shipami.cli import cli, main, runs_locally
+from shipami.server import ShipAMIServer
+
+
+@pytest.fixture()
+def ec2():
+    import boto3
+    import moto
+
+    moto.mock_ec2().start()
+    return boto3.resource('ec2', region_name='eu-west-1')
+
+@pytest.fixture()
+def base_image(ec2):
+    instance = ec2.create_instances(ImageId='ami-42424242', MinCount=1, MaxCount=1)[0]
+    return instance.create_image(Name='foo', Description='Foo')
+
+def start(tmpdir, group):
+    server = ShipAMIServer(str(tmpdir.join('s.sock')), group, cache_ttl=600)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+@pytest.fixture()
+def server(tmpdir):
+    server = start(tmpdir, cli)
+    yield server.server_address
+    server.shutdown()
+    server.server_close()
+
+
+class Output(object):
+
+    def __init__(self, on_write=None):
+        self.data = ''
+        self.on_write = on_write
+
+    def write(self, data):
+        self.data += data
+        if self.on_write:
+            self.on_write()
+
+    def flush(self):
+        pass
+
+
+class TestServer:
+
+    def test_no_daemon(self, tmpdir):
+        assert client.forward(['list'], path=str(tmpdir.join('none.sock'))) is None
+
+    def test_forward(self, ec2, base_image, server):
+        out = Output()
+
+        assert client.forward(['list', '-q'], path=server, stdout=out) == 0
+        assert out.data.split() == [base_image.id]
+
+        level = logging.getLogger('shipami.cli').level
+        client.forward(['-v', 'list', '-q'], path=server, stdout=Output())
+        assert logging.getLogger('shipami.cli').level == level
+
+    def test_inventory_cache(self, ec2, base_image, server):
+        client.forward(['list', '-q'], path=server, stdout=Output())
+        other = base_image.meta.client.copy_image(SourceRegion='eu-west-1', SourceImageId=base_image.id, Name='bar')
+
+        out = Output()
+        client.forward(['list', '-q'], path=server, stdout=out)
+        assert other['ImageId'] not in out.data
+
+        copied = Output()
+        client.forward(['copy', base_image.id], path=server, stdout=copied)
+        out = Output()
+        client.forward(['list', '-q'], path=server, stdout=out)
+        assert other['ImageId'] in out.data
+        assert copied.data.strip() in out.data
+
+    def test_local_change(self, ec2, base_image, server, monkeypatch):
+        client.forward(['list', '-q'], path=server, stdout=Output())
+        other = base_image.meta.client.copy_image(SourceRegion='eu-west-1', SourceImageId=base_image.id, Name='bar')
+
+        monkeypatch.setenv('SHIPAMI_NO_DAEMON', '1')
+        monkeypatch.setattr(sys, 'argv', ['shipami', 'tag', other['ImageId'], '-a', 'foo=bar'])
+        with pytest.raises(SystemExit):
+            main()
+        monkeypatch.delenv('SHIPAMI_NO_DAEMON')
+        assert client.changed_at()
+
+        out = Output()
+        client.forward(['list', '-q'], path=server, stdout=out)
+        assert other['ImageId'] in out.data
+
+    def test_error(self, ec2, server):
+        out = Output()
+
+        assert client.forward(['delete', 'ami-42424242'], path=server, stdout=Output(), stderr=out) == 1
+        assert out.data.startswith('Error:')
+
+    def test_different_environment(self, ec2, server, monkeypatch):
+        monkeypatch.setenv('AWS_PROFILE', 'other')
+
+        assert client.forward(['list'], path=server) is None
+
+    def test_concurrent_streamed_commands(self, tmpdir):
+        started, release = threading.Event(), threading.Event()
+
+        @click.group()
+        def group():
+            pass
+
+        @group.command()
+        def slow():
+            click.echo('started')
+            release.wait(5)
+            click.echo('done')
+
+        @group.command()
+        def fast():
+            click.echo('fast')
+
+        server = start(tmpdir, group)
+        try:
+            path = server.server_address
+            slow_out = Output(on_write=started.set)
+            thread = threading.Thread(target=client.forward, args=(['slow'], path, slow_out))
+            thread.start()
+
+            # output arrives while the command runs, other commands are not blocked
+            assert started.wait(5)
+            out = Output()
+            assert client.forward(['fast'], path=path, stdout=out) == 0
+            assert out.data == 'fast\n'
+            assert slow_out.data == 'started\n'
+
+            release.set()
+            thread.join(5)
+            assert slow_out.data == 'started\ndone\n'
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_parse_command(self):
+        assert client.parse_command(cli, ['ls', '-q'])[0] == 'list'
+        assert client.parse_command(cli, ['copy', 'ami-42424242', '--name', 'list'])[0] == 'copy'
+        assert client.parse_command(cli, ['--region', 'eu-west-1', 'snapshot', 'export', 'list'])[0] == 'snapshot'
+        assert client.parse_command(cli, ['--version'])[0] is None
+
+        assert not runs_locally(['list'])
+        assert runs_locally(['-v', 'list'])
+        assert runs_locally(['--trace', 'list.json', 'list'])
+        assert runs_locally(['diff', 'old.db', 'new.db'])
+        assert not runs_locally(['copy', 'ami-42424242', '--name', 'diff'])
+        assert runs_locally(['delete', '--cascade', 'ami-42424242'])
+        assert not runs_locally(['delete', '--cascade', '-y', 'ami-42424242'])
@@ -0,0 +1,48 @@
+import json
+import threading
+
+from shipami import tracing
+
+
+class TestTracing:
+
+    def test_disabled(self):
+        with tracing.span('foo', region='eu-west-1') as span:
+            span.set('image_id', 'ami-00000000')
+
+        assert tracing.stop() is None
+
+    def test_export(self, tmpdir):
+        path = str(tmpdir.join('trace.json'))
+        tracing.start()
+
+        def wait():
+            with tracing.span('wait_for_image'):
+                pass
+
+        with tracing.span('copy', region='eu-west-1') as span:
+            span.set('image_id', 'ami-00000000')
+            thread = threading.Thread(target=wait)
+            thread.start()
+            thread.join()
+        tracing.stop(path)
+
+        with open(path) as f:
+            events = json.load(f)['traceEvents']
+        spans = dict((_['name'], _) for _ in events if _['ph'] == 'X')
+
+        assert sorted(spans) == ['copy', 'wait_for_image']
+        assert spans['copy']['args'] == {'region': 'eu-west-1', 'image_id': 'ami-00000000'}
+        assert spans['copy']['tid'] != spans['wait_for_image']['tid']
+        assert len([_ for _ in events if _['ph'] == 'M']) == 2
+
+    def test_error(self):
+        tracer = tracing.start()
+        try:
+            with tracing.span('delete'):
+                raise RuntimeError('boom')
+        except RuntimeError:
+            pass
+        tracing.stop()
+
+        assert tracer.spans[0].attributes['error'] == 'boom'
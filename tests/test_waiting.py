@@ -0,0 +1,40 @@
+import threading
+import time
+
+import pytest
+
+from shipami import waiting
+from shipami.exceptions import WaitCancelled, WaitTimeout
+
+
+class TestPoll:
+
+    def test_done(self):
+        results = iter([(False, None), (False, 50), (True, 100)])
+        waiting.poll(lambda: next(results), 'test', min_delay=0.001)
+
+    def test_timeout(self):
+        with pytest.raises(WaitTimeout):
+            waiting.poll(lambda: (False, 10), 'test', deadline=waiting.deadline(0.05), min_delay=0.01)
+
+    def test_cancel(self):
+        cancel = threading.Event()
+        threading.Timer(0.05, cancel.set).start()
+
+        started = time.time()
+        with pytest.raises(WaitCancelled):
+            waiting.poll(lambda: (False, None), 'test', cancel=cancel, min_delay=10)
+        assert time.time() - started < 5
+
+    def test_progress_shortens_delay(self):
+        checks = []
+        started = time.time()
+
+        def check():
+            checks.append(time.time())
+            progress = min(100, int((time.time() - started) * 500))
+            return progress == 100, progress
+
+        # without progress the backoff would wait 1s then 1.5s
+        waiting.poll(check, 'test', min_delay=0.01, max_delay=1)
+        assert time.time() - started < 1